@@ -34,6 +34,7 @@ ALLOWED_HOSTS = []
 AUTH_USER_MODEL = 'users.User'
 
 INSTALLED_APPS = [
+    'daphne',  # ASGI-сервер для runserver (WebSocket чатов)
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -43,6 +44,7 @@ INSTALLED_APPS = [
     'chats',
 
     # Third party apps
+    'channels',
     'rest_framework',
     'rest_framework_simplejwt',  # Добавляем JWT
     'corsheaders',
@@ -83,6 +85,18 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'AxonHorizon.wsgi.application'
+ASGI_APPLICATION = 'AxonHorizon.asgi.application'
+
+# Channel layer для доставки сообщений чатов по WebSocket.
+# InMemoryChannelLayer работает в пределах одного процесса (разработка, тесты);
+# для нескольких узлов подключается общий слой, например:
+# 'BACKEND': 'channels_redis.core.RedisChannelLayer',
+# 'CONFIG': {'hosts': [('127.0.0.1', 6379)]},
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
 
 
 # Database
@@ -123,6 +137,37 @@ CACHE_TIMEOUTS = {
     'user_profile': 3600,  # 1 час
 }
 
+# Ранжирование ленты новостей по релевантности
+FEED_RANKING = {
+    'candidates': 500,       # количество свежих постов-кандидатов
+    'time_budget_ms': 15,    # при превышении - хронологический порядок
+    'half_life_hours': 36,   # период полураспада свежести поста
+}
+
+# Буфер лайков и избранного: документы состояния и счетчиков в MongoDB истекают
+# через столько секунд без переключений и затем заново читаются из БД
+ENGAGEMENT_STATE_TTL = 86400
+
+# Количество пользователей в кэше графа дружбы одного процесса
+FRIEND_GRAPH_CACHE_SIZE = 10000
+# Время жизни версий графа дружбы в общем кэше MongoDB, секунды
+FRIEND_GRAPH_VERSION_TIMEOUT = 86400
+
+# Автодополнение по людям, сообществам и научным областям (индекс в памяти процесса)
+TYPEAHEAD_MAX_ITEMS = 100000         # самых популярных записей каждого вида
+TYPEAHEAD_REFRESH_INTERVAL = 30      # секунд между дочитываниями изменений
+TYPEAHEAD_RELOAD_INTERVAL = 900      # секунд между полными перестроениями
+
+# Присутствие и индикатор набора текста (эфемерные данные, в реляционную БД не пишутся).
+# 'memory' - в памяти процесса (как InMemoryChannelLayer), 'mongo' - общая TTL-коллекция
+PRESENCE_BACKEND = 'memory'
+PRESENCE_TTL = 60    # секунд без heartbeat до статуса «не в сети»
+TYPING_TTL = 6       # секунд показа индикатора набора после последнего нажатия
+
+# Дневные агрегаты активности: события моложе этого числа секунд откладываются до
+# следующего запуска, чтобы не пропустить строки еще не завершенных транзакций
+ACTIVITY_ROLLUP_LAG = 60
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -0,0 +1,168 @@
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.db import transaction
+
+from .history import append_message
+from .models import Chat, ChatMember, Message
+from .presence import presence
+from .realtime import chat_group_name, serialize_message
+
+
+class ChatConsumer(AsyncJsonWebsocketConsumer):
+    """
+    WebSocket-подключение участника к чату.
+
+    Клиент может передать ?last_id=<id> при переподключении: после подписки
+    на группу ему досылаются пропущенные сообщения (не больше RESUME_LIMIT).
+    Сообщение {'type': 'read', 'message_id': id} сдвигает водяной знак прочтения,
+    {'type': 'heartbeat'} продлевает присутствие, {'type': 'typing'} включает
+    индикатор набора у остальных участников. Присутствие и набор хранятся
+    только в эфемерном хранилище presence, отключение снимает присутствие. Удаление из чата закрывает
+    подключение (см. membership.remove_members).
+    """
+
+    RESUME_LIMIT = 200
+    MAX_MESSAGE_LENGTH = 10000
+
+    async def connect(self):
+        self.joined = False
+        self.user = self.scope['user']
+        self.chat_id = self.scope['url_route']['kwargs']['chat_id']
+        self.group_name = chat_group_name(self.chat_id)
+
+        if not self.user.is_authenticated or not await self._is_member():
+            await self.close(code=4403)
+            return
+
+        # Сначала подписываемся, затем досылаем пропущенное, чтобы не было «дыры»;
+        # возможные дубликаты клиент отбрасывает по id
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        self.joined = True
+        await self._heartbeat()
+
+        last_id = self._last_id()
+        if last_id is not None:
+            missed, has_more = await self._messages_after(last_id)
+            await self.send_json({'type': 'resume', 'messages': missed, 'has_more': has_more})
+
+    async def disconnect(self, code):
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        if not self.joined:
+            return
+        # Пользователь уходит из сети сразу, а не через PRESENCE_TTL; другие его вкладки
+        # вернут его следующим heartbeat
+        await sync_to_async(presence.go_offline)(self.user.id)
+        await sync_to_async(presence.stop_typing)(self.chat_id, self.user.id)
+        await self.channel_layer.group_send(self.group_name, {
+            'type': 'chat.presence', 'user_id': self.user.id, 'online': False,
+        })
+
+    async def receive_json(self, content, **kwargs):
+        if content.get('type') == 'read':
+            await self._receive_read(content)
+            return
+        if content.get('type') == 'heartbeat':
+            await self._heartbeat()
+            return
+        if content.get('type') == 'typing':
+            await sync_to_async(presence.typing)(self.chat_id, self.user.id)
+            await self.channel_layer.group_send(self.group_name, {'type': 'chat.typing', 'user_id': self.user.id})
+            return
+        if content.get('type') != 'message':
+            return
+
+        text = (content.get('content') or '').strip()
+        if not text or len(text) > self.MAX_MESSAGE_LENGTH:
+            await self.send_json({'type': 'error', 'client_id': content.get('client_id'),
+                                  'error': 'Некорректное сообщение'})
+            return
+
+        message = await self._create_message(text)
+        await sync_to_async(presence.stop_typing)(self.chat_id, self.user.id)
+        await self.send_json({'type': 'ack', 'client_id': content.get('client_id'), 'id': message['id']})
+        await self.channel_layer.group_send(self.group_name, {'type': 'chat.message', 'message': message})
+
+    async def _heartbeat(self):
+        # Остальным участникам сообщаем только о появлении в сети, а не о каждом heartbeat
+        if await sync_to_async(presence.heartbeat)(self.user.id):
+            await self.channel_layer.group_send(self.group_name, {
+                'type': 'chat.presence', 'user_id': self.user.id, 'online': True,
+            })
+
+    async def _receive_read(self, content):
+        try:
+            message_id = int(content.get('message_id'))
+        except (TypeError, ValueError):
+            return
+        # Рассылаем отметку только если водяной знак действительно сдвинулся
+        if await self._mark_read(message_id):
+            await self.channel_layer.group_send(self.group_name, {
+                'type': 'chat.read', 'user_id': self.user.id, 'message_id': message_id,
+            })
+
+    async def chat_message(self, event):
+        self.last_message_id = max(self.last_message_id, event['message']['id'])
+        await self.send_json({'type': 'message', 'message': event['message']})
+
+    async def chat_typing(self, event):
+        if event['user_id'] != self.user.id:
+            await self.send_json({'type': 'typing', 'user_id': event['user_id']})
+
+    async def chat_presence(self, event):
+        if event['user_id'] != self.user.id:
+            await self.send_json({'type': 'presence', 'user_id': event['user_id'], 'online': event['online']})
+
+    async def chat_read(self, event):
+        await self.send_json({'type': 'read', 'user_id': event['user_id'], 'message_id': event['message_id']})
+
+    async def chat_members_removed(self, event):
+        # Удаленный участник больше не получает события чата и не может писать в него
+        if self.user.id in event['user_ids']:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            await self.close(code=4403)
+
+    def _last_id(self):
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            return int(query['last_id'][0])
+        except (KeyError, IndexError, ValueError):
+            return None
+
+    @database_sync_to_async
+    def _is_member(self):
+        # Тем же запросом запоминаем последнее сообщение чата; дальше оно обновляется по событиям
+        # группы и служит подсказкой для Chat.record_message при отправке
+        last_ids = list(
+            ChatMember.objects.filter(chat_id=self.chat_id, user=self.user).values_list('chat__last_message_id', flat=True)
+        )
+        self.last_message_id = (last_ids[0] or 0) if last_ids else 0
+        return bool(last_ids)
+
+    @database_sync_to_async
+    def _messages_after(self, last_id):
+        messages = list(
+            Message.objects.filter(chat_id=self.chat_id, id__gt=last_id)
+            .select_related('author')
+            .order_by('id')[:self.RESUME_LIMIT + 1]
+        )
+        has_more = len(messages) > self.RESUME_LIMIT
+        return [serialize_message(message) for message in messages[:self.RESUME_LIMIT]], has_more
+
+    @database_sync_to_async
+    def _mark_read(self, message_id):
+        # Водяной знак не может обогнать последнее реальное сообщение чата
+        if not Message.objects.filter(chat_id=self.chat_id, id=message_id).exists():
+            return False
+        return ChatMember.mark_read(self.chat_id, self.user.id, message_id)
+
+    @database_sync_to_async
+    def _create_message(self, text):
+        chat = Chat(id=self.chat_id, last_message_id=self.last_message_id)
+        message = Message.objects.create(chat=chat, author=self.user, content=text)
+        self.last_message_id = max(self.last_message_id, message.id)
+        transaction.on_commit(lambda: append_message(message))
+        return serialize_message(message)
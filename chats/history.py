@@ -0,0 +1,81 @@
+from datetime import timezone as dt_timezone
+
+from django.utils import timezone
+
+from utils.mongo_cache import MongoCacheHelper
+from .models import Message
+
+
+# Сколько последних сообщений показывается при открытии чата и хранится в кэше
+HISTORY_WINDOW = 50
+# Размер страницы при подгрузке более ранних сообщений
+HISTORY_PAGE_SIZE = 50
+
+
+def serialize_message(message):
+    """Компактное представление сообщения для кэша и шаблона"""
+    return {
+        'id': message.id,
+        'chat_id': message.chat_id,
+        'author_id': message.author_id,
+        'author_username': message.author.username,
+        'author_name': message.author.get_full_name() or message.author.username,
+        'content': message.content,
+        'created_at': message.created_at,
+    }
+
+
+def message_json(message_data):
+    """Представление сообщения для JSON (дата в ISO 8601)"""
+    return {**message_data, 'created_at': message_data['created_at'].isoformat()}
+
+
+def _fetch_before(chat_id, before_id, limit):
+    """limit сообщений старше before_id (или самых новых) в хронологическом порядке и признак продолжения"""
+    messages = Message.objects.filter(chat_id=chat_id).select_related('author').order_by('-id')
+    if before_id is not None:
+        messages = messages.filter(id__lt=before_id)
+    messages = list(messages[:limit + 1])
+    has_more = len(messages) > limit
+    return [serialize_message(message) for message in reversed(messages[:limit])], has_more
+
+
+def get_recent_messages(chat_id):
+    """
+    Окно последних HISTORY_WINDOW сообщений чата.
+
+    В кэше хранится только это окно, поэтому память и время ответа не зависят
+    от возраста чата. Новые сообщения дописываются в окно (append_message),
+    из БД оно перечитывается только после пропуска.
+    """
+    window = MongoCacheHelper.get_cached_chat_messages(chat_id)
+    if window is not None:
+        for message_data in window['messages']:
+            # MongoDB возвращает даты без часового пояса (в UTC)
+            if timezone.is_naive(message_data['created_at']):
+                message_data['created_at'] = timezone.make_aware(message_data['created_at'], dt_timezone.utc)
+        return window
+
+    messages, has_more = _fetch_before(chat_id, None, HISTORY_WINDOW)
+    window = {'messages': messages, 'has_more': has_more}
+    MongoCacheHelper.cache_chat_messages(chat_id, window)
+    return window
+
+
+def get_messages_before(chat_id, before_id, limit=HISTORY_PAGE_SIZE):
+    """Страница истории старше сообщения before_id"""
+    messages, has_more = _fetch_before(chat_id, before_id, limit)
+    return {'messages': messages, 'has_more': has_more}
+
+
+def append_message(message):
+    """
+    Дописать только что сохраненное сообщение в кэшированное окно чата.
+
+    Предыдущее сообщение берется из сводки чата, подтвержденной при сохранении
+    (Message.previous_message_id). Если оно неизвестно, окно сбрасывается и
+    при следующем открытии чата перечитывается из БД.
+    """
+    return MongoCacheHelper.append_chat_message(
+        message.chat_id, serialize_message(message), getattr(message, 'previous_message_id', None), HISTORY_WINDOW
+    )
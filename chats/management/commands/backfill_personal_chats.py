@@ -0,0 +1,96 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chats.models import Chat, ChatMember, Message, display_name
+from users.models import User
+from utils.mongo_cache import MongoCacheHelper
+
+
+class Command(BaseCommand):
+    help = 'Fill the canonical member pair of existing personal chats'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Chats per transaction'
+        )
+        parser.add_argument(
+            '--merge-duplicates',
+            action='store_true',
+            help='Move messages of duplicate chats into the oldest chat of the pair and delete the duplicates'
+        )
+
+    def handle(self, *args, **options):
+        filled = skipped = duplicates = 0
+        last_id = 0
+
+        while True:
+            chat_ids = list(
+                Chat.objects.filter(chat_type='personal', member_low_id__isnull=True, id__gt=last_id)
+                .order_by('id').values_list('id', flat=True)[:options['batch_size']]
+            )
+            if not chat_ids:
+                break
+            last_id = chat_ids[-1]
+
+            with transaction.atomic():
+                batch_filled, batch_skipped, batch_duplicates = self._process(chat_ids, options['merge_duplicates'])
+            filled += batch_filled
+            skipped += batch_skipped
+            duplicates += batch_duplicates
+
+        self.stdout.write(f"Chats without exactly two members: {skipped}")
+        if duplicates:
+            action = 'merged' if options['merge_duplicates'] else 'left as is (use --merge-duplicates)'
+            self.stdout.write(self.style.WARNING(f"Duplicate personal chats {action}: {duplicates}"))
+        self.stdout.write(self.style.SUCCESS(f"Filled member pair for {filled} chats"))
+
+    def _process(self, chat_ids, merge):
+        members = defaultdict(set)
+        for chat_id, user_id in ChatMember.objects.filter(chat_id__in=chat_ids).values_list('chat_id', 'user_id'):
+            members[chat_id].add(user_id)
+
+        pairs = {}
+        skipped = 0
+        for chat_id in chat_ids:
+            if len(members[chat_id]) != 2:
+                skipped += 1
+                continue
+            pairs[chat_id] = Chat.personal_pair(*members[chat_id])
+
+        # Пары, которые уже закреплены за другими чатами
+        owners = {}
+        lows = {low for low, _ in pairs.values()}
+        for chat_id, low, high in Chat.objects.filter(
+            chat_type='personal', member_low_id__in=lows
+        ).values_list('id', 'member_low_id', 'member_high_id'):
+            owners[(low, high)] = chat_id
+
+        names = {user.id: display_name(user) for user in User.objects.filter(
+            id__in={user_id for pair in pairs.values() for user_id in pair})}
+
+        to_update = []
+        duplicates = {}
+        for chat_id, pair in pairs.items():
+            if pair in owners:
+                duplicates[chat_id] = owners[pair]
+                continue
+            owners[pair] = chat_id
+            to_update.append(Chat(id=chat_id, member_low_id=pair[0], member_high_id=pair[1],
+                                  member_low_name=names[pair[0]], member_high_name=names[pair[1]]))
+
+        Chat.objects.bulk_update(to_update, ['member_low_id', 'member_high_id', 'member_low_name', 'member_high_name'],
+                                 batch_size=500)
+
+        if merge:
+            for duplicate_id, canonical_id in duplicates.items():
+                Message.objects.filter(chat_id=duplicate_id).update(chat_id=canonical_id)
+                Chat.objects.filter(id=duplicate_id).delete()
+                Chat.objects.get(id=canonical_id).refresh_summary()
+                transaction.on_commit(lambda chat_id=canonical_id: MongoCacheHelper.invalidate_chat_cache(chat_id))
+
+        return len(to_update), skipped, len(duplicates)
@@ -0,0 +1,131 @@
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chats.presence import MemoryPresenceStore, create_presence_store
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the presence store with many concurrent heartbeating users'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000, help='Concurrently connected users')
+        parser.add_argument('--duration', type=int, default=300,
+                            help='Simulated seconds (memory backend)')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Client heartbeat interval in seconds (default: PRESENCE_TTL / 3)')
+        parser.add_argument('--chat-size', type=int, default=50, help='Members per presence read')
+        parser.add_argument('--churn', type=float, default=0.05,
+                            help='Share of users replaced by new ones every simulated minute')
+        parser.add_argument('--backend', choices=['memory', 'mongo'], default=None,
+                            help='Store to benchmark (default: PRESENCE_BACKEND)')
+
+    def handle(self, *args, **options):
+        backend = options['backend'] or getattr(settings, 'PRESENCE_BACKEND', 'memory')
+        if backend == 'memory':
+            self._benchmark_memory(options)
+        else:
+            self._benchmark_mongo(options)
+
+    def _benchmark_memory(self, options):
+        """Симуляция по виртуальному времени: истечение и очистка идут так же, как за реальные минуты"""
+        clock = SimulatedClock()
+        store = MemoryPresenceStore(clock=clock)
+        users = options['users']
+        interval = options['interval'] or store.ttl / 3
+        chat_size = options['chat_size']
+
+        active = list(range(users))
+        next_user_id = users
+        # Каждый клиент шлет heartbeat со своим сдвигом внутри интервала
+        offsets = {user_id: random.random() * interval for user_id in active}
+
+        heartbeat_calls = read_calls = 0
+        heartbeat_time = read_time = 0.0
+        peak_heap = 0
+
+        for second in range(options['duration']):
+            clock.now = float(second)
+
+            if second and second % 60 == 0 and options['churn']:
+                # Часть пользователей уходит (их записи должны истечь), приходят новые
+                for index in random.sample(range(len(active)), int(len(active) * options['churn'])):
+                    offsets.pop(active[index])
+                    active[index] = next_user_id
+                    offsets[next_user_id] = random.random() * interval
+                    next_user_id += 1
+
+            due = [user_id for user_id in active if (second - offsets[user_id]) % interval < 1]
+            started = time.perf_counter()
+            for user_id in due:
+                store.heartbeat(user_id)
+            heartbeat_time += time.perf_counter() - started
+            heartbeat_calls += len(due)
+
+            # Каждую секунду часть пользователей открывает чат и запрашивает присутствие участников
+            reads = [random.sample(active, chat_size) for _ in range(max(users // 100, 1))]
+            started = time.perf_counter()
+            for member_ids in reads:
+                store.online(member_ids)
+            read_time += time.perf_counter() - started
+            read_calls += len(reads)
+
+            peak_heap = max(peak_heap, len(store._heap))
+
+        simulated_online = len(store.online(active))
+        self.stdout.write(f"Backend: memory, users: {users}, simulated: {options['duration']} s, "
+                          f"heartbeat interval: {interval:.0f} s, TTL: {store.ttl} s")
+        self.stdout.write(f"Heartbeats: {heartbeat_calls} calls, "
+                          f"{heartbeat_time / max(heartbeat_calls, 1) * 1e6:.2f} us per call, "
+                          f"{heartbeat_calls / options['duration']:.0f} per second of load")
+        self.stdout.write(f"Presence reads ({chat_size} members): {read_calls} calls, "
+                          f"{read_time / max(read_calls, 1) * 1e6:.2f} us per call")
+        self.stdout.write(f"Store: {len(store)} online entries (active users online: {simulated_online}), "
+                          f"peak heap {peak_heap}, users replaced by churn: {next_user_id - users}")
+        busy = (heartbeat_time + read_time) / options['duration'] * 100
+        self.stdout.write(self.style.SUCCESS(f"CPU share of one core: {busy:.3f}%"))
+
+    def _benchmark_mongo(self, options):
+        """Реальное время: один полный цикл heartbeat всех пользователей и батч-чтения"""
+        store = create_presence_store('mongo')
+        users = options['users']
+        chat_size = options['chat_size']
+        user_ids = range(10 ** 9, 10 ** 9 + users)  # не пересекаются с настоящими пользователями
+
+        started = time.perf_counter()
+        for user_id in user_ids:
+            store.heartbeat(user_id)
+        heartbeat_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for user_id in user_ids:
+            store.heartbeat(user_id)
+        coalesced_time = time.perf_counter() - started
+
+        reads = [random.sample(user_ids, chat_size) for _ in range(200)]
+        started = time.perf_counter()
+        for member_ids in reads:
+            store.online(member_ids)
+        read_time = time.perf_counter() - started
+
+        store.presence.delete_many({'_id': {'$gte': user_ids[0], '$lte': user_ids[-1]}})
+
+        interval = options['interval'] or store.ttl / 3
+        self.stdout.write(f"Backend: mongo, users: {users}")
+        self.stdout.write(f"Heartbeat writes: {heartbeat_time / users * 1e6:.0f} us per call, "
+                          f"{users / interval:.0f} writes per second of load at {interval:.0f} s interval")
+        self.stdout.write(f"Repeated heartbeats within refresh window: {coalesced_time / users * 1e6:.2f} us per call")
+        self.stdout.write(f"Presence reads ({chat_size} members): {read_time / len(reads) * 1e6:.0f} us per call")
+        self.stdout.write(self.style.SUCCESS(
+            f"Store load: {heartbeat_time / interval * 100:.1f}% of one connection busy"
+        ))
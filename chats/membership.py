@@ -0,0 +1,71 @@
+from django.db import transaction
+
+from users.models import User
+from utils.mongo_cache import MongoCacheHelper
+from .models import Chat, ChatMember
+from .realtime import disconnect_members
+
+
+def _parse_ids(user_ids):
+    ids = set()
+    for user_id in user_ids:
+        try:
+            ids.add(int(user_id))
+        except (TypeError, ValueError):
+            continue
+    return ids
+
+
+def add_members(chat, user_ids, role='member'):
+    """
+    Добавить пользователей в чат пачкой.
+
+    Один in_bulk для проверки id, один запрос уже состоящих, чтение последнего
+    сообщения чата (с него начинается водяной знак прочтения), bulk_create
+    с ignore_conflicts и один пересчет счетчика участников - число запросов
+    не зависит от количества пользователей. Возвращает список добавленных.
+    """
+    users = User.objects.in_bulk(_parse_ids(user_ids))
+    if not users:
+        return []
+
+    existing = set(ChatMember.objects.filter(chat=chat, user_id__in=users).values_list('user_id', flat=True))
+    added = [user for user_id, user in users.items() if user_id not in existing]
+    if not added:
+        return []
+
+    with transaction.atomic():
+        # Новые участники начинают с прочитанной историей
+        last_read_message_id = Chat.current_last_message_id(chat.id)
+        ChatMember.objects.bulk_create(
+            [ChatMember(chat=chat, user=user, role=role, last_read_message_id=last_read_message_id)
+             for user in added],
+            ignore_conflicts=True,
+        )
+        Chat.refresh_member_count(chat.id)
+
+    added_ids = [user.id for user in added]
+    transaction.on_commit(lambda: MongoCacheHelper.invalidate_chat_lists(added_ids))
+    return added
+
+
+def remove_members(chat, user_ids):
+    """
+    Удалить пользователей из чата одним DELETE; возвращает количество удаленных.
+
+    После фиксации открытые WebSocket-подключения удаленных закрываются:
+    членство проверяется только при подключении.
+    """
+    ids = _parse_ids(user_ids)
+    if not ids:
+        return 0
+
+    with transaction.atomic():
+        removed, _ = ChatMember.objects.filter(chat=chat, user_id__in=ids).delete()
+        if removed:
+            Chat.refresh_member_count(chat.id)
+
+    if removed:
+        transaction.on_commit(lambda: MongoCacheHelper.invalidate_chat_lists(ids))
+        transaction.on_commit(lambda: disconnect_members(chat.id, ids))
+    return removed
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.7 on 2026-10-19 11:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmember',
+            index=models.Index(fields=['user', 'chat', 'last_read'], name='chatmember_user_read_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'created_at'], name='message_chat_created_idx'),
+        ),
+    ]
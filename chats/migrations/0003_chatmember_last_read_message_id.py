@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 11:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0002_chatmember_chatmember_user_read_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmember',
+            name='last_read_message_id',
+            field=models.PositiveBigIntegerField(default=0, verbose_name='Последнее прочитанное сообщение'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_read_watermark(apps, schema_editor):
+    ChatMember = apps.get_model('chats', 'ChatMember')
+    Message = apps.get_model('chats', 'Message')
+
+    # Водяной знак = последнее сообщение чата, созданное не позже last_read
+    last_read_message = Message.objects.filter(
+        chat_id=OuterRef('chat_id'), created_at__lte=OuterRef('last_read')
+    ).order_by().values('chat_id').annotate(last_id=Max('id')).values('last_id')
+    ChatMember.objects.update(last_read_message_id=Coalesce(Subquery(last_read_message), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0003_chatmember_last_read_message_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_read_watermark, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.7 on 2026-10-19 11:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0004_backfill_read_watermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='member_high_id',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='member_low_id',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='chat',
+            constraint=models.UniqueConstraint(condition=models.Q(('chat_type', 'personal')), fields=('member_low_id', 'member_high_id'), name='chat_personal_pair_uniq'),
+        ),
+    ]
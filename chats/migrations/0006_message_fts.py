@@ -0,0 +1,65 @@
+from django.db import migrations
+
+
+# Внешнее содержимое: индекс хранит только токены, текст берется из chats_message.
+# Триггеры держат индекс в актуальном состоянии при любых изменениях сообщений,
+# prefix-индексы ускоряют префиксный поиск по коротким началам слов.
+FTS_SQL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chats_message_fts USING fts5(
+        content, content='chats_message', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chats_message_fts_insert AFTER INSERT ON chats_message BEGIN
+        INSERT INTO chats_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chats_message_fts_delete AFTER DELETE ON chats_message BEGIN
+        INSERT INTO chats_message_fts(chats_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chats_message_fts_update AFTER UPDATE OF content ON chats_message BEGIN
+        INSERT INTO chats_message_fts(chats_message_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO chats_message_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    "INSERT INTO chats_message_fts(chats_message_fts) VALUES ('rebuild')",
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS chats_message_fts_update",
+    "DROP TRIGGER IF EXISTS chats_message_fts_delete",
+    "DROP TRIGGER IF EXISTS chats_message_fts_insert",
+    "DROP TABLE IF EXISTS chats_message_fts",
+]
+
+
+def _execute_on_sqlite(schema_editor, statements):
+    # FTS5 есть только в SQLite; на других СУБД поиск работает без индекса
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def create_message_fts(apps, schema_editor):
+    _execute_on_sqlite(schema_editor, FTS_SQL)
+
+
+def drop_message_fts(apps, schema_editor):
+    _execute_on_sqlite(schema_editor, DROP_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0005_chat_personal_pair'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_message_fts, drop_message_fts),
+    ]
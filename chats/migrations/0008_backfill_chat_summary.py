@@ -0,0 +1,57 @@
+from django.db import migrations
+
+
+PREVIEW_LENGTH = 200
+
+
+def _display_name(user):
+    full_name = f'{user.first_name} {user.last_name}'.strip()
+    return full_name or user.username
+
+
+def backfill_chat_summary(apps, schema_editor):
+    Chat = apps.get_model('chats', 'Chat')
+    ChatMember = apps.get_model('chats', 'ChatMember')
+    Message = apps.get_model('chats', 'Message')
+    User = apps.get_model('users', 'User')
+
+    chats = []
+    for chat in Chat.objects.order_by('id').iterator(chunk_size=500):
+        chat.member_count = ChatMember.objects.filter(chat_id=chat.id).count()
+        chat.message_count = Message.objects.filter(chat_id=chat.id).count()
+        last = Message.objects.filter(chat_id=chat.id).select_related('author').order_by('-id').first()
+        if last:
+            chat.last_message_id = last.id
+            chat.last_message_at = last.created_at
+            chat.last_message_preview = ' '.join(last.content.split())[:PREVIEW_LENGTH]
+            chat.last_message_author_name = _display_name(last.author)
+        if chat.member_low_id is not None:
+            names = {user.id: _display_name(user) for user in User.objects.filter(
+                id__in=[chat.member_low_id, chat.member_high_id])}
+            chat.member_low_name = names.get(chat.member_low_id, '')
+            chat.member_high_name = names.get(chat.member_high_id, '')
+        chats.append(chat)
+
+        if len(chats) >= 500:
+            _save(Chat, chats)
+            chats = []
+    _save(Chat, chats)
+
+
+def _save(Chat, chats):
+    Chat.objects.bulk_update(chats, [
+        'member_count', 'message_count', 'last_message_id', 'last_message_at',
+        'last_message_preview', 'last_message_author_name', 'member_low_name', 'member_high_name',
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0007_chat_summary'),
+        ('users', '0008_backfill_friendedge'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_chat_summary, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,65 @@
+from collections import defaultdict
+
+from django.db import migrations
+
+
+BATCH_SIZE = 500
+
+
+def _display_name(user):
+    full_name = f'{user.first_name} {user.last_name}'.strip()
+    return full_name or user.username
+
+
+def backfill_personal_pair(apps, schema_editor):
+    Chat = apps.get_model('chats', 'Chat')
+    ChatMember = apps.get_model('chats', 'ChatMember')
+    User = apps.get_model('users', 'User')
+
+    # Пара достается самому старому чату; дубликаты остаются без пары,
+    # их объединяет команда backfill_personal_chats --merge-duplicates
+    owned = set(
+        Chat.objects.filter(chat_type='personal', member_low_id__isnull=False)
+        .values_list('member_low_id', 'member_high_id')
+    )
+    last_id = 0
+    while True:
+        chat_ids = list(
+            Chat.objects.filter(chat_type='personal', member_low_id__isnull=True, id__gt=last_id)
+            .order_by('id').values_list('id', flat=True)[:BATCH_SIZE]
+        )
+        if not chat_ids:
+            break
+        last_id = chat_ids[-1]
+
+        members = defaultdict(set)
+        for chat_id, user_id in ChatMember.objects.filter(chat_id__in=chat_ids).values_list('chat_id', 'user_id'):
+            members[chat_id].add(user_id)
+
+        pairs = {}
+        for chat_id in chat_ids:
+            if len(members[chat_id]) == 2:
+                pair = tuple(sorted(members[chat_id]))
+                if pair not in owned:
+                    owned.add(pair)
+                    pairs[chat_id] = pair
+
+        names = {user.id: _display_name(user) for user in User.objects.filter(
+            id__in={user_id for pair in pairs.values() for user_id in pair})}
+        Chat.objects.bulk_update(
+            [Chat(id=chat_id, member_low_id=low, member_high_id=high,
+                  member_low_name=names[low], member_high_name=names[high])
+             for chat_id, (low, high) in pairs.items()],
+            ['member_low_id', 'member_high_id', 'member_low_name', 'member_high_name'],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0008_backfill_chat_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_personal_pair, migrations.RunPython.noop),
+    ]
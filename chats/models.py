@@ -1,8 +1,17 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
 from django.conf import settings
 from django.utils import timezone
 
 
+PREVIEW_LENGTH = 200
+
+
+def display_name(user):
+    return user.get_full_name() or user.username
+
+
 class Chat(models.Model):
     CHAT_TYPES = (
         ('personal', 'Личный чат'),
@@ -17,19 +26,169 @@ class Chat(models.Model):
                                      related_name='chats', verbose_name="Участники")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+    # Каноническая пара участников личного чата (меньший и больший id)
+    member_low_id = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
+    member_high_id = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
+    member_low_name = models.CharField(max_length=255, blank=True, editable=False)
+    member_high_name = models.CharField(max_length=255, blank=True, editable=False)
+
+    # Сводка для списка чатов, обновляется при отправке сообщения и изменении состава
+    member_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Участников")
+    message_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Сообщений")
+    last_message_id = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
+    last_message_at = models.DateTimeField(null=True, blank=True, editable=False)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, editable=False)
+    last_message_author_name = models.CharField(max_length=255, blank=True, editable=False)
 
     class Meta:
         verbose_name = "Чат"
         verbose_name_plural = "Чаты"
         ordering = ['-updated_at']
+        constraints = [
+            # Один личный чат на пару пользователей; поиск пары - одно обращение к индексу
+            models.UniqueConstraint(fields=['member_low_id', 'member_high_id'],
+                                    condition=models.Q(chat_type='personal'),
+                                    name='chat_personal_pair_uniq'),
+        ]
 
     def __str__(self):
         if self.chat_type == 'personal':
+            if self.member_low_id is not None:
+                return self.display_name_for(self.created_by_id)
             members = self.members.exclude(id=self.created_by_id)
             if members.exists():
                 return f"Чат с {members.first().get_full_name()}"
         return self.name or f"Чат {self.id}"
 
+    def display_name_for(self, user_id):
+        """Название чата для участника: для личного чата - имя собеседника из сохраненной пары"""
+        if self.chat_type == 'personal' and self.member_low_id is not None:
+            other_name = self.member_high_name if user_id == self.member_low_id else self.member_low_name
+            return f"Чат с {other_name}"
+        return self.name or f"Чат {self.id}"
+
+    @classmethod
+    def record_message(cls, message, expected_last_id=None):
+        """
+        Обновить сводку чата новым сообщением одним UPDATE (опоздавшее сообщение не затирает более новое).
+
+        expected_last_id - последнее сообщение чата, известное вызывающему (0 - чат был пуст).
+        Если оно подтверждается условием того же UPDATE, оно и есть предыдущее сообщение
+        и возвращается; иначе сводка обновляется с проверкой порядка, а результат - None.
+        """
+        preview = ' '.join(message.content.split())[:PREVIEW_LENGTH]
+        chats = cls.objects.filter(id=message.chat_id)
+        if expected_last_id is not None and expected_last_id < message.id:
+            previous = Q(last_message_id=expected_last_id) if expected_last_id else Q(last_message_id__isnull=True)
+            if chats.filter(previous).update(
+                message_count=F('message_count') + 1, last_message_id=message.id, last_message_at=message.created_at,
+                last_message_preview=preview, last_message_author_name=display_name(message.author),
+                updated_at=timezone.now(),
+            ):
+                return expected_last_id
+
+        newer = Q(last_message_id__isnull=True) | Q(last_message_id__lt=message.id)
+
+        def latest(field, value):
+            return Case(When(newer, then=Value(value)), default=F(field), output_field=cls._meta.get_field(field))
+
+        chats.update(
+            message_count=F('message_count') + 1,
+            last_message_id=latest('last_message_id', message.id),
+            last_message_at=latest('last_message_at', message.created_at),
+            last_message_preview=latest('last_message_preview', preview),
+            last_message_author_name=latest('last_message_author_name', display_name(message.author)),
+            updated_at=timezone.now(),
+        )
+        return None
+
+    def refresh_summary(self):
+        """Пересчитать сводку чата по базе (после удаления сообщений или участников)"""
+        last = self.messages.select_related('author').order_by('-id').first()
+        self.member_count = self.chatmember_set.count()
+        self.message_count = self.messages.count()
+        self.last_message_id = last.id if last else None
+        self.last_message_at = last.created_at if last else None
+        self.last_message_preview = ' '.join(last.content.split())[:PREVIEW_LENGTH] if last else ''
+        self.last_message_author_name = display_name(last.author) if last else ''
+        Chat.objects.filter(id=self.id).update(
+            member_count=self.member_count,
+            message_count=self.message_count,
+            last_message_id=self.last_message_id,
+            last_message_at=self.last_message_at,
+            last_message_preview=self.last_message_preview,
+            last_message_author_name=self.last_message_author_name,
+        )
+
+    @classmethod
+    def current_last_message_id(cls, chat_id):
+        """id последнего сообщения чата по сводке (0 для пустого чата): водяной знак прочтения нового участника"""
+        return cls.objects.filter(id=chat_id).values_list('last_message_id', flat=True).first() or 0
+
+    @classmethod
+    def refresh_member_count(cls, chat_id):
+        """Пересчитать число участников одним UPDATE (после массовых операций с участниками)"""
+        members = ChatMember.objects.filter(chat_id=OuterRef('pk')).order_by().values('chat_id').annotate(total=Count('*'))
+        cls.objects.filter(id=chat_id).update(member_count=Coalesce(Subquery(members.values('total')), 0))
+
+    @classmethod
+    def refresh_member_names(cls, user):
+        """Обновить сохраненное имя пользователя во всех его личных чатах"""
+        name = display_name(user)
+        cls.objects.filter(chat_type='personal', member_low_id=user.id).update(member_low_name=name)
+        cls.objects.filter(chat_type='personal', member_high_id=user.id).update(member_high_name=name)
+
+    @staticmethod
+    def personal_pair(user_id, other_user_id):
+        """Канонический ключ личного чата: id участников по возрастанию"""
+        return min(user_id, other_user_id), max(user_id, other_user_id)
+
+    @classmethod
+    def get_or_create_personal(cls, user, other_user):
+        """
+        Найти или создать личный чат двух пользователей.
+
+        Поиск идет по уникальному индексу пары, поэтому при одновременном
+        создании второй запрос получит IntegrityError и вернет чат первого.
+        Старый чат без заполненной пары находится по участникам.
+        Возвращает (chat, created).
+        """
+        low, high = cls.personal_pair(user.id, other_user.id)
+        lookup = {'chat_type': 'personal', 'member_low_id': low, 'member_high_id': high}
+        names = {user.id: display_name(user), other_user.id: display_name(other_user)}
+
+        chat = cls.objects.filter(**lookup).first()
+        if chat:
+            return chat, False
+
+        # Чат, созданный до появления пары и еще не заполненный миграцией
+        # или командой backfill_personal_chats, находим по участникам и закрепляем пару за ним
+        chat = cls.objects.filter(chat_type='personal', member_low_id__isnull=True, members=user) \
+            .filter(members=other_user).order_by('id').first()
+        if chat:
+            fields = {'member_low_id': low, 'member_high_id': high,
+                      'member_low_name': names[low], 'member_high_name': names[high]}
+            try:
+                with transaction.atomic():
+                    cls.objects.filter(id=chat.id).update(**fields)
+            except IntegrityError:
+                return cls.objects.get(**lookup), False
+            for name, value in fields.items():
+                setattr(chat, name, value)
+            return chat, False
+
+        try:
+            with transaction.atomic():
+                chat = cls.objects.create(created_by=user, member_low_name=names[low], member_high_name=names[high],
+                                          member_count=2, **lookup)
+                ChatMember.objects.bulk_create([
+                    ChatMember(user=user, chat=chat, role='admin'),
+                    ChatMember(user=other_user, chat=chat, role='member'),
+                ])
+        except IntegrityError:
+            return cls.objects.get(**lookup), False
+        return chat, True
+
     def get_last_message(self):
         return self.messages.order_by('-created_at').first()
 
@@ -37,6 +196,20 @@ class Chat(models.Model):
         return self.messages.filter(created_at__gt=user.chat_members.get(chat=self).last_read).count()
 
 
+class ChatMemberQuerySet(models.QuerySet):
+    def with_unread(self):
+        """Аннотировать участия числом чужих сообщений выше водяного знака прочтения"""
+        unread = Message.objects.filter(
+            chat_id=OuterRef('chat_id'), id__gt=OuterRef('last_read_message_id')
+        ).exclude(author_id=OuterRef('user_id')).order_by().values('chat_id').annotate(total=Count('*'))
+        return self.annotate(unread=Coalesce(Subquery(unread.values('total')), 0))
+
+    def with_latest_message_id(self):
+        """Аннотировать участия id последнего сообщения чата (поиск по индексу chat_id)"""
+        latest = Message.objects.filter(chat_id=OuterRef('chat_id')).order_by('-id').values('id')[:1]
+        return self.annotate(last_id=Coalesce(Subquery(latest), 0))
+
+
 class ChatMember(models.Model):
     ROLE_CHOICES = (
         ('member', 'Участник'),
@@ -48,15 +221,57 @@ class ChatMember(models.Model):
     role = models.CharField(max_length=20, choices=ROLE_CHOICES, default='member', verbose_name="Роль")
     joined_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата вступления")
     last_read = models.DateTimeField(default=timezone.now, verbose_name="Последнее прочтение")
+    # Водяной знак прочтения: все сообщения чата с id <= этого значения прочитаны
+    last_read_message_id = models.PositiveBigIntegerField(default=0, verbose_name="Последнее прочитанное сообщение")
+
+    objects = ChatMemberQuerySet.as_manager()
 
     class Meta:
         verbose_name = "Участник чата"
         verbose_name_plural = "Участники чатов"
         unique_together = ('user', 'chat')
+        indexes = [
+            # Подсчет непрочитанных сообщений без обращения к таблице
+            models.Index(fields=['user', 'chat', 'last_read'], name='chatmember_user_read_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user} в {self.chat}"
 
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        if created and not self.last_read_message_id:
+            # История до вступления не считается непрочитанной
+            self.last_read_message_id = Chat.current_last_message_id(self.chat_id)
+        super().save(*args, **kwargs)
+        if created:
+            Chat.objects.filter(id=self.chat_id).update(member_count=F('member_count') + 1)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        Chat.objects.filter(id=self.chat_id).update(member_count=Greatest(F('member_count') - 1, 0))
+        return result
+
+    @classmethod
+    def mark_read(cls, chat_id, user_id, message_id):
+        """
+        Сдвинуть водяной знак прочтения до message_id одним UPDATE.
+
+        Знак только растет, поэтому повторное или запоздавшее обращение
+        ничего не перезаписывает. Возвращает True, если знак сдвинулся.
+        """
+        return cls.objects.filter(
+            chat_id=chat_id, user_id=user_id, last_read_message_id__lt=message_id
+        ).update(last_read_message_id=message_id, last_read=timezone.now()) > 0
+
+    @classmethod
+    def read_up_to(cls, chat_id, exclude_user_id=None):
+        """Наибольший водяной знак среди участников чата (кроме exclude_user_id)"""
+        members = cls.objects.filter(chat_id=chat_id)
+        if exclude_user_id is not None:
+            members = members.exclude(user_id=exclude_user_id)
+        return members.aggregate(watermark=models.Max('last_read_message_id'))['watermark'] or 0
+
 
 class Message(models.Model):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='messages', verbose_name="Чат")
@@ -72,12 +287,39 @@ class Message(models.Model):
         verbose_name = "Сообщение"
         verbose_name_plural = "Сообщения"
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['chat', 'created_at'], name='message_chat_created_idx'),
+        ]
 
     def __str__(self):
         return f"Сообщение от {self.author} в {self.chat}"
 
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        super().save(*args, **kwargs)
+        if created:
+            # Загруженная строка чата подсказывает предыдущее сообщение: подтвердив его тем же
+            # UPDATE сводки, сообщение дописывается в кэшированное окно без чтения БД (append_message)
+            chat = self.chat if self._meta.get_field('chat').is_cached(self) else None
+            expected_last_id = (chat.last_message_id or 0) if chat else None
+            self.previous_message_id = Chat.record_message(self, expected_last_id)
+            if chat and (chat.last_message_id or 0) < self.id:
+                chat.last_message_id = self.id
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        Chat.objects.get(id=self.chat_id).refresh_summary()
+        return result
+
 
 class MessageRead(models.Model):
+    """
+    Отметка о прочтении отдельного сообщения (прежняя схема).
+
+    Прочтение определяется водяным знаком ChatMember.last_read_message_id,
+    новые строки сюда не пишутся.
+    """
+
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name="Пользователь")
     message = models.ForeignKey(Message, on_delete=models.CASCADE, verbose_name="Сообщение")
     read_at = models.DateTimeField(auto_now_add=True, verbose_name="Время прочтения")
@@ -85,4 +327,4 @@ class MessageRead(models.Model):
     class Meta:
         verbose_name = "Прочитанное сообщение"
         verbose_name_plural = "Прочитанные сообщения"
-        unique_together = ('user', 'message')
\ No newline at end of file
+        unique_together = ('user', 'message')
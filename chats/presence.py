@@ -0,0 +1,190 @@
+import heapq
+import threading
+import time
+from datetime import datetime, timedelta
+
+from django.conf import settings
+
+from .models import ChatMember
+
+
+class MemoryPresenceStore:
+    """
+    Присутствие и набор текста в памяти процесса.
+
+    Срок жизни каждой записи хранится в словаре, а в куче лежат моменты
+    истечения. Каждая операция снимает с кучи не больше sweep_batch истекших
+    записей, поэтому очистка размазана по обращениям и не требует фонового
+    потока. Повторный heartbeat раньше refresh_after секунд ничего не пишет.
+    """
+
+    def __init__(self, ttl=None, typing_ttl=None, sweep_batch=64, clock=time.monotonic):
+        self.ttl = ttl or getattr(settings, 'PRESENCE_TTL', 60)
+        self.typing_ttl = typing_ttl or getattr(settings, 'TYPING_TTL', 6)
+        self.refresh_after = self.ttl / 3
+        self.sweep_batch = sweep_batch
+        self.clock = clock
+
+        self._online = {}   # user_id -> момент истечения
+        self._typing = {}   # chat_id -> {user_id: момент истечения}
+        self._heap = []     # (момент истечения, ключ); устаревшие элементы отбрасываются при снятии
+        self._lock = threading.Lock()
+
+    def heartbeat(self, user_id):
+        """Отметить пользователя в сети; возвращает True, если он только что появился"""
+        now = self.clock()
+        with self._lock:
+            self._sweep(now)
+            expires = self._online.get(user_id)
+            if expires is not None and expires - now > self.ttl - self.refresh_after:
+                return False
+            self._online[user_id] = now + self.ttl
+            heapq.heappush(self._heap, (now + self.ttl, ('online', user_id)))
+            # Истекшая запись, которую очистка еще не сняла с кучи, - тоже новое появление
+            return expires is None or expires <= now
+
+    def go_offline(self, user_id):
+        with self._lock:
+            self._online.pop(user_id, None)
+
+    def online(self, user_ids):
+        """Множество пользователей из user_ids, которые сейчас в сети"""
+        now = self.clock()
+        with self._lock:
+            self._sweep(now)
+            return {user_id for user_id in user_ids if self._online.get(user_id, 0) > now}
+
+    def typing(self, chat_id, user_id):
+        """Отметить набор текста; возвращает True, если индикатор только что появился"""
+        now = self.clock()
+        with self._lock:
+            self._sweep(now)
+            typists = self._typing.setdefault(chat_id, {})
+            started = typists.get(user_id, 0) <= now
+            typists[user_id] = now + self.typing_ttl
+            heapq.heappush(self._heap, (now + self.typing_ttl, ('typing', chat_id, user_id)))
+            return started
+
+    def stop_typing(self, chat_id, user_id):
+        with self._lock:
+            self._typing.get(chat_id, {}).pop(user_id, None)
+
+    def typing_users(self, chat_id):
+        now = self.clock()
+        with self._lock:
+            self._sweep(now)
+            return {user_id for user_id, expires in self._typing.get(chat_id, {}).items() if expires > now}
+
+    def __len__(self):
+        return len(self._online)
+
+    def _sweep(self, now):
+        # Ленивое удаление: запись удаляется, только если ее срок не продлевали
+        for _ in range(self.sweep_batch):
+            if not self._heap or self._heap[0][0] > now:
+                return
+            expires, key = heapq.heappop(self._heap)
+            if key[0] == 'online':
+                if self._online.get(key[1]) == expires:
+                    del self._online[key[1]]
+            else:
+                typists = self._typing.get(key[1])
+                if typists is not None and typists.get(key[2]) == expires:
+                    del typists[key[2]]
+                    if not typists:
+                        del self._typing[key[1]]
+
+
+class MongoPresenceStore:
+    """
+    Присутствие и набор текста в TTL-коллекциях MongoDB - общие для всех процессов.
+
+    Истекшие документы удаляет фоновый TTL-монитор MongoDB, чтение
+    дополнительно фильтрует по сроку. Как и в памяти, частые heartbeat
+    одного пользователя из процесса не доходят до базы.
+    """
+
+    def __init__(self, database, ttl=None, typing_ttl=None):
+        self.ttl = ttl or getattr(settings, 'PRESENCE_TTL', 60)
+        self.typing_ttl = typing_ttl or getattr(settings, 'TYPING_TTL', 6)
+        self.refresh_after = self.ttl / 3
+
+        self.presence = database['presence']
+        self.typists = database['typing']
+        self.presence.create_index('expires', expireAfterSeconds=0)
+        self.typists.create_index('expires', expireAfterSeconds=0)
+        self.typists.create_index('chat_id')
+
+        self._written = {}  # user_id -> когда этот процесс последний раз записал heartbeat
+        self._lock = threading.Lock()
+
+    def heartbeat(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._written.get(user_id, float('-inf')) < self.refresh_after:
+                return False
+            self._written[user_id] = now
+            if len(self._written) > 100000:
+                self._written.clear()
+
+        now = datetime.utcnow()
+        previous = self.presence.find_one_and_update(
+            {'_id': user_id},
+            {'$set': {'expires': now + timedelta(seconds=self.ttl)}},
+            upsert=True
+        )
+        return previous is None or previous['expires'] <= now
+
+    def go_offline(self, user_id):
+        with self._lock:
+            self._written.pop(user_id, None)
+        self.presence.delete_one({'_id': user_id})
+
+    def online(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        cursor = self.presence.find(
+            {'_id': {'$in': user_ids}, 'expires': {'$gt': datetime.utcnow()}}, {'_id': 1}
+        )
+        return {doc['_id'] for doc in cursor}
+
+    def typing(self, chat_id, user_id):
+        now = datetime.utcnow()
+        previous = self.typists.find_one_and_update(
+            {'_id': f'{chat_id}:{user_id}'},
+            {'$set': {'chat_id': chat_id, 'user_id': user_id,
+                      'expires': now + timedelta(seconds=self.typing_ttl)}},
+            upsert=True
+        )
+        return previous is None or previous['expires'] <= now
+
+    def stop_typing(self, chat_id, user_id):
+        self.typists.delete_one({'_id': f'{chat_id}:{user_id}'})
+
+    def typing_users(self, chat_id):
+        cursor = self.typists.find({'chat_id': chat_id, 'expires': {'$gt': datetime.utcnow()}}, {'user_id': 1})
+        return {doc['user_id'] for doc in cursor}
+
+    def __len__(self):
+        return self.presence.count_documents({'expires': {'$gt': datetime.utcnow()}})
+
+
+def create_presence_store(backend=None, **kwargs):
+    backend = backend or getattr(settings, 'PRESENCE_BACKEND', 'memory')
+    if backend == 'mongo':
+        from utils.mongo_cache import cache
+        return MongoPresenceStore(cache._collection.database, **kwargs)
+    return MemoryPresenceStore(**kwargs)
+
+
+presence = create_presence_store()
+
+
+def get_chat_presence(chat_id):
+    """Кто из участников чата в сети и кто набирает текст: один запрос к БД и одно обращение к хранилищу"""
+    member_ids = list(ChatMember.objects.filter(chat_id=chat_id).values_list('user_id', flat=True))
+    return {
+        'online': sorted(presence.online(member_ids)),
+        'typing': sorted(presence.typing_users(chat_id)),
+    }
@@ -0,0 +1,36 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from . import history
+
+
+def chat_group_name(chat_id):
+    """Группа channel layer, в которую подписаны все подключения чата"""
+    return f'chat_{chat_id}'
+
+
+def serialize_message(message):
+    """Представление сообщения для WebSocket-клиента"""
+    return history.message_json(history.serialize_message(message))
+
+
+def broadcast_message(message):
+    """Разослать новое сообщение подключенным участникам чата"""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    async_to_sync(channel_layer.group_send)(
+        chat_group_name(message.chat_id),
+        {'type': 'chat.message', 'message': serialize_message(message)}
+    )
+
+
+def disconnect_members(chat_id, user_ids):
+    """Закрыть WebSocket-подключения удаленных из чата пользователей"""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    async_to_sync(channel_layer.group_send)(
+        chat_group_name(chat_id),
+        {'type': 'chat.members_removed', 'user_ids': sorted(user_ids)}
+    )
@@ -0,0 +1,97 @@
+import re
+
+from django.db import connection
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from utils.fts import parse_query, prefix_query
+from .models import Message
+
+
+SEARCH_PAGE_SIZE = 20
+SNIPPET_TOKENS = 16
+
+# Служебные символы-маркеры подсветки: не встречаются в тексте и переживают экранирование HTML
+_MARK_START, _MARK_END = '\x02', '\x03'
+
+
+def highlight(snippet):
+    """Экранированный HTML фрагмента с найденными словами в <mark>"""
+    html = escape(snippet).replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+    return mark_safe(html)
+
+
+def search_messages(user, query, before=None, chat_id=None, limit=SEARCH_PAGE_SIZE):
+    """
+    Поиск по сообщениям чатов, в которых состоит пользователь.
+
+    Результаты идут от новых к старым, курсор before - id последнего
+    показанного сообщения. Возвращает {'results', 'has_more', 'next_cursor'},
+    каждый результат - сообщение с атрибутом snippet (HTML с подсветкой).
+    """
+    tokens = parse_query(query)
+    if not tokens:
+        return {'results': [], 'has_more': False, 'next_cursor': None}
+
+    if connection.vendor == 'sqlite':
+        rows = _search_fts(user.id, tokens, before, chat_id, limit + 1)
+    else:
+        rows = _search_scan(user.id, tokens, before, chat_id, limit + 1)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    messages = Message.objects.select_related('author', 'chat').in_bulk([message_id for message_id, _ in rows])
+    results = []
+    for message_id, snippet in rows:
+        message = messages.get(message_id)
+        if message is not None:
+            message.snippet = highlight(snippet)
+            results.append(message)
+
+    return {
+        'results': results,
+        'has_more': has_more,
+        'next_cursor': rows[-1][0] if has_more else None,
+    }
+
+
+def _search_fts(user_id, tokens, before, chat_id, limit):
+    """Поиск по индексу FTS5: совпадения перебираются от новых rowid к старым с фильтром по членству"""
+    sql = f"""
+        SELECT m.id, snippet(chats_message_fts, 0, %s, %s, '…', {SNIPPET_TOKENS})
+        FROM chats_message_fts
+        JOIN chats_message m ON m.id = chats_message_fts.rowid
+        JOIN chats_chatmember cm ON cm.chat_id = m.chat_id AND cm.user_id = %s
+        WHERE chats_message_fts MATCH %s
+    """
+    params = [_MARK_START, _MARK_END, user_id, prefix_query(tokens)]
+    if before is not None:
+        sql += ' AND chats_message_fts.rowid < %s'
+        params.append(before)
+    if chat_id is not None:
+        sql += ' AND m.chat_id = %s'
+        params.append(chat_id)
+    sql += ' ORDER BY chats_message_fts.rowid DESC LIMIT %s'
+    params.append(limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def _search_scan(user_id, tokens, before, chat_id, limit):
+    """Подстрочный поиск по тексту сообщений, новые первыми; совпадения подсвечиваются в Python"""
+    messages = Message.objects.filter(chat__chatmember__user_id=user_id)
+    for token in tokens:
+        messages = messages.filter(content__icontains=token)
+    if before is not None:
+        messages = messages.filter(id__lt=before)
+    if chat_id is not None:
+        messages = messages.filter(chat_id=chat_id)
+
+    pattern = re.compile('|'.join(re.escape(token) for token in tokens), re.IGNORECASE)
+    return [
+        (message_id, pattern.sub(lambda match: f'{_MARK_START}{match.group(0)}{_MARK_END}', content))
+        for message_id, content in messages.order_by('-id').values_list('id', 'content')[:limit]
+    ]
@@ -0,0 +1,110 @@
+import hashlib
+
+from .history import message_json, serialize_message
+from .models import ChatMember, Message
+
+
+# Сколько новых сообщений отдается за один ответ; остальное - следующим запросом
+SYNC_LIMIT = 200
+
+
+class SyncState:
+    """
+    Снимок состояния чатов пользователя для дельта-синхронизации.
+
+    Строится одним запросом по ChatMember. Токен состоит из последнего
+    id сообщения и хэша членства и водяных знаков прочтения, он же служит
+    ETag: пока в чатах ничего не изменилось, токен тот же, и клиент
+    получает 304 без тела.
+    """
+
+    def __init__(self, user, chat_id=None):
+        self.user = user
+        members = ChatMember.objects.filter(user=user)
+        if chat_id is not None:
+            members = members.filter(chat_id=chat_id)
+        self.rows = {
+            chat_id: (last_read_id, last_id)
+            for chat_id, last_read_id, last_id in members.with_latest_message_id()
+            .order_by('chat_id').values_list('chat_id', 'last_read_message_id', 'last_id')
+        }
+        self.max_message_id = max((last_id for _, last_id in self.rows.values()), default=0)
+
+        digest = hashlib.sha1(repr(sorted(
+            (chat_id, last_read_id) for chat_id, (last_read_id, _) in self.rows.items()
+        )).encode()).hexdigest()[:16]
+        self.digest = digest
+        self.token = f'{self.max_message_id}-{digest}'
+
+    def delta(self, since_token=None, last_id=None, limit=SYNC_LIMIT):
+        """
+        Изменения с момента since_token: новые сообщения, членство и непрочитанные.
+
+        Вместо токена можно передать last_id - id последнего сообщения,
+        которое видел клиент (без отслеживания изменений членства).
+        """
+        since_id, since_digest = parse_token(since_token)
+        if since_id is None and last_id is not None:
+            since_id, since_digest = last_id, self.digest
+
+        if since_id is None:
+            # Первая синхронизация: сообщения клиент уже получил со страницей чата
+            messages, has_more = [], False
+        else:
+            changed = [chat_id for chat_id, (_, chat_last_id) in self.rows.items() if chat_last_id > since_id]
+            messages, has_more = self._messages_after(changed, since_id, limit)
+
+        token = self.token
+        if has_more:
+            # Отдан не весь хвост: следующий запрос продолжит с последнего выданного сообщения
+            token = f"{messages[-1]['id']}-{since_digest}"
+
+        membership_changed = since_digest != self.digest
+        if membership_changed:
+            chat_ids = list(self.rows)
+        else:
+            chat_ids = sorted({message['chat_id'] for message in messages})
+
+        delta = {
+            'token': token,
+            'messages': messages,
+            'has_more': has_more,
+            'chats': self._chat_states(chat_ids),
+        }
+        if membership_changed:
+            # Полный список чатов, чтобы клиент увидел и вступления, и выходы
+            delta['chat_ids'] = list(self.rows)
+        return delta
+
+    def _messages_after(self, chat_ids, since_id, limit):
+        if not chat_ids:
+            return [], False
+        messages = list(
+            Message.objects.filter(chat_id__in=chat_ids, id__gt=since_id)
+            .select_related('author').order_by('id')[:limit + 1]
+        )
+        has_more = len(messages) > limit
+        return [message_json(serialize_message(message)) for message in messages[:limit]], has_more
+
+    def _chat_states(self, chat_ids):
+        if not chat_ids:
+            return []
+        members = ChatMember.objects.filter(user=self.user, chat_id__in=chat_ids).with_unread().order_by('chat_id')
+        return [
+            {
+                'id': chat_id,
+                'unread': unread,
+                'last_read_message_id': last_read_id,
+                'last_message_id': self.rows[chat_id][1],
+            }
+            for chat_id, last_read_id, unread in members.values_list('chat_id', 'last_read_message_id', 'unread')
+        ]
+
+
+def parse_token(token):
+    """(id последнего сообщения, хэш состояния) из токена или (None, None)"""
+    try:
+        max_id, digest = (token or '').split('-', 1)
+        return int(max_id), digest
+    except ValueError:
+        return None, None
@@ -1,3 +1,778 @@
-from django.test import TestCase
+from importlib import import_module
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.apps import apps
+from django.core.management import call_command
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models import Count
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from users.models import User
+from utils.mongo_cache import MongoCacheHelper, cache
+from utils.query_plan import QueryPlanAssertionsMixin
+from .history import HISTORY_WINDOW, append_message, get_messages_before, get_recent_messages
+from .membership import add_members, remove_members
+from .models import Chat, ChatMember, Message
+from .routing import websocket_urlpatterns
+from .presence import MemoryPresenceStore, get_chat_presence
+from .search import search_messages
+from .sync import SyncState
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN доступен только в SQLite')
+class ChatQueryPlanTests(QueryPlanAssertionsMixin, TestCase):
+    """Горячие запросы списка чатов и непрочитанных не должны сканировать таблицы целиком"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='alice', password='password')
+        cls.other = User.objects.create_user(username='bob', password='password')
+        cls.chat = Chat.objects.create(chat_type='group', name='Lab', created_by=cls.user)
+        ChatMember.objects.create(user=cls.user, chat=cls.chat, role='admin')
+        ChatMember.objects.create(user=cls.other, chat=cls.chat)
+        Message.objects.create(chat=cls.chat, author=cls.other, content='Hello')
+
+    def test_chat_list(self):
+        chats = Chat.objects.filter(members=self.user).order_by('-updated_at')
+        self.assertNoFullScan(chats)
+
+    def test_unread_per_membership(self):
+        self.assertNoFullScan(ChatMember.objects.filter(user=self.user).with_unread())
+
+    def test_unread_count(self):
+        member = ChatMember.objects.get(chat=self.chat, user=self.user)
+        unread = Message.objects.filter(chat=self.chat, created_at__gt=member.last_read)
+        self.assertNoFullScan(unread)
+        self.assertUsesIndex(unread, 'message_chat_created_idx')
+
+    def test_unread_counts_for_all_chats(self):
+        unread = Message.objects.filter(
+            chat__chatmember__user=self.user,
+            created_at__gt=models.F('chat__chatmember__last_read')
+        ).values('chat').annotate(unread=Count('id'))
+        self.assertNoFullScan(unread)
+        self.assertUsesIndex(unread, 'chatmember_user_read_idx')
+
+    def test_chat_membership(self):
+        self.assertNoFullScan(ChatMember.objects.filter(chat=self.chat, user=self.user))
+
+
+class ChatConsumerTests(TransactionTestCase):
+    """Доставка сообщений по WebSocket через InMemoryChannelLayer"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='password')
+        self.bob = User.objects.create_user(username='bob', password='password')
+        self.outsider = User.objects.create_user(username='eve', password='password')
+        self.chat = Chat.objects.create(chat_type='group', name='Lab', created_by=self.alice)
+        ChatMember.objects.create(user=self.alice, chat=self.chat, role='admin')
+        ChatMember.objects.create(user=self.bob, chat=self.chat)
+        # Свежее хранилище присутствия на каждый тест
+        self.presence = MemoryPresenceStore()
+        patcher = mock.patch('chats.consumers.presence', self.presence)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def communicator(self, user, query=''):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/chats/{self.chat.id}/{query}')
+        communicator.scope['user'] = user
+        return communicator
+
+    async def receive(self, communicator, skip_presence=True):
+        message = await communicator.receive_json_from()
+        while skip_presence and message['type'] == 'presence':
+            message = await communicator.receive_json_from()
+        return message
+
+    async def test_message_is_broadcast_to_members(self):
+        alice = self.communicator(self.alice)
+        bob = self.communicator(self.bob)
+        self.assertTrue((await alice.connect())[0])
+        self.assertTrue((await bob.connect())[0])
+
+        await alice.send_json_to({'type': 'message', 'content': 'Hello', 'client_id': 'c1'})
+
+        ack = await self.receive(alice)
+        self.assertEqual((ack['type'], ack['client_id']), ('ack', 'c1'))
+        received = await self.receive(bob)
+        self.assertEqual(received['type'], 'message')
+        self.assertEqual(received['message']['content'], 'Hello')
+        self.assertEqual(received['message']['id'], ack['id'])
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_non_member_is_rejected(self):
+        connected, code = await self.communicator(self.outsider).connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4403)
+
+    async def test_removed_member_is_disconnected(self):
+        alice = self.communicator(self.alice)
+        bob = self.communicator(self.bob)
+        await alice.connect()
+        await bob.connect()
+
+        with mock.patch('chats.membership.MongoCacheHelper'):
+            await database_sync_to_async(remove_members)(self.chat, [self.bob.id])
+
+        closed = await bob.receive_output()
+        while closed['type'] != 'websocket.close':
+            closed = await bob.receive_output()
+        self.assertEqual(closed['code'], 4403)
+
+        # Оставшиеся участники продолжают получать сообщения
+        await alice.send_json_to({'type': 'message', 'content': 'Still here', 'client_id': 'c1'})
+        self.assertEqual((await self.receive(alice))['type'], 'ack')
+        await alice.disconnect()
+
+    async def test_resume_sends_missed_messages(self):
+        first = await Message.objects.acreate(chat=self.chat, author=self.alice, content='seen')
+        await Message.objects.acreate(chat=self.chat, author=self.alice, content='missed')
+
+        bob = self.communicator(self.bob, f'?last_id={first.id}')
+        await bob.connect()
+        resume = await self.receive(bob)
+        self.assertEqual(resume['type'], 'resume')
+        self.assertEqual([m['content'] for m in resume['messages']], ['missed'])
+        self.assertFalse(resume['has_more'])
+        await bob.disconnect()
+
+    async def test_read_event_moves_watermark_and_notifies_members(self):
+        message = await Message.objects.acreate(chat=self.chat, author=self.alice, content='ping')
+        alice = self.communicator(self.alice)
+        bob = self.communicator(self.bob)
+        await alice.connect()
+        await bob.connect()
+
+        await bob.send_json_to({'type': 'read', 'message_id': message.id})
+        receipt = await self.receive(alice)
+        self.assertEqual(receipt, {'type': 'read', 'user_id': self.bob.id, 'message_id': message.id})
+
+        # Повторная отметка водяной знак не сдвигает и не рассылается
+        await bob.send_json_to({'type': 'read', 'message_id': message.id})
+        self.assertTrue(await alice.receive_nothing())
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_typing_is_relayed_to_other_members(self):
+        alice = self.communicator(self.alice)
+        bob = self.communicator(self.bob)
+        await alice.connect()
+        await bob.connect()
+        # Уведомление о появлении Боба в сети
+        self.assertEqual(await self.receive(alice, skip_presence=False),
+                         {'type': 'presence', 'user_id': self.bob.id, 'online': True})
+
+        await bob.send_json_to({'type': 'typing'})
+        self.assertEqual(await self.receive(alice), {'type': 'typing', 'user_id': self.bob.id})
+        self.assertTrue(await bob.receive_nothing())
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_disconnect_takes_member_offline(self):
+        alice = self.communicator(self.alice)
+        bob = self.communicator(self.bob)
+        await alice.connect()
+        await bob.connect()
+        self.assertEqual(await self.receive(alice, skip_presence=False),
+                         {'type': 'presence', 'user_id': self.bob.id, 'online': True})
+
+        await bob.disconnect()
+        self.assertEqual(await self.receive(alice, skip_presence=False),
+                         {'type': 'presence', 'user_id': self.bob.id, 'online': False})
+        self.assertEqual(self.presence.online([self.alice.id, self.bob.id]), {self.alice.id})
+        await alice.disconnect()
+
+
+class ChatHistoryTests(TestCase):
+    """Окно последних сообщений и подгрузка истории по курсору"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='reader', password='password')
+        self.chat = Chat.objects.create(chat_type='group', name='History', created_by=self.user)
+        ChatMember.objects.create(user=self.user, chat=self.chat)
+        self.messages = [
+            Message.objects.create(chat=self.chat, author=self.user, content=f'message {i}')
+            for i in range(HISTORY_WINDOW + 5)
+        ]
+
+    @mock.patch('chats.history.MongoCacheHelper')
+    def test_recent_window_is_bounded_and_cached(self, helper):
+        helper.get_cached_chat_messages.return_value = None
+
+        window = get_recent_messages(self.chat.id)
+
+        self.assertEqual(len(window['messages']), HISTORY_WINDOW)
+        self.assertTrue(window['has_more'])
+        self.assertEqual(window['messages'][-1]['id'], self.messages[-1].id)
+        self.assertEqual(window['messages'][0]['id'], self.messages[5].id)
+        helper.cache_chat_messages.assert_called_once_with(self.chat.id, window)
+
+    @mock.patch('chats.history.MongoCacheHelper')
+    def test_cached_window_skips_database(self, helper):
+        cached = {'messages': [], 'has_more': False}
+        helper.get_cached_chat_messages.return_value = cached
+
+        with self.assertNumQueries(0):
+            self.assertIs(get_recent_messages(self.chat.id), cached)
+
+    def test_pages_before_cursor_cover_history_once(self):
+        page = get_messages_before(self.chat.id, self.messages[5].id, limit=3)
+        self.assertEqual([m['id'] for m in page['messages']], [m.id for m in self.messages[2:5]])
+        self.assertTrue(page['has_more'])
+
+        page = get_messages_before(self.chat.id, page['messages'][0]['id'], limit=3)
+        self.assertEqual([m['id'] for m in page['messages']], [m.id for m in self.messages[:2]])
+        self.assertFalse(page['has_more'])
+
+    def test_history_endpoint_requires_membership(self):
+        outsider = User.objects.create_user(username='outsider', password='password')
+        self.client.force_login(outsider)
+        url = reverse('chats:chat_history', args=[self.chat.id])
+        response = self.client.get(url, {'before': self.messages[-1].id})
+        self.assertEqual(response.status_code, 404)
+
+    def test_history_endpoint_returns_cursor(self):
+        self.client.force_login(self.user)
+        url = reverse('chats:chat_history', args=[self.chat.id])
+        response = self.client.get(url, {'before': self.messages[5].id})
+        data = response.json()
+        self.assertEqual(data['next_cursor'], self.messages[0].id)
+        self.assertFalse(data['has_more'])
+        self.assertEqual(len(data['messages']), 5)
+        self.assertEqual(self.client.get(url, {'before': 'x'}).status_code, 400)
+
+
+class ReadWatermarkTests(TestCase):
+    """Отметки о прочтении через водяной знак участника"""
+
+    def setUp(self):
+        self.author = User.objects.create_user(username='author', password='password')
+        self.reader = User.objects.create_user(username='reader', password='password')
+        self.chat = Chat.objects.create(chat_type='group', name='Receipts', created_by=self.author)
+        ChatMember.objects.create(user=self.author, chat=self.chat)
+        ChatMember.objects.create(user=self.reader, chat=self.chat)
+        self.messages = [
+            Message.objects.create(chat=self.chat, author=self.author, content=f'message {i}')
+            for i in range(30)
+        ]
+
+    def test_watermark_only_moves_forward(self):
+        self.assertTrue(ChatMember.mark_read(self.chat.id, self.reader.id, self.messages[10].id))
+        self.assertFalse(ChatMember.mark_read(self.chat.id, self.reader.id, self.messages[5].id))
+        member = ChatMember.objects.get(chat=self.chat, user=self.reader)
+        self.assertEqual(member.last_read_message_id, self.messages[10].id)
+
+    def test_read_up_to_other_members(self):
+        ChatMember.mark_read(self.chat.id, self.reader.id, self.messages[10].id)
+        self.assertEqual(ChatMember.read_up_to(self.chat.id, exclude_user_id=self.author.id), self.messages[10].id)
+
+    @mock.patch('chats.history.MongoCacheHelper')
+    def test_opening_chat_costs_single_write(self, helper):
+        helper.get_cached_chat_messages.return_value = None
+        self.client.force_login(self.reader)
+        url = reverse('chats:chat_detail', args=[self.chat.id])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        writes = [q['sql'] for q in queries.captured_queries if q['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))]
+        # Сессия не меняется, поэтому единственная запись - сдвиг водяного знака
+        self.assertEqual(len(writes), 1)
+        self.assertIn('last_read_message_id', writes[0])
+        member = ChatMember.objects.get(chat=self.chat, user=self.reader)
+        self.assertEqual(member.last_read_message_id, self.messages[-1].id)
+
+
+class ChatTailCacheTests(TestCase):
+    """Дописывание новых сообщений в кэшированное окно чата"""
+
+    def setUp(self):
+        # Отдельная база MongoDB, чтобы не задеть кэш рабочего приложения
+        self.database = cache._collection.database.client['axon_horizon_test']
+        patcher = mock.patch.object(cache, '_collection', self.database['django_cache'])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.database.client.drop_database, self.database.name)
+
+        self.user = User.objects.create_user(username='writer', password='password')
+        self.chat = Chat.objects.create(chat_type='group', name='Tail', created_by=self.user)
+
+    def send(self, content):
+        message = Message.objects.create(chat=self.chat, author=self.user, content=content)
+        return message, append_message(message)
+
+    def test_new_messages_are_appended_without_database_reads(self):
+        self.send('first')
+        get_recent_messages(self.chat.id)
+
+        for i in range(HISTORY_WINDOW + 1):
+            _, appended = self.send(f'message {i}')
+            self.assertTrue(appended)
+
+        with self.assertNumQueries(0):
+            window = get_recent_messages(self.chat.id)
+        self.assertEqual(len(window['messages']), HISTORY_WINDOW)
+        self.assertTrue(window['has_more'])
+        self.assertEqual(window['messages'][-1]['content'], f'message {HISTORY_WINDOW}')
+        self.assertTrue(timezone.is_aware(window['messages'][-1]['created_at']))
+
+    def test_append_reads_previous_message_from_chat_summary(self):
+        self.send('first')
+        get_recent_messages(self.chat.id)
+
+        message = Message.objects.create(chat=self.chat, author=self.user, content='second')
+        with self.assertNumQueries(0):
+            self.assertTrue(append_message(message))
+
+        # Без загруженной строки чата предыдущее сообщение неизвестно: окно пересобирается
+        message = Message.objects.create(chat_id=self.chat.id, author=self.user, content='third')
+        self.assertIsNone(message.previous_message_id)
+        self.assertFalse(append_message(message))
+        self.assertIsNone(MongoCacheHelper.get_cached_chat_messages(self.chat.id))
+
+    def test_stale_chat_summary_is_not_confirmed(self):
+        self.send('first')
+        stale = Chat.objects.get(id=self.chat.id)
+        self.send('second')
+
+        late = Message.objects.create(chat=stale, author=self.user, content='third')
+        self.assertIsNone(late.previous_message_id)
+        self.chat.refresh_from_db()
+        self.assertEqual((self.chat.message_count, self.chat.last_message_id), (3, late.id))
+
+    def test_gap_forces_rebuild_from_database(self):
+        get_recent_messages(self.chat.id)
+        missed = Message.objects.create(chat=self.chat, author=self.user, content='missed')
+        _, appended = self.send('after gap')
+        self.assertFalse(appended)
+
+        with self.assertNumQueries(1):
+            window = get_recent_messages(self.chat.id)
+        self.assertEqual([m['content'] for m in window['messages']], ['missed', 'after gap'])
+        self.assertEqual(window['messages'][0]['id'], missed.id)
+
+    def test_stale_window_does_not_overwrite_newer_version(self):
+        stale = {'messages': [], 'has_more': False}
+        self.send('newer')
+        MongoCacheHelper.cache_chat_messages(self.chat.id, stale)
+        self.assertIsNone(MongoCacheHelper.get_cached_chat_messages(self.chat.id))
+
+
+class PersonalChatPairTests(QueryPlanAssertionsMixin, TestCase):
+    """Личный чат по канонической паре участников"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='password')
+        self.bob = User.objects.create_user(username='bob', password='password')
+
+    def test_get_or_create_is_idempotent_in_both_directions(self):
+        chat, created = Chat.get_or_create_personal(self.alice, self.bob)
+        self.assertTrue(created)
+        self.assertEqual(set(chat.members.values_list('id', flat=True)), {self.alice.id, self.bob.id})
+
+        with self.assertNumQueries(1):
+            again, created = Chat.get_or_create_personal(self.bob, self.alice)
+        self.assertFalse(created)
+        self.assertEqual(again, chat)
+
+    def test_duplicate_pair_is_rejected_by_index(self):
+        Chat.get_or_create_personal(self.alice, self.bob)
+        low, high = Chat.personal_pair(self.alice.id, self.bob.id)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Chat.objects.create(chat_type='personal', created_by=self.bob, member_low_id=low, member_high_id=high)
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN доступен только в SQLite')
+    def test_lookup_uses_pair_index(self):
+        lookup = Chat.objects.filter(chat_type='personal', member_low_id=1, member_high_id=2)
+        self.assertUsesIndex(lookup, 'chat_personal_pair_uniq')
+
+    def test_backfill_fills_pairs_and_merges_duplicates(self):
+        chats = []
+        for _ in range(2):
+            chat = Chat.objects.create(chat_type='personal', created_by=self.alice)
+            ChatMember.objects.create(user=self.alice, chat=chat)
+            ChatMember.objects.create(user=self.bob, chat=chat)
+            Message.objects.create(chat=chat, author=self.alice, content='hi')
+            chats.append(chat)
+
+        with mock.patch('chats.management.commands.backfill_personal_chats.MongoCacheHelper'):
+            call_command('backfill_personal_chats', '--merge-duplicates', stdout=StringIO())
+
+        canonical, = Chat.objects.filter(chat_type='personal')
+        self.assertEqual(canonical.id, chats[0].id)
+        self.assertEqual(Chat.personal_pair(self.alice.id, self.bob.id),
+                         (canonical.member_low_id, canonical.member_high_id))
+        self.assertEqual(canonical.messages.count(), 2)
+        self.assertEqual(Chat.get_or_create_personal(self.bob, self.alice), (canonical, False))
+
+    def personal_chat_without_pair(self):
+        chat = Chat.objects.create(chat_type='personal', created_by=self.alice)
+        ChatMember.objects.create(user=self.alice, chat=chat)
+        ChatMember.objects.create(user=self.bob, chat=chat)
+        return chat
+
+    def test_chat_without_pair_is_found_by_members(self):
+        old = self.personal_chat_without_pair()
+
+        chat, created = Chat.get_or_create_personal(self.bob, self.alice)
+        self.assertFalse(created)
+        self.assertEqual(chat, old)
+        self.assertEqual(Chat.objects.filter(chat_type='personal').count(), 1)
+        # Пара закреплена: следующий поиск идет по индексу
+        with self.assertNumQueries(1):
+            self.assertEqual(Chat.get_or_create_personal(self.alice, self.bob), (old, False))
+
+    def test_migration_backfills_pairs(self):
+        backfill = import_module('chats.migrations.0009_backfill_personal_pair').backfill_personal_pair
+        old, duplicate = self.personal_chat_without_pair(), self.personal_chat_without_pair()
+
+        backfill(apps, None)
+
+        old.refresh_from_db()
+        duplicate.refresh_from_db()
+        self.assertEqual((old.member_low_id, old.member_high_id), Chat.personal_pair(self.alice.id, self.bob.id))
+        self.assertEqual({old.member_low_name, old.member_high_name}, {'alice', 'bob'})
+        self.assertIsNone(duplicate.member_low_id)
+
+
+class MessageSearchTests(TestCase):
+    """Полнотекстовый поиск по сообщениям чатов пользователя"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='password')
+        self.bob = User.objects.create_user(username='bob', password='password')
+        self.lab = Chat.objects.create(chat_type='group', name='Lab', created_by=self.alice)
+        self.private = Chat.objects.create(chat_type='group', name='Private', created_by=self.bob)
+        ChatMember.objects.create(user=self.alice, chat=self.lab)
+        ChatMember.objects.create(user=self.bob, chat=self.lab)
+        ChatMember.objects.create(user=self.bob, chat=self.private)
+
+    def post(self, chat, content):
+        return Message.objects.create(chat=chat, author=self.bob, content=content)
+
+    def test_results_are_limited_to_member_chats(self):
+        visible = self.post(self.lab, 'Черновик статьи готов')
+        self.post(self.private, 'Черновик статьи для другого журнала')
+
+        page = search_messages(self.alice, 'статьи')
+        self.assertEqual([message.id for message in page['results']], [visible.id])
+        self.assertEqual(page['results'][0].snippet, 'Черновик <mark>статьи</mark> готов')
+
+    def test_prefix_matching_and_html_escaping(self):
+        self.post(self.lab, '<b>Статьей</b> займемся завтра')
+        snippet = search_messages(self.alice, 'СТАТЬ')['results'][0].snippet
+        self.assertEqual(snippet, '&lt;b&gt;<mark>Статьей</mark>&lt;/b&gt; займемся завтра')
+
+    def test_index_follows_edits_and_deletes(self):
+        message = self.post(self.lab, 'grant report')
+        message.content = 'grant proposal'
+        message.save()
+        self.assertEqual(search_messages(self.alice, 'report')['results'], [])
+        self.assertEqual(len(search_messages(self.alice, 'proposal')['results']), 1)
+        message.delete()
+        self.assertEqual(search_messages(self.alice, 'proposal')['results'], [])
+
+    def test_cursor_pagination_from_newest(self):
+        messages = [self.post(self.lab, f'dataset version {i}') for i in range(5)]
+
+        page = search_messages(self.alice, 'dataset', limit=3)
+        self.assertEqual([m.id for m in page['results']], [m.id for m in reversed(messages[2:])])
+        self.assertTrue(page['has_more'])
+
+        page = search_messages(self.alice, 'dataset', before=page['next_cursor'], limit=3)
+        self.assertEqual([m.id for m in page['results']], [m.id for m in reversed(messages[:2])])
+        self.assertFalse(page['has_more'])
+
+    def test_query_syntax_is_not_passed_to_index(self):
+        self.post(self.lab, 'NEAR OR AND')
+        self.assertEqual(len(search_messages(self.alice, 'near" OR (and*')['results']), 1)
+        self.assertEqual(search_messages(self.alice, '"*()')['results'], [])
+
+    def test_search_page_within_chat(self):
+        self.post(self.lab, 'microscope booking')
+        self.client.force_login(self.alice)
+        url = reverse('chats:message_search')
+        response = self.client.get(url, {'q': 'microscope', 'chat': self.lab.id})
+        self.assertContains(response, '<mark>microscope</mark>')
+        self.assertEqual(self.client.get(url, {'q': 'x', 'chat': self.private.id}).status_code, 404)
+
+
+class ChatSummaryTests(TestCase):
+    """Сводка чата для списка: последнее сообщение, счетчики, имена собеседников"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='password', first_name='Alice', last_name='Smith')
+        self.bob = User.objects.create_user(username='bob', password='password')
+        self.chat = Chat.objects.create(chat_type='group', name='Lab', created_by=self.alice)
+        ChatMember.objects.create(user=self.alice, chat=self.chat)
+        ChatMember.objects.create(user=self.bob, chat=self.chat)
+
+    def test_summary_follows_messages(self):
+        first = Message.objects.create(chat=self.chat, author=self.alice, content='first')
+        last = Message.objects.create(chat=self.chat, author=self.bob, content='  multi\n line  ')
+        self.chat.refresh_from_db()
+        self.assertEqual((self.chat.member_count, self.chat.message_count), (2, 2))
+        self.assertEqual(self.chat.last_message_id, last.id)
+        self.assertEqual(self.chat.last_message_preview, 'multi line')
+        self.assertEqual(self.chat.last_message_author_name, 'bob')
+
+        # Запоздавшее сообщение не затирает более новое
+        Chat.record_message(first)
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.last_message_id, last.id)
+
+        last.delete()
+        self.chat.refresh_from_db()
+        self.assertEqual((self.chat.message_count, self.chat.last_message_id), (1, first.id))
+        self.assertEqual(self.chat.last_message_author_name, 'Alice Smith')
+
+    def test_member_count_follows_membership(self):
+        ChatMember.objects.get(chat=self.chat, user=self.bob).delete()
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.member_count, 1)
+
+    def test_personal_chat_name_depends_on_viewer(self):
+        chat, _ = Chat.get_or_create_personal(self.alice, self.bob)
+        self.assertEqual(chat.display_name_for(self.alice.id), 'Чат с bob')
+        self.assertEqual(chat.display_name_for(self.bob.id), 'Чат с Alice Smith')
+
+        self.bob.first_name = 'Robert'
+        self.bob.save()
+        Chat.refresh_member_names(self.bob)
+        chat.refresh_from_db()
+        self.assertEqual(chat.member_count, 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(str(chat), 'Чат с Robert')
+
+    @mock.patch('chats.views.MongoCacheHelper')
+    def test_chat_list_query_count_does_not_grow_with_chats(self, helper):
+        helper.get_cached_chat_list.return_value = None
+        for i in range(5):
+            chat = Chat.objects.create(chat_type='group', name=f'Group {i}', created_by=self.bob)
+            ChatMember.objects.create(user=self.alice, chat=chat)
+            Message.objects.create(chat=chat, author=self.bob, content='hi')
+        self.client.force_login(self.alice)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('chats:chat_list'))
+        chat_queries = [q['sql'] for q in queries.captured_queries if 'chats_' in q['sql']]
+        # Чаты, непрочитанные для списка и счетчик непрочитанных в шапке
+        self.assertEqual(len(chat_queries), 3)
+        self.assertContains(response, 'Group 4')
+
+
+class ChatSyncTests(TestCase):
+    """Дельта-синхронизация чатов с условными запросами"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='password')
+        self.bob = User.objects.create_user(username='bob', password='password')
+        self.lab = Chat.objects.create(chat_type='group', name='Lab', created_by=self.alice)
+        self.quiet = Chat.objects.create(chat_type='group', name='Quiet', created_by=self.alice)
+        for chat in (self.lab, self.quiet):
+            ChatMember.objects.create(user=self.alice, chat=chat)
+            ChatMember.objects.create(user=self.bob, chat=chat)
+        Message.objects.create(chat=self.lab, author=self.bob, content='old')
+        self.client.force_login(self.alice)
+        self.url = reverse('chats:chat_sync')
+
+    def test_idle_client_gets_not_modified(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json()['messages'], [])
+        self.assertEqual(first.json()['chat_ids'], [self.lab.id, self.quiet.id])
+
+        again = self.client.get(self.url, {'token': first.json()['token']}, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.content, b'')
+
+    def test_delta_contains_only_new_messages_and_changed_chats(self):
+        token = self.client.get(self.url).json()['token']
+        new = Message.objects.create(chat=self.lab, author=self.bob, content='new')
+        Message.objects.create(chat=self.lab, author=self.alice, content='mine')
+
+        data = self.client.get(self.url, {'token': token}).json()
+        self.assertEqual([m['content'] for m in data['messages']], ['new', 'mine'])
+        self.assertNotIn('chat_ids', data)
+        lab, = data['chats']
+        self.assertEqual(lab['id'], self.lab.id)
+        # Свои сообщения непрочитанными не считаются
+        self.assertEqual(lab['unread'], 2)
+
+        ChatMember.mark_read(self.lab.id, self.alice.id, new.id)
+        data = self.client.get(self.url, {'token': data['token']}).json()
+        self.assertEqual(data['messages'], [])
+        self.assertEqual(data['chat_ids'], [self.lab.id, self.quiet.id])
+        self.assertEqual({c['id']: c['unread'] for c in data['chats']}, {self.lab.id: 0, self.quiet.id: 0})
+
+    def test_membership_change_is_reported(self):
+        token = self.client.get(self.url).json()['token']
+        ChatMember.objects.filter(chat=self.quiet, user=self.alice).delete()
+
+        data = self.client.get(self.url, {'token': token}).json()
+        self.assertEqual(data['chat_ids'], [self.lab.id])
+
+    def test_truncated_delta_continues_from_last_message(self):
+        token = self.client.get(self.url).json()['token']
+        messages = [Message.objects.create(chat=self.quiet, author=self.bob, content=str(i)) for i in range(3)]
+
+        state = SyncState(self.alice)
+        data = state.delta(token, limit=2)
+        self.assertTrue(data['has_more'])
+        data = SyncState(self.alice).delta(data['token'], limit=2)
+        self.assertEqual([m['id'] for m in data['messages']], [messages[2].id])
+        self.assertFalse(data['has_more'])
+
+    def test_chat_endpoint_accepts_last_id_and_checks_membership(self):
+        outsider = User.objects.create_user(username='eve', password='password')
+        last = Message.objects.create(chat=self.lab, author=self.bob, content='latest')
+        url = reverse('chats:chat_sync', args=[self.lab.id])
+
+        data = self.client.get(url, {'last_id': last.id - 1}).json()
+        self.assertEqual([m['id'] for m in data['messages']], [last.id])
+
+        self.client.force_login(outsider)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class BulkMembershipTests(TestCase):
+    """Массовое добавление и удаление участников чата"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username='teacher', password='password')
+        User.objects.bulk_create([User(username=f'student{i}') for i in range(300)])
+        cls.students = list(User.objects.filter(username__startswith='student').values_list('id', flat=True))
+
+    def setUp(self):
+        self.chat = Chat.objects.create(chat_type='group', name='Course', created_by=self.owner)
+        ChatMember.objects.create(user=self.owner, chat=self.chat, role='admin')
+
+    @mock.patch('chats.membership.MongoCacheHelper')
+    def test_add_is_idempotent_and_batches_invalidation(self, helper):
+        with self.captureOnCommitCallbacks(execute=True):
+            added = add_members(self.chat, self.students[:10] + ['junk', self.owner.id, 10 ** 9])
+        self.assertEqual(len(added), 10)
+        helper.invalidate_chat_lists.assert_called_once()
+        self.assertEqual(sorted(helper.invalidate_chat_lists.call_args[0][0]), sorted(self.students[:10]))
+
+        self.assertEqual(add_members(self.chat, self.students[:10]), [])
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.member_count, 11)
+
+    @mock.patch('chats.membership.MongoCacheHelper')
+    def test_joining_existing_chat_starts_with_no_unread(self, helper):
+        for number in range(5):
+            Message.objects.create(chat=self.chat, author=self.owner, content=str(number))
+        newcomer, late = User.objects.filter(id__in=self.students[:2]).order_by('id')
+        add_members(self.chat, [newcomer.id])
+        ChatMember.objects.create(user=late, chat=self.chat)
+
+        for user in (newcomer, late):
+            self.assertEqual(ChatMember.objects.filter(user=user).with_unread().get().unread, 0)
+            self.assertEqual(user.get_unread_chats_count(), 0)
+        Message.objects.create(chat=self.chat, author=self.owner, content='new')
+        self.assertEqual(ChatMember.objects.filter(user=newcomer).with_unread().get().unread, 1)
+
+    @mock.patch('chats.membership.MongoCacheHelper')
+    def test_remove_members(self, helper):
+        add_members(self.chat, self.students[:10])
+        self.assertEqual(remove_members(self.chat, self.students[:5] + [10 ** 9]), 5)
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.member_count, 6)
+
+    @mock.patch('chats.membership.MongoCacheHelper')
+    @mock.patch('chats.views.MongoCacheHelper')
+    def test_course_chat_takes_constant_queries(self, *helpers):
+        self.client.force_login(self.owner)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('chats:create_chat'), {'name': 'Big course', 'users': self.students})
+        self.assertEqual(response.status_code, 302)
+        self.assertLess(len(queries), 20)
+
+        chat = Chat.objects.get(name='Big course')
+        self.assertEqual(chat.member_count, 301)
+        self.assertEqual(chat.chatmember_set.count(), 301)
+
+
+class PresenceStoreTests(TestCase):
+    """Эфемерное присутствие и набор текста без записи в БД"""
+
+    def setUp(self):
+        self.clock = mock.Mock(return_value=0.0)
+        self.store = MemoryPresenceStore(ttl=60, typing_ttl=6, sweep_batch=4, clock=self.clock)
+
+    def test_presence_expires_without_heartbeat(self):
+        self.assertTrue(self.store.heartbeat(1))
+        self.store.heartbeat(2)
+        self.clock.return_value = 30.0
+        self.store.heartbeat(1)
+
+        self.clock.return_value = 61.0
+        self.assertEqual(self.store.online([1, 2, 3]), {1})
+        self.clock.return_value = 91.0
+        self.assertEqual(self.store.online([1, 2]), set())
+        self.assertTrue(self.store.heartbeat(1))
+
+    def test_reconnect_after_expiry_is_reported_before_sweep(self):
+        for user_id in range(10):
+            self.store.heartbeat(user_id)
+        self.clock.return_value = 100.0
+        # Очистка снимает только sweep_batch записей, запись пользователя 9 истекла, но еще лежит в словаре
+        self.assertTrue(self.store.heartbeat(9))
+        self.assertEqual(self.store.online([9]), {9})
+
+    def test_frequent_heartbeats_are_coalesced(self):
+        self.store.heartbeat(1)
+        for second in range(1, 20):
+            self.clock.return_value = float(second)
+            self.assertFalse(self.store.heartbeat(1))
+        self.assertEqual(len(self.store._heap), 1)
+
+    def test_sweeping_is_amortized_over_operations(self):
+        for user_id in range(20):
+            self.store.heartbeat(user_id)
+        self.clock.return_value = 100.0
+        # Каждое обращение снимает не больше sweep_batch истекших записей
+        self.store.online([])
+        self.assertEqual(len(self.store), 16)
+        for _ in range(4):
+            self.store.online([])
+        self.assertEqual((len(self.store), len(self.store._heap)), (0, 0))
+
+    def test_typing_indicator(self):
+        self.assertTrue(self.store.typing(7, 1))
+        self.assertFalse(self.store.typing(7, 1))
+        self.assertEqual(self.store.typing_users(7), {1})
+        self.clock.return_value = 7.0
+        self.assertEqual(self.store.typing_users(7), set())
+
+        self.store.typing(7, 2)
+        self.store.stop_typing(7, 2)
+        self.assertEqual(self.store.typing_users(7), set())
+
+    def test_chat_presence_endpoint_reads_members_in_one_query(self):
+        user = User.objects.create_user(username='alice', password='password')
+        other = User.objects.create_user(username='bob', password='password')
+        chat = Chat.objects.create(chat_type='group', name='Lab', created_by=user)
+        ChatMember.objects.create(user=user, chat=chat)
+        ChatMember.objects.create(user=other, chat=chat)
+        self.store.heartbeat(other.id)
+        self.store.typing(chat.id, other.id)
+        self.client.force_login(user)
+
+        with mock.patch('chats.presence.presence', self.store):
+            with self.assertNumQueries(1):
+                self.assertEqual(get_chat_presence(chat.id), {'online': [other.id], 'typing': [other.id]})
+            response = self.client.get(reverse('chats:chat_presence', args=[chat.id]))
+        self.assertEqual(response.json()['online'], [other.id])
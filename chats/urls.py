@@ -6,8 +6,13 @@ app_name = 'chats'
 urlpatterns = [
     path('', views.chat_list, name='chat_list'),
     path('create/', views.create_chat, name='create_chat'),  # Только групповые чаты
+    path('search/', views.message_search, name='message_search'),
+    path('sync/', views.chat_sync, name='chat_sync'),
     path('create-personal/<int:user_id>/', views.create_personal_chat, name='create_personal_chat'),
     path('<int:chat_id>/', views.chat_detail, name='chat_detail'),
+    path('<int:chat_id>/messages/', views.chat_history, name='chat_history'),
+    path('<int:chat_id>/sync/', views.chat_sync, name='chat_sync'),
+    path('<int:chat_id>/presence/', views.chat_presence, name='chat_presence'),
     path('<int:chat_id>/settings/', views.chat_settings, name='chat_settings'),
     path('<int:chat_id>/remove-member/<int:user_id>/', views.remove_member, name='remove_member'),
     path('search-users/', views.search_users, name='search_users'),
@@ -1,14 +1,20 @@
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import JsonResponse
+from django.http import HttpResponseNotModified, JsonResponse
+from django.utils.http import parse_etags, quote_etag
 from django.contrib import messages
-from django.db.models import Q, Count
-from django.db import models
+from django.db import transaction
 from django.conf import settings
-from django.utils import timezone
-from .models import Chat, ChatMember, Message, MessageRead
+from .models import Chat, ChatMember
 from .forms import ChatForm, MessageForm, AddMembersForm
+from .membership import add_members, remove_members
+from .history import append_message, get_recent_messages, get_messages_before, message_json
+from .realtime import broadcast_message, serialize_message
+from .presence import get_chat_presence, presence
+from .search import search_messages
+from .sync import SyncState
 from users.models import User
+from users.typeahead import typeahead
 from utils.mongo_cache import MongoCacheHelper
 import time
 
@@ -25,23 +31,13 @@ def chat_list(request):
 
     print("🔄 Список чатов загружается из базы данных")
 
-    # Основной запрос для получения чатов пользователя
-    user_chats = Chat.objects.filter(members=request.user).annotate(
-        message_count=Count('messages'),
-        last_message_time=models.Max('messages__created_at')
-    ).order_by('-updated_at')
+    # Чаты со сводкой (последнее сообщение, счетчики) и непрочитанные - два запроса на весь список
+    user_chats = list(Chat.objects.filter(members=request.user).order_by('-updated_at'))
+    unread = dict(ChatMember.objects.filter(user=request.user).with_unread().values_list('chat_id', 'unread'))
 
-    # Добавляем информацию о непрочитанных сообщениях для каждого чата
     for chat in user_chats:
-        try:
-            chat_member = ChatMember.objects.get(chat=chat, user=request.user)
-            unread_count = Message.objects.filter(
-                chat=chat,
-                created_at__gt=chat_member.last_read
-            ).count()
-            chat.unread_count = unread_count
-        except ChatMember.DoesNotExist:
-            chat.unread_count = 0
+        chat.unread_count = unread.get(chat.id, 0)
+        chat.display_name = chat.display_name_for(request.user.id)
 
     # Подготавливаем контекст для кэширования
     context = {
@@ -59,33 +55,17 @@ def chat_list(request):
 def chat_detail(request, chat_id):
     """Детальная страница чата с сообщениями и кэшированием"""
     chat = get_object_or_404(Chat, id=chat_id, members=request.user)
+    chat.display_name = chat.display_name_for(request.user.id)
 
-    # Пробуем получить сообщения из кэша MongoDB
-    cached_messages = MongoCacheHelper.get_cached_chat_messages(chat_id)
-
-    if cached_messages:
-        print("✅ Сообщения чата получены из кэша MongoDB")
-        messages_list = cached_messages
-    else:
-        print("🔄 Сообщения чата загружаются из базы данных")
-        messages_list = list(chat.messages.all().order_by('created_at'))
-        # Сохраняем в кэш MongoDB на 5 минут
-        MongoCacheHelper.cache_chat_messages(chat_id, messages_list)
-
-    # Помечаем сообщения как прочитанные для текущего пользователя
-    try:
-        chat_member = ChatMember.objects.get(chat=chat, user=request.user)
-        unread_messages = chat.messages.filter(created_at__gt=chat_member.last_read)
+    # Окно последних сообщений (кэшируется в MongoDB), более ранние - по курсору
+    recent = get_recent_messages(chat_id)
 
-        # Создаем записи о прочтении для непрочитанных сообщений
-        for message in unread_messages:
-            MessageRead.objects.get_or_create(user=request.user, message=message)
+    # Открытая страница чата тоже продлевает присутствие (без записи в БД)
+    presence.heartbeat(request.user.id)
 
-        # Обновляем время последнего прочтения
-        chat_member.last_read = timezone.now()
-        chat_member.save()
-    except ChatMember.DoesNotExist:
-        pass
+    # Помечаем показанные сообщения прочитанными: один UPDATE водяного знака
+    if recent['messages']:
+        ChatMember.mark_read(chat_id, request.user.id, recent['messages'][-1]['id'])
 
     # Обработка отправки нового сообщения
     if request.method == 'POST':
@@ -96,12 +76,13 @@ def chat_detail(request, chat_id):
             message.author = request.user
             message.save()
 
-            # Инвалидируем кэш чата при отправке нового сообщения
-            MongoCacheHelper.invalidate_chat_cache(chat_id)
+            # Дописываем сообщение в кэш чата и рассылаем подключенным по WebSocket участникам
+            transaction.on_commit(lambda: append_message(message))
+            transaction.on_commit(lambda: broadcast_message(message))
 
             # Для AJAX запросов возвращаем JSON
             if request.headers.get('x-requested-with') == 'XMLHttpRequest':
-                return JsonResponse({'status': 'success'})
+                return JsonResponse({'status': 'success', 'message': serialize_message(message)})
 
             # Для обычных запросов - редирект
             return redirect('chats:chat_detail', chat_id=chat.id)
@@ -111,7 +92,12 @@ def chat_detail(request, chat_id):
     # Формируем контекст
     context = {
         'chat': chat,
-        'messages_list': messages_list,
+        'messages_list': recent['messages'],
+        'has_older_messages': recent['has_more'],
+        'read_up_to': ChatMember.read_up_to(chat_id, exclude_user_id=request.user.id),
+        'online_count': len(get_chat_presence(chat_id)['online']),
+        'presence_ttl': presence.ttl,
+        'typing_ttl': presence.typing_ttl,
         'form': form,
         'cache_timestamp': time.time()  # Метка времени для отладки
     }
@@ -119,6 +105,88 @@ def chat_detail(request, chat_id):
     return render(request, 'chats/chat_detail.html', context)
 
 
+@login_required
+def chat_history(request, chat_id):
+    """JSON: страница сообщений старше ?before=<id>"""
+    if not ChatMember.objects.filter(chat_id=chat_id, user=request.user).exists():
+        return JsonResponse({'error': 'Чат не найден'}, status=404)
+
+    try:
+        before_id = int(request.GET['before'])
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Некорректный курсор'}, status=400)
+
+    page = get_messages_before(chat_id, before_id)
+    messages_data = [message_json(message) for message in page['messages']]
+    return JsonResponse({
+        'messages': messages_data,
+        'has_more': page['has_more'],
+        'next_cursor': messages_data[0]['id'] if messages_data else None,
+    })
+
+
+@login_required
+def chat_presence(request, chat_id):
+    """JSON: участники чата в сети и набирающие текст"""
+    if not ChatMember.objects.filter(chat_id=chat_id, user=request.user).exists():
+        return JsonResponse({'error': 'Чат не найден'}, status=404)
+    return JsonResponse(get_chat_presence(chat_id))
+
+
+@login_required
+def chat_sync(request, chat_id=None):
+    """
+    JSON: изменения в чатах пользователя с момента ?token=<токен> (или ?last_id=<id>).
+
+    Поддерживает If-None-Match: если ничего не изменилось, отвечает 304 без тела.
+    """
+    state = SyncState(request.user, chat_id=chat_id)
+    if chat_id is not None and not state.rows:
+        return JsonResponse({'error': 'Чат не найден'}, status=404)
+
+    etag = quote_etag(state.token)
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        try:
+            last_id = int(request.GET['last_id'])
+        except (KeyError, ValueError):
+            last_id = None
+        response = JsonResponse(state.delta(request.GET.get('token'), last_id=last_id))
+
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@login_required
+def message_search(request):
+    """Поиск по сообщениям во всех чатах пользователя (или в одном чате: ?chat=<id>)"""
+    query = request.GET.get('q', '').strip()
+
+    def int_param(name):
+        try:
+            return int(request.GET[name])
+        except (KeyError, ValueError):
+            return None
+
+    chat = None
+    chat_id = int_param('chat')
+    if chat_id is not None:
+        chat = get_object_or_404(Chat, id=chat_id, members=request.user)
+
+    page = search_messages(request.user, query, before=int_param('before'), chat_id=chat_id)
+
+    context = {
+        'query': query,
+        'chat': chat,
+        'results': page['results'],
+        'has_more': page['has_more'],
+        'next_cursor': page['next_cursor'],
+    }
+    return render(request, 'chats/message_search.html', context)
+
+
 @login_required
 def create_chat(request):
     """Создание группового чата"""
@@ -134,22 +202,11 @@ def create_chat(request):
             # Добавляем создателя в чат как администратора
             ChatMember.objects.create(user=request.user, chat=chat, role='admin')
 
-            # Добавляем выбранных пользователей
-            user_ids = request.POST.getlist('users')
-            added_users_count = 0
-            for user_id in user_ids:
-                try:
-                    user = User.objects.get(id=user_id)
-                    ChatMember.objects.get_or_create(user=user, chat=chat)
-                    added_users_count += 1
-
-                    # Инвалидируем кэш списка чатов для добавленного пользователя
-                    MongoCacheHelper.invalidate_user_cache(user.id)
-                except User.DoesNotExist:
-                    continue
+            # Добавляем выбранных пользователей одной пачкой (кэш их списков чатов сбрасывается там же)
+            added_users_count = len(add_members(chat, request.POST.getlist('users')))
 
             # Инвалидируем кэш списка чатов для создателя
-            MongoCacheHelper.invalidate_user_cache(request.user.id)
+            MongoCacheHelper.invalidate_chat_lists([request.user.id])
 
             # Сообщения об успехе
             if added_users_count > 0:
@@ -195,13 +252,7 @@ def chat_settings(request, chat_id):
             add_form = AddMembersForm(request.POST, current_chat=chat)
             if add_form.is_valid():
                 users = add_form.cleaned_data['users']
-                added_count = 0
-                for user in users:
-                    _, created = ChatMember.objects.get_or_create(user=user, chat=chat)
-                    if created:
-                        added_count += 1
-                        # Инвалидируем кэш для добавленного пользователя
-                        MongoCacheHelper.invalidate_user_cache(user.id)
+                added_count = len(add_members(chat, [user.id for user in users]))
 
                 if added_count > 0:
                     messages.success(request, f"Добавлено {added_count} участников")
@@ -243,15 +294,9 @@ def chat_settings(request, chat_id):
 def search_users(request):
     """Поиск пользователей для добавления в чат"""
     query = request.GET.get('q', '')
-    if query:
-        users = User.objects.filter(
-            Q(username__icontains=query) |
-            Q(first_name__icontains=query) |
-            Q(last_name__icontains=query)
-        ).exclude(id=request.user.id)[:10]
-        results = [{'id': user.id, 'name': user.get_full_name() or user.username} for user in users]
-    else:
-        results = []
+    # Каждое нажатие клавиши - префиксный поиск в памяти, без запроса к БД
+    users = typeahead.lookup(query, user_id=request.user.id, kinds=('user',), exclude=[request.user.id])
+    results = [{'id': user['id'], 'name': user['label']} for user in users]
 
     return JsonResponse(results, safe=False)
 
@@ -277,13 +322,10 @@ def remove_member(request, chat_id, user_id):
     if user_to_remove == request.user:
         messages.error(request, "Вы не можете удалить себя из чата")
     else:
-        # Удаляем участника
-        ChatMember.objects.filter(chat=chat, user=user_to_remove).delete()
+        # Удаляем участника (кэш его списка чатов сбрасывается там же)
+        remove_members(chat, [user_to_remove.id])
         messages.success(request,
                          f"Пользователь {user_to_remove.get_full_name() or user_to_remove.username} удален из чата")
-
-        # Инвалидируем кэш для удаленного пользователя
-        MongoCacheHelper.invalidate_user_cache(user_to_remove.id)
         # Инвалидируем кэш чата
         MongoCacheHelper.invalidate_chat_cache(chat_id)
 
@@ -300,26 +342,13 @@ def create_personal_chat(request, user_id):
         messages.error(request, "Нельзя создать чат с самим собой")
         return redirect('users:user_profile', username=request.user.username)
 
-    # Проверяем, не существует ли уже личный чат между этими пользователями
-    existing_chat = Chat.objects.filter(
-        chat_type='personal',
-        members=request.user
-    ).filter(members=other_user).distinct().first()
+    # Личный чат ищется по канонической паре участников, создание защищено уникальным индексом
+    chat, created = Chat.get_or_create_personal(request.user, other_user)
 
-    if existing_chat:
+    if not created:
         # Если чат уже существует, перенаправляем в него
         messages.info(request, "Переход к существующему чату")
-        return redirect('chats:chat_detail', chat_id=existing_chat.id)
-
-    # Создаем новый личный чат
-    chat = Chat.objects.create(
-        chat_type='personal',
-        created_by=request.user
-    )
-
-    # Добавляем обоих пользователей в чат
-    ChatMember.objects.create(user=request.user, chat=chat, role='admin')
-    ChatMember.objects.create(user=other_user, chat=chat, role='member')
+        return redirect('chats:chat_detail', chat_id=chat.id)
 
     # Инвалидируем кэш списка чатов для обоих пользователей
     MongoCacheHelper.invalidate_user_cache(request.user.id)
@@ -335,19 +364,4 @@ def get_unread_chats_count(user):
     if not user.is_authenticated:
         return 0
 
-    user_chats = Chat.objects.filter(members=user)
-    unread_count = 0
-
-    for chat in user_chats:
-        try:
-            chat_member = ChatMember.objects.get(chat=chat, user=user)
-            unread_messages = Message.objects.filter(
-                chat=chat,
-                created_at__gt=chat_member.last_read
-            ).count()
-            if unread_messages > 0:
-                unread_count += 1
-        except ChatMember.DoesNotExist:
-            continue
-
-    return unread_count
\ No newline at end of file
+    return user.get_unread_chats_count()
\ No newline at end of file
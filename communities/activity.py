@@ -0,0 +1,132 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Max
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from posts.models import Comment, Post, PostLike
+from .models import ActivityWatermark, CommunityMembership, DailyActivity
+
+
+# Источник событий = счетчик DailyActivity: модель, время события, сообщество и научная область.
+# Пост без своей научной области относится к области сообщества
+SOURCES = {
+    'posts': (Post, 'created_at', F('community_id'),
+              Coalesce('scientific_field_id', 'community__scientific_field_id')),
+    'comments': (Comment, 'created_at', F('post__community_id'),
+                 Coalesce('post__scientific_field_id', 'post__community__scientific_field_id')),
+    'likes': (PostLike, 'created_at', F('post__community_id'),
+              Coalesce('post__scientific_field_id', 'post__community__scientific_field_id')),
+    'new_members': (CommunityMembership, 'date_joined', F('community_id'), F('community__scientific_field_id')),
+}
+COUNTERS = tuple(SOURCES)
+MAX_SERIES_DAYS = 366
+
+
+def rollup_activity(batch_size=5000, lag=None):
+    """
+    Дописать в дневные агрегаты события, появившиеся после отметки уровня.
+
+    Каждый источник читается по возрастанию id пачками: пачка - один GROUP BY
+    по дню, сообществу и научной области в диапазоне id и одна транзакция,
+    в которой обновляются агрегаты и отметка. Отметка не переходит первое
+    событие моложе cutoff: события с меньшим id, но более поздним временем
+    (вставленные задним числом или долгой транзакцией) ждут своей очереди,
+    а не пропускаются. Удаления не вычитаются: агрегат -
+    число событий, случившихся за день. Возвращает {источник: учтено событий}.
+    """
+    lag = settings.ACTIVITY_ROLLUP_LAG if lag is None else lag
+    cutoff = timezone.now() - timedelta(seconds=lag)
+    processed = {}
+    for source in SOURCES:
+        processed[source] = 0
+        while True:
+            count = _rollup_batch(source, batch_size, cutoff)
+            processed[source] += count
+            if count < batch_size:
+                break
+    return processed
+
+
+def _rollup_batch(source, batch_size, cutoff):
+    model, time_field, community, field = SOURCES[source]
+    with transaction.atomic():
+        ActivityWatermark.objects.get_or_create(source=source)
+        watermark = ActivityWatermark.objects.select_for_update().get(source=source)
+
+        events = model.objects.filter(id__gt=watermark.last_id).order_by()
+        blocked = events.filter(**{f'{time_field}__gte': cutoff}).order_by('id').values_list('id', flat=True).first()
+        if blocked is not None:
+            events = events.filter(id__lt=blocked)
+        boundary = list(events.order_by('id').values_list('id', flat=True)[batch_size - 1:batch_size])
+        upper = boundary[0] if boundary else events.aggregate(upper=Max('id'))['upper']
+        if upper is None:
+            return 0
+
+        rows = events.filter(id__lte=upper).values(
+            rollup_day=TruncDate(time_field), rollup_community=community, rollup_field=field,
+        ).annotate(total=Count('id'))
+
+        count = 0
+        deltas = Counter()
+        for row in rows:
+            count += row['total']
+            day = row['rollup_day']
+            deltas['platform', 0, day] += row['total']
+            if row['rollup_community']:
+                deltas['community', row['rollup_community'], day] += row['total']
+            if row['rollup_field']:
+                deltas['field', row['rollup_field'], day] += row['total']
+        _apply(source, deltas)
+
+        watermark.last_id = upper
+        watermark.save(update_fields=['last_id', 'updated_at'])
+    return count
+
+
+def _apply(counter, deltas):
+    """Прибавить deltas {(срез, id, день): n} к счетчику counter"""
+    if not deltas:
+        return
+    # Недостающие строки создаются пустыми, затем все нужные блокируются и
+    # увеличиваются: параллельная агрегация других источников не теряет счетчики
+    DailyActivity.objects.bulk_create(
+        [DailyActivity(scope=scope, scope_id=scope_id, day=day) for scope, scope_id, day in deltas],
+        ignore_conflicts=True, batch_size=500,
+    )
+    changed = []
+    for scope in {scope for scope, _, _ in deltas}:
+        keys = [key for key in deltas if key[0] == scope]
+        rows = DailyActivity.objects.select_for_update().filter(
+            scope=scope, scope_id__in={key[1] for key in keys}, day__in={key[2] for key in keys},
+        )
+        for row in rows:
+            delta = deltas.get((scope, row.scope_id, row.day))
+            if delta:
+                setattr(row, counter, getattr(row, counter) + delta)
+                changed.append(row)
+    DailyActivity.objects.bulk_update(changed, [counter], batch_size=500)
+
+
+def activity_series(scope, scope_id, start, end):
+    """
+    Дневной ряд активности среза за [start, end] для графика.
+
+    Одна выборка по уникальному индексу (scope, scope_id, day); дни без
+    событий заполняются нулями. Длина ряда ограничена MAX_SERIES_DAYS.
+    """
+    start = max(start, end - timedelta(days=MAX_SERIES_DAYS - 1))
+    rows = {
+        row['day']: row
+        for row in DailyActivity.objects.filter(scope=scope, scope_id=scope_id or 0, day__range=(start, end))
+        .values('day', *COUNTERS)
+    }
+    series = []
+    for offset in range((end - start).days + 1):
+        day = start + timedelta(days=offset)
+        row = rows.get(day) or dict.fromkeys(COUNTERS, 0)
+        series.append({'day': day.isoformat(), **{counter: row[counter] for counter in COUNTERS}})
+    return series
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Community, CommunityMembership
+from .models import Community, CommunityMembership, DailyActivity
 
 @admin.register(Community)
 class CommunityAdmin(admin.ModelAdmin):
@@ -11,3 +11,9 @@ class CommunityAdmin(admin.ModelAdmin):
 class CommunityMembershipAdmin(admin.ModelAdmin):
     list_display = ('user', 'community', 'date_joined', 'is_moderator')
     list_filter = ('is_moderator', 'date_joined')
+
+@admin.register(DailyActivity)
+class DailyActivityAdmin(admin.ModelAdmin):
+    list_display = ('day', 'scope', 'scope_id', 'posts', 'comments', 'likes', 'new_members')
+    list_filter = ('scope', 'day')
+    date_hierarchy = 'day'
@@ -0,0 +1,72 @@
+from datetime import datetime
+
+from django.db.models import Q
+
+from .models import Community
+
+
+DIRECTORY_PAGE_SIZE = 24
+
+# Сортировка каталога: поле, направление и как курсор хранит значение поля
+SORTS = {
+    'size': ('members_count', True, int),
+    'activity': ('last_activity_at', True, datetime.fromisoformat),
+    'name': ('name', False, str),
+}
+DEFAULT_SORT = 'size'
+SORT_CHOICES = (
+    ('size', 'По числу участников'),
+    ('activity', 'По активности'),
+    ('name', 'По названию'),
+)
+
+
+def community_directory(sort=DEFAULT_SORT, scientific_field_id=None, after=None, limit=DIRECTORY_PAGE_SIZE):
+    """
+    Страница каталога сообществ одним запросом по индексу.
+
+    Порядок - по размеру, активности или названию, необязательный фильтр по
+    научной области. Страницы идут по ключу (значение сортировки, id) без
+    OFFSET, курсор after - next_cursor предыдущей страницы. Возвращает
+    {'results', 'has_more', 'next_cursor'}.
+    """
+    field = SORTS.get(sort, SORTS[DEFAULT_SORT])[0]
+    results = list(directory_queryset(sort, scientific_field_id, after)[:limit + 1])
+    has_more = len(results) > limit
+    results = results[:limit]
+
+    next_cursor = None
+    if has_more:
+        last = results[-1]
+        value = getattr(last, field)
+        next_cursor = f'{value.isoformat() if isinstance(value, datetime) else value}|{last.id}'
+    return {'results': results, 'has_more': has_more, 'next_cursor': next_cursor}
+
+
+def directory_queryset(sort=DEFAULT_SORT, scientific_field_id=None, after=None):
+    """Упорядоченный запрос каталога, начиная с позиции курсора"""
+    field, descending, parse = SORTS.get(sort, SORTS[DEFAULT_SORT])
+
+    communities = Community.objects.select_related('scientific_field')
+    if scientific_field_id:
+        communities = communities.filter(scientific_field_id=scientific_field_id)
+
+    cursor = _parse_cursor(after, parse)
+    if cursor is not None:
+        # Диапазон по полю сортировки (поиск по индексу) минус уже показанные строки с тем же значением
+        value, community_id = cursor
+        if descending:
+            communities = communities.filter(Q(**{f'{field}__lte': value}) & ~Q(**{field: value, 'id__gte': community_id}))
+        else:
+            communities = communities.filter(Q(**{f'{field}__gte': value}) & ~Q(**{field: value, 'id__lte': community_id}))
+
+    return communities.order_by(*([f'-{field}', '-id'] if descending else [field, 'id']))
+
+
+def _parse_cursor(cursor, parse):
+    # Курсор «значение|id»; значение может само содержать «|» (название), поэтому режем справа
+    try:
+        value, community_id = (cursor or '').rsplit('|', 1)
+        return parse(value), int(community_id)
+    except ValueError:
+        return None
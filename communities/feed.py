@@ -0,0 +1,78 @@
+from datetime import datetime
+
+from django.db.models import Q
+
+from posts.models import FavouritePost, Post
+from utils.mongo_cache import MongoCacheHelper
+
+
+COMMUNITY_FEED_PAGE_SIZE = 20
+
+
+def _serialize_post(post):
+    """Карточка поста для ленты сообщества и кэша: все, что нужно шаблону, без обращений к БД"""
+    return {
+        'id': post.id,
+        'title': post.title,
+        'content': post.content,
+        'post_type_display': post.get_post_type_display(),
+        'author_username': post.author.username,
+        'author_name': post.author.get_full_name() or post.author.username,
+        'created_at': post.created_at,
+        'like_count': post.like_count,
+        'comment_count': post.comment_count,
+        'favourite_count': post.favourite_count,
+    }
+
+
+def community_feed(community_id, after=None):
+    """
+    Страница ленты сообщества после курсора «created_at|id».
+
+    Посты идут от новых к старым по индексу (community, created_at) без OFFSET,
+    авторы подгружаются JOIN, счетчики - подзапросами with_engagement(), так что
+    страница стоит одного запроса при любом размере сообщества. Первая страница
+    кэшируется и сбрасывается при публикации и удалении поста.
+    Возвращает {'results', 'has_more', 'next_cursor'}.
+    """
+    cursor = _parse_cursor(after)
+    if cursor is None:
+        cached_page = MongoCacheHelper.get_cached_community_feed(community_id)
+        if cached_page is not None:
+            return cached_page
+
+    posts = Post.objects.filter(community_id=community_id)
+    if cursor is not None:
+        created_at, post_id = cursor
+        posts = posts.filter(Q(created_at__lte=created_at) & ~Q(created_at=created_at, id__gte=post_id))
+    posts = list(
+        posts.with_engagement().select_related('author')
+        .order_by('-created_at', '-id')[:COMMUNITY_FEED_PAGE_SIZE + 1]
+    )
+    has_more = len(posts) > COMMUNITY_FEED_PAGE_SIZE
+    results = [_serialize_post(post) for post in posts[:COMMUNITY_FEED_PAGE_SIZE]]
+
+    page = {
+        'results': results,
+        'has_more': has_more,
+        'next_cursor': f"{results[-1]['created_at'].isoformat()}|{results[-1]['id']}" if has_more else None,
+    }
+    if cursor is None:
+        MongoCacheHelper.cache_community_feed(community_id, page)
+    return page
+
+
+def favourite_post_ids(user, posts):
+    """id постов страницы, которые пользователь добавил в избранное - один запрос"""
+    return set(
+        FavouritePost.objects.filter(user_id=user.id, post_id__in=[post['id'] for post in posts])
+        .values_list('post_id', flat=True)
+    )
+
+
+def _parse_cursor(cursor):
+    try:
+        created_at, post_id = (cursor or '').rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(post_id)
+    except ValueError:
+        return None
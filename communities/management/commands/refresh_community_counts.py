@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from communities.models import Community
+
+
+class Command(BaseCommand):
+    help = 'Recompute member and post counters of all communities (after bulk imports and deletions)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Communities per UPDATE'
+        )
+
+    def handle(self, *args, **options):
+        last_id = total = 0
+        while True:
+            community_ids = list(
+                Community.objects.filter(id__gt=last_id).order_by('id')
+                .values_list('id', flat=True)[:options['batch_size']]
+            )
+            if not community_ids:
+                break
+            Community.refresh_counts(community_ids)
+            total += len(community_ids)
+            last_id = community_ids[-1]
+
+        self.stdout.write(self.style.SUCCESS(f"Recomputed counters of {total} communities"))
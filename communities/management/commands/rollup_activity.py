@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand
+from communities.activity import rollup_activity
+
+
+class Command(BaseCommand):
+    help = 'Add new posts, comments, likes and memberships to daily activity rollups'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Events per transaction'
+        )
+        parser.add_argument(
+            '--lag',
+            type=int,
+            default=None,
+            help='Skip events younger than this many seconds (default: ACTIVITY_ROLLUP_LAG)'
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Run as a background worker'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=60.0,
+            help='Seconds between runs (with --loop)'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            processed = rollup_activity(batch_size=options['batch_size'], lag=options['lag'])
+            summary = ', '.join(f"{source}: {count}" for source, count in processed.items())
+            self.stdout.write(f"Rolled up events - {summary}")
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS("Activity rollups are up to date"))
@@ -0,0 +1,73 @@
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+
+from users.models import UserStats
+from .models import Community, CommunityMembership
+
+
+MEMBERS_PAGE_SIZE = 50
+
+
+def member_page(community_id, role=None, query='', after=None, limit=MEMBERS_PAGE_SIZE):
+    """
+    Страница списка участников сообщества в порядке вступления.
+
+    Необязательные фильтры - роль и подстрока имени или логина. Страницы идут
+    по id членства без OFFSET, курсор after - next_cursor предыдущей страницы.
+    Возвращает {'results', 'has_more', 'next_cursor'}.
+    """
+    memberships = CommunityMembership.objects.filter(community_id=community_id)
+    if role:
+        memberships = memberships.filter(role=role)
+    for token in query.split():
+        memberships = memberships.filter(
+            Q(user__username__icontains=token) | Q(user__first_name__icontains=token) |
+            Q(user__last_name__icontains=token)
+        )
+    if after:
+        memberships = memberships.filter(id__gt=after)
+
+    results = list(memberships.select_related('user__profile').order_by('id')[:limit + 1])
+    has_more = len(results) > limit
+    results = results[:limit]
+    return {'results': results, 'has_more': has_more, 'next_cursor': results[-1].id if has_more else None}
+
+
+def apply_member_changes(community, roles, remove_user_ids):
+    """
+    Массово сменить роли и удалить участников в одной транзакции.
+
+    roles - {id пользователя: новая роль}. Изменившиеся роли сохраняются одним
+    bulk_update вместе с is_moderator, удаление - один DELETE с фильтром и
+    поправка счетчика участников. Создателя сообщества операция не затрагивает.
+    Возвращает (сколько ролей изменено, сколько участников удалено).
+    """
+    remove_user_ids = set(remove_user_ids) - {community.created_by_id}
+    roles = {
+        user_id: role for user_id, role in roles.items()
+        if user_id not in remove_user_ids and user_id != community.created_by_id
+    }
+
+    with transaction.atomic():
+        changed = []
+        if roles:
+            memberships = CommunityMembership.objects.filter(community_id=community.id, user_id__in=roles) \
+                .only('id', 'user_id', 'role')
+            for membership in memberships:
+                if membership.role != roles[membership.user_id]:
+                    membership.role = roles[membership.user_id]
+                    # bulk_update не вызывает save(), поэтому синхронизируем флаг здесь
+                    membership.is_moderator = membership.role in CommunityMembership.MODERATOR_ROLES
+                    changed.append(membership)
+            CommunityMembership.objects.bulk_update(changed, ['role', 'is_moderator'], batch_size=500)
+
+        removed = 0
+        if remove_user_ids:
+            memberships = CommunityMembership.objects.filter(community_id=community.id, user_id__in=remove_user_ids)
+            removed_user_ids = list(memberships.values_list('user_id', flat=True))
+            removed, _ = memberships.filter(user_id__in=removed_user_ids).delete()
+            Community.objects.filter(id=community.id).update(members_count=Greatest(F('members_count') - removed, 0))
+            UserStats.increment('communities_count', dict.fromkeys(removed_user_ids, -1))
+
+    return len(changed), removed
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-19 12:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0004_alter_community_options_community_avatar_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='community',
+            index=models.Index(fields=['updated_at'], name='community_updated_idx'),
+        ),
+    ]
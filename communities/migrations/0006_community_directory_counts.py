@@ -0,0 +1,49 @@
+# Generated by Django 4.2.7 on 2026-10-19 12:24
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0005_community_updated_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='community',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Последняя активность'),
+        ),
+        migrations.AddField(
+            model_name='community',
+            name='members_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Количество участников'),
+        ),
+        migrations.AddField(
+            model_name='community',
+            name='posts_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Количество публикаций'),
+        ),
+        migrations.AddIndex(
+            model_name='community',
+            index=models.Index(fields=['-members_count', '-id'], name='community_size_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='community',
+            index=models.Index(fields=['-last_activity_at', '-id'], name='community_activity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='community',
+            index=models.Index(fields=['scientific_field', '-members_count', '-id'], name='community_field_size_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='community',
+            index=models.Index(fields=['scientific_field', '-last_activity_at', '-id'], name='community_field_activity_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='community',
+            index=models.Index(fields=['scientific_field', 'name'], name='community_field_name_idx'),
+        ),
+    ]
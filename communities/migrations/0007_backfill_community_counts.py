@@ -0,0 +1,44 @@
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def backfill_community_counts(apps, schema_editor):
+    Community = apps.get_model('communities', 'Community')
+    CommunityMembership = apps.get_model('communities', 'CommunityMembership')
+    Post = apps.get_model('posts', 'Post')
+
+    members = dict(
+        CommunityMembership.objects.order_by().values('community_id').annotate(total=Count('id'))
+        .values_list('community_id', 'total')
+    )
+    posts = {
+        community_id: (total, last_post_at)
+        for community_id, total, last_post_at in Post.objects.filter(community__isnull=False).order_by()
+        .values('community_id').annotate(total=Count('id'), last_post_at=Max('created_at'))
+        .values_list('community_id', 'total', 'last_post_at')
+    }
+
+    communities = []
+    for community in Community.objects.order_by('id').iterator(chunk_size=500):
+        post_total, last_post_at = posts.get(community.id, (0, None))
+        community.members_count = members.get(community.id, 0)
+        community.posts_count = post_total
+        community.last_activity_at = max(filter(None, [community.created_at, last_post_at]))
+        communities.append(community)
+
+        if len(communities) >= 500:
+            Community.objects.bulk_update(communities, ['members_count', 'posts_count', 'last_activity_at'])
+            communities = []
+    Community.objects.bulk_update(communities, ['members_count', 'posts_count', 'last_activity_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0006_community_directory_counts'),
+        ('posts', '0008_post_fts'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_community_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-19 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0007_backfill_community_counts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='communitymembership',
+            index=models.Index(fields=['community', 'role'], name='membership_community_role_idx'),
+        ),
+    ]
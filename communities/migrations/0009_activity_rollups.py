@@ -0,0 +1,44 @@
+# Generated by Django 4.2.7 on 2026-10-19 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0008_membership_community_role_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=50, unique=True, verbose_name='Источник')),
+                ('last_id', models.PositiveBigIntegerField(default=0, verbose_name='Последний учтенный id')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+            ],
+            options={
+                'verbose_name': 'Отметка агрегации',
+                'verbose_name_plural': 'Отметки агрегации',
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyActivity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(choices=[('platform', 'Платформа'), ('community', 'Сообщество'), ('field', 'Научная область')], max_length=20, verbose_name='Срез')),
+                ('scope_id', models.PositiveIntegerField(default=0, verbose_name='Объект среза')),
+                ('day', models.DateField(verbose_name='День')),
+                ('posts', models.PositiveIntegerField(default=0, verbose_name='Публикации')),
+                ('comments', models.PositiveIntegerField(default=0, verbose_name='Комментарии')),
+                ('likes', models.PositiveIntegerField(default=0, verbose_name='Лайки')),
+                ('new_members', models.PositiveIntegerField(default=0, verbose_name='Новые участники')),
+            ],
+            options={
+                'verbose_name': 'Активность за день',
+                'verbose_name_plural': 'Активность по дням',
+                'unique_together': {('scope', 'scope_id', 'day')},
+            },
+        ),
+    ]
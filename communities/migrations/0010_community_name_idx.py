@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-19 13:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0009_activity_rollups'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='community',
+            index=models.Index(fields=['name', 'id'], name='community_name_idx'),
+        ),
+    ]
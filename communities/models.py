@@ -1,6 +1,11 @@
 from django.db import models
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
 from django.conf import settings
 from django.urls import reverse
+from django.utils import timezone
+
+from users.models import UserStats
 
 class Community(models.Model):
     COMMUNITY_TYPES = (
@@ -30,6 +35,12 @@ class Community(models.Model):
     website = models.URLField(blank=True, verbose_name="Веб-сайт")
     contact_email = models.EmailField(blank=True, verbose_name="Контактный email")
 
+    # Денормализованные счетчики для каталога: поддерживаются при вступлении,
+    # выходе, публикации и удалении поста, пересчитываются refresh_counts()
+    members_count = models.PositiveIntegerField(default=0, verbose_name="Количество участников")
+    posts_count = models.PositiveIntegerField(default=0, verbose_name="Количество публикаций")
+    last_activity_at = models.DateTimeField(default=timezone.now, verbose_name="Последняя активность")
+
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
 
@@ -37,18 +48,52 @@ class Community(models.Model):
         verbose_name = "Сообщество"
         verbose_name_plural = "Сообщества"
         ordering = ['-created_at']
+        indexes = [
+            # Дочитывание измененных сообществ индексом автодополнения
+            models.Index(fields=['updated_at'], name='community_updated_idx'),
+            # Страницы каталога по размеру, активности и названию, в том числе внутри научной области
+            models.Index(fields=['-members_count', '-id'], name='community_size_idx'),
+            models.Index(fields=['-last_activity_at', '-id'], name='community_activity_idx'),
+            models.Index(fields=['scientific_field', '-members_count', '-id'], name='community_field_size_idx'),
+            models.Index(fields=['scientific_field', '-last_activity_at', '-id'],
+                         name='community_field_activity_idx'),
+            models.Index(fields=['name', 'id'], name='community_name_idx'),
+            models.Index(fields=['scientific_field', 'name'], name='community_field_name_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
     def member_count(self):
-        return self.members.count()
+        return self.members_count
 
     def post_count(self):
-        return self.posts.count()
+        return self.posts_count
+
+    @classmethod
+    def record_post(cls, post):
+        """Учесть новый пост сообщества одним UPDATE"""
+        cls.objects.filter(id=post.community_id).update(
+            posts_count=F('posts_count') + 1,
+            last_activity_at=Greatest(F('last_activity_at'), Value(post.created_at)),
+        )
+
+    @classmethod
+    def refresh_counts(cls, community_ids):
+        """Пересчитать счетчики участников и постов одним UPDATE (после массовых операций)"""
+        from posts.models import Post
+
+        members = CommunityMembership.objects.filter(community_id=OuterRef('pk')).order_by() \
+            .values('community_id').annotate(total=Count('*'))
+        posts = Post.objects.filter(community_id=OuterRef('pk')).order_by() \
+            .values('community_id').annotate(total=Count('*'))
+        cls.objects.filter(id__in=community_ids).update(
+            members_count=Coalesce(Subquery(members.values('total')), 0),
+            posts_count=Coalesce(Subquery(posts.values('total')), 0),
+        )
 
     def is_creator(self, user):
-        return self.created_by == user
+        return self.created_by_id == user.id
 
     def is_moderator(self, user):
         # ЗАМЕНА: используем filter().first() вместо get() для обработки дубликатов
@@ -67,6 +112,8 @@ class CommunityMembership(models.Model):
         ('moderator', 'Модератор'),
         ('admin', 'Администратор'),
     )
+    # Роли, для которых is_moderator=True
+    MODERATOR_ROLES = ('moderator', 'admin')
 
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name="Пользователь")
     community = models.ForeignKey(Community, on_delete=models.CASCADE, verbose_name="Сообщество")
@@ -78,11 +125,69 @@ class CommunityMembership(models.Model):
         verbose_name = "Участник сообщества"
         verbose_name_plural = "Участники сообществ"
         unique_together = ('user', 'community')  # Это должно предотвращать дубликаты
+        indexes = [
+            # Страницы списка участников сообщества с фильтром по роли
+            models.Index(fields=['community', 'role'], name='membership_community_role_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user} в {self.community} ({self.role})"
 
     def save(self, *args, **kwargs):
         # Синхронизируем is_moderator с ролью
-        self.is_moderator = self.role in ['moderator', 'admin']
-        super().save(*args, **kwargs)
\ No newline at end of file
+        self.is_moderator = self.role in self.MODERATOR_ROLES
+        created = self._state.adding
+        super().save(*args, **kwargs)
+        if created:
+            Community.objects.filter(id=self.community_id).update(members_count=F('members_count') + 1)
+            UserStats.increment('communities_count', {self.user_id: 1})
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        Community.objects.filter(id=self.community_id).update(members_count=Greatest(F('members_count') - 1, 0))
+        UserStats.increment('communities_count', {self.user_id: -1})
+        return result
+
+
+class DailyActivity(models.Model):
+    """
+    Дневной агрегат активности одного среза: платформы целиком, сообщества
+    или научной области. Заполняется инкрементально (communities.activity),
+    графики читают по строке на день вместо GROUP BY по исходным таблицам.
+    """
+    SCOPES = (
+        ('platform', 'Платформа'),
+        ('community', 'Сообщество'),
+        ('field', 'Научная область'),
+    )
+
+    scope = models.CharField(max_length=20, choices=SCOPES, verbose_name="Срез")
+    # id сообщества или научной области, 0 для платформы
+    scope_id = models.PositiveIntegerField(default=0, verbose_name="Объект среза")
+    day = models.DateField(verbose_name="День")
+    posts = models.PositiveIntegerField(default=0, verbose_name="Публикации")
+    comments = models.PositiveIntegerField(default=0, verbose_name="Комментарии")
+    likes = models.PositiveIntegerField(default=0, verbose_name="Лайки")
+    new_members = models.PositiveIntegerField(default=0, verbose_name="Новые участники")
+
+    class Meta:
+        verbose_name = "Активность за день"
+        verbose_name_plural = "Активность по дням"
+        unique_together = ('scope', 'scope_id', 'day')
+
+    def __str__(self):
+        return f"{self.get_scope_display()} {self.scope_id} {self.day}"
+
+
+class ActivityWatermark(models.Model):
+    """Отметка уровня: id последнего учтенного в агрегатах события источника"""
+    source = models.CharField(max_length=50, unique=True, verbose_name="Источник")
+    last_id = models.PositiveBigIntegerField(default=0, verbose_name="Последний учтенный id")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+
+    class Meta:
+        verbose_name = "Отметка агрегации"
+        verbose_name_plural = "Отметки агрегации"
+
+    def __str__(self):
+        return f"{self.source}: {self.last_id}"
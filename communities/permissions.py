@@ -0,0 +1,51 @@
+from .models import CommunityMembership
+
+
+class CommunityRoles:
+    """
+    Роли пользователя во всех его сообществах.
+
+    Членства загружаются одним запросом при первой проверке, дальше
+    is_member, role, can_edit и can_manage_members отвечают из памяти.
+    Живет в пределах запроса - см. get_community_roles().
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self._roles = None
+
+    @property
+    def roles(self):
+        """{id сообщества: роль}"""
+        if self._roles is None:
+            if self.user.is_authenticated:
+                self._roles = dict(
+                    CommunityMembership.objects.filter(user_id=self.user.id).values_list('community_id', 'role')
+                )
+            else:
+                self._roles = {}
+        return self._roles
+
+    def is_creator(self, community):
+        return self.user.is_authenticated and community.created_by_id == self.user.id
+
+    def is_member(self, community):
+        return community.id in self.roles
+
+    def role(self, community):
+        return self.roles.get(community.id)
+
+    def can_edit(self, community):
+        # Редактировать сообщество и открывать список участников могут создатель, администраторы и модераторы
+        return self.is_creator(community) or self.role(community) in ('admin', 'moderator')
+
+    def can_manage_members(self, community):
+        # Менять роли и удалять участников могут только создатель и администраторы
+        return self.is_creator(community) or self.role(community) == 'admin'
+
+
+def get_community_roles(request):
+    """Роли текущего пользователя, общие для всех проверок одного запроса"""
+    if not hasattr(request, '_community_roles'):
+        request._community_roles = CommunityRoles(request.user)
+    return request._community_roles
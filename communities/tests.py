@@ -1,3 +1,454 @@
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from posts.models import Comment, FavouritePost, Post, PostLike
+from users.models import User, ScientificField
+from utils.mongo_cache import MongoCacheHelper
+from utils.query_plan import QueryPlanAssertionsMixin
+from . import feed
+from .activity import activity_series, rollup_activity
+from .directory import community_directory, directory_queryset
+from .members import member_page
+from .models import ActivityWatermark, Community, CommunityMembership
+from .permissions import CommunityRoles
+
+
+class CommunityCountersTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username='owner', password='password')
+        cls.reader = User.objects.create_user(username='reader', password='password')
+
+    def setUp(self):
+        self.community = Community.objects.create(name='Optics', created_by=self.owner)
+
+    def reload(self):
+        self.community.refresh_from_db()
+        return self.community
+
+    def test_join_and_leave(self):
+        CommunityMembership.objects.create(user=self.owner, community=self.community, role='admin')
+        membership = CommunityMembership.objects.create(user=self.reader, community=self.community)
+        self.assertEqual(self.reload().members_count, 2)
+
+        membership.role = 'moderator'
+        membership.save()
+        self.assertEqual(self.reload().members_count, 2)
+
+        membership.delete()
+        self.assertEqual(self.reload().members_count, 1)
+
+    def test_posts_update_count_and_activity(self):
+        before = self.reload().last_activity_at
+        post = Post.objects.create(author=self.owner, community=self.community, title='Laser', content='...')
+        Post.objects.create(author=self.owner, title='Personal', content='...')
+        community = self.reload()
+        self.assertEqual(community.posts_count, 1)
+        self.assertEqual(community.last_activity_at, max(before, post.created_at))
+
+        post.delete()
+        self.assertEqual(self.reload().posts_count, 0)
+
+    def test_refresh_counts(self):
+        CommunityMembership.objects.create(user=self.reader, community=self.community)
+        Post.objects.create(author=self.owner, community=self.community, title='Laser', content='...')
+        Community.objects.filter(id=self.community.id).update(members_count=7, posts_count=7)
+
+        Community.refresh_counts([self.community.id])
+        community = self.reload()
+        self.assertEqual((community.members_count, community.posts_count), (1, 1))
+
+        Community.objects.filter(id=self.community.id).update(members_count=7, posts_count=7)
+        call_command('refresh_community_counts', batch_size=1, stdout=StringIO())
+        community = self.reload()
+        self.assertEqual((community.members_count, community.posts_count), (1, 1))
+
+
+class CommunityDirectoryTests(QueryPlanAssertionsMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username='owner', password='password')
+        cls.physics = ScientificField.objects.create(name='Физика')
+        now = timezone.now()
+        cls.communities = []
+        for index in range(5):
+            cls.communities.append(Community.objects.create(
+                name=f'Community {index}', created_by=cls.owner, members_count=index % 3,
+                last_activity_at=now - timedelta(hours=index),
+                scientific_field=cls.physics if index % 2 else None,
+            ))
+
+    def walk(self, sort, **kwargs):
+        names, after = [], None
+        while True:
+            page = community_directory(sort, after=after, limit=2, **kwargs)
+            names += [community.name for community in page['results']]
+            if not page['has_more']:
+                return names
+            after = page['next_cursor']
+
+    def test_cursor_pages_for_each_sort(self):
+        by_size = sorted(self.communities, key=lambda c: (c.members_count, c.id), reverse=True)
+        self.assertEqual(self.walk('size'), [c.name for c in by_size])
+        self.assertEqual(self.walk('activity'), [c.name for c in self.communities])
+        self.assertEqual(self.walk('name'), sorted(c.name for c in self.communities))
+        self.assertEqual(self.walk('unknown'), [c.name for c in by_size])
+
+    def test_field_filter(self):
+        self.assertEqual(self.walk('activity', scientific_field_id=self.physics.id), ['Community 1', 'Community 3'])
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN доступен только в SQLite')
+    def test_directory_queries_use_indexes(self):
+        after = f'{self.communities[2].last_activity_at.isoformat()}|{self.communities[2].id}'
+        self.assertEqual(
+            [c.name for c in community_directory('activity', after=after)['results']],
+            ['Community 3', 'Community 4'],
+        )
+        for sort, field_id, index in [
+            ('size', None, 'community_size_idx'),
+            ('activity', None, 'community_activity_idx'),
+            ('size', self.physics.id, 'community_field_size_idx'),
+            ('activity', self.physics.id, 'community_field_activity_idx'),
+            ('name', None, 'community_name_idx'),
+            ('name', self.physics.id, 'community_field_name_idx'),
+        ]:
+            page = community_directory(sort, field_id, limit=1)
+            queryset = directory_queryset(sort, field_id, after=page['next_cursor'])[:25]
+            self.assertNoFullScan(queryset)
+            self.assertUsesIndex(queryset, index)
+
+    def test_directory_page_queries(self):
+        CommunityMembership.objects.create(user=self.owner, community=self.communities[0], role='admin')
+        self.client.force_login(self.owner)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('communities:community_list'), {'sort': 'size'})
+        self.assertContains(response, 'Community 4')
+        self.assertContains(response, 'Админ')
+        # Страница каталога - один запрос к сообществам, без подсчетов участников и постов
+        directory = [query['sql'] for query in queries if query['sql'].startswith('SELECT "communities_community"')]
+        self.assertEqual(len(directory), 1)
+        self.assertFalse([query['sql'] for query in queries if 'COUNT' in query['sql'] and 'communit' in query['sql']])
+
+
+@mock.patch.object(MongoCacheHelper, 'cache_community_feed')
+@mock.patch.object(MongoCacheHelper, 'get_cached_community_feed', return_value=None)
+class CommunityRolesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username='owner', password='password')
+        cls.admin = User.objects.create_user(username='admin', password='password')
+        cls.moderator = User.objects.create_user(username='moderator', password='password')
+        cls.reader = User.objects.create_user(username='reader', password='password')
+        cls.stranger = User.objects.create_user(username='stranger', password='password')
+        cls.community = Community.objects.create(name='Optics', created_by=cls.owner)
+        cls.other = Community.objects.create(name='Lasers', created_by=cls.admin)
+        for user, role in [(cls.owner, 'admin'), (cls.admin, 'admin'), (cls.moderator, 'moderator'),
+                           (cls.reader, 'member')]:
+            CommunityMembership.objects.create(user=user, community=cls.community, role=role)
+        CommunityMembership.objects.create(user=cls.reader, community=cls.other, role='admin')
+
+    def test_answers_from_one_query(self, get_cached, cache_page):
+        roles = CommunityRoles(self.reader)
+        with self.assertNumQueries(1):
+            self.assertTrue(roles.is_member(self.community))
+            self.assertEqual(roles.role(self.community), 'member')
+            self.assertFalse(roles.can_edit(self.community))
+            self.assertTrue(roles.can_manage_members(self.other))
+
+        expected = {
+            self.owner: (True, True), self.admin: (True, True), self.moderator: (True, False),
+            self.reader: (False, False), self.stranger: (False, False),
+        }
+        for user, (can_edit, can_manage) in expected.items():
+            roles = CommunityRoles(user)
+            self.assertEqual((roles.can_edit(self.community), roles.can_manage_members(self.community)),
+                             (can_edit, can_manage), user.username)
+
+    def test_detail_page_loads_memberships_once(self, get_cached, cache_page):
+        self.client.force_login(self.moderator)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('communities:community_detail', args=[self.community.id]))
+        self.assertContains(response, reverse('communities:community_edit', args=[self.community.id]))
+        memberships = [query['sql'] for query in queries if 'communities_communitymembership' in query['sql']]
+        self.assertEqual(len(memberships), 1)
+
+    def test_member_management_permissions(self, get_cached, cache_page):
+        target = CommunityMembership.objects.get(user=self.reader, community=self.community)
+
+        # Модератор видит список участников, но не управляет ими
+        self.client.force_login(self.moderator)
+        response = self.client.get(reverse('communities:community_members', args=[self.community.id]))
+        self.assertNotContains(response, f'name="remove" value="{self.reader.id}"')
+        self.client.post(reverse('communities:change_member_role', args=[self.community.id, self.reader.id]),
+                         {'role': 'admin'})
+        target.refresh_from_db()
+        self.assertEqual(target.role, 'member')
+
+        # Посторонний получает отказ, а не ошибку сервера
+        self.client.force_login(self.stranger)
+        response = self.client.post(reverse('communities:remove_member', args=[self.community.id, self.reader.id]))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(CommunityMembership.objects.filter(id=target.id).exists())
+
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('communities:community_members', args=[self.community.id]))
+        self.assertContains(response, f'name="remove" value="{self.reader.id}"')
+        self.client.post(reverse('communities:change_member_role', args=[self.community.id, self.reader.id]),
+                         {'role': 'moderator'})
+        target.refresh_from_db()
+        self.assertEqual(target.role, 'moderator')
+
+        # Создателя нельзя удалить
+        self.client.post(reverse('communities:remove_member', args=[self.community.id, self.owner.id]))
+        self.assertTrue(CommunityMembership.objects.filter(user=self.owner, community=self.community).exists())
+
+
+@mock.patch.object(MongoCacheHelper, 'cache_community_feed')
+@mock.patch.object(MongoCacheHelper, 'get_cached_community_feed', return_value=None)
+class CommunityFeedTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username='owner', password='password')
+        cls.reader = User.objects.create_user(username='reader', password='password')
+        cls.community = Community.objects.create(name='Optics', created_by=cls.owner)
+        CommunityMembership.objects.create(user=cls.owner, community=cls.community, role='admin')
+
+    def create_posts(self, count):
+        return [
+            Post.objects.create(author=self.owner, community=self.community, title=f'Post {index}', content='...')
+            for index in range(count)
+        ]
+
+    def test_pages_follow_cursor(self, get_cached, cache_page):
+        posts = self.create_posts(5)
+        # Одинаковое время публикации у двух постов: порядок внутри - по id
+        Post.objects.filter(id=posts[3].id).update(created_at=posts[2].created_at)
+        Post.objects.create(author=self.owner, title='Personal', content='...')
+
+        titles, after = [], None
+        with mock.patch.object(feed, 'COMMUNITY_FEED_PAGE_SIZE', 2):
+            while True:
+                page = feed.community_feed(self.community.id, after=after)
+                titles += [post['title'] for post in page['results']]
+                if not page['has_more']:
+                    break
+                after = page['next_cursor']
+        self.assertEqual(titles, ['Post 4', 'Post 3', 'Post 2', 'Post 1', 'Post 0'])
+        # В кэш попадает только первая страница
+        self.assertEqual(cache_page.call_count, 1)
+
+    def test_first_page_from_cache(self, get_cached, cache_page):
+        get_cached.return_value = {'results': [], 'has_more': False, 'next_cursor': None}
+        with self.assertNumQueries(0):
+            self.assertEqual(feed.community_feed(self.community.id), get_cached.return_value)
+
+    def test_new_and_deleted_posts_invalidate_first_page(self, get_cached, cache_page):
+        with mock.patch.object(MongoCacheHelper, 'invalidate_community_feed') as invalidate:
+            with self.captureOnCommitCallbacks(execute=True):
+                post = Post.objects.create(author=self.owner, community=self.community, title='New', content='...')
+            with self.captureOnCommitCallbacks(execute=True):
+                Post.objects.create(author=self.owner, title='Personal', content='...')
+            with self.captureOnCommitCallbacks(execute=True):
+                post.delete()
+        self.assertEqual(invalidate.call_args_list, [mock.call(self.community.id), mock.call(self.community.id)])
+
+    def test_page_queries_do_not_grow_with_posts(self, get_cached, cache_page):
+        self.client.force_login(self.reader)
+        url = reverse('communities:community_detail', args=[self.community.id])
+
+        def render():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            return response, len(queries)
+
+        posts = self.create_posts(3)
+        _, small = render()
+
+        posts += self.create_posts(30)
+        PostLike.objects.create(user=self.reader, post=posts[-1])
+        FavouritePost.objects.create(user=self.reader, post=posts[-1])
+        response, large = render()
+
+        self.assertEqual(small, large)
+        self.assertEqual(len(response.context['posts']), feed.COMMUNITY_FEED_PAGE_SIZE)
+        self.assertEqual(response.context['user_favourite_ids'], {posts[-1].id})
+        self.assertContains(response, 'fas fa-bookmark')
+        self.assertContains(response, 'Показать еще')
+
+
+class MemberModerationTests(QueryPlanAssertionsMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username='owner', password='password')
+        cls.admin = User.objects.create_user(username='admin', password='password')
+        cls.moderator = User.objects.create_user(username='moderator', password='password')
+        cls.community = Community.objects.create(name='Optics', created_by=cls.owner)
+        CommunityMembership.objects.create(user=cls.owner, community=cls.community, role='admin')
+        CommunityMembership.objects.create(user=cls.admin, community=cls.community, role='admin')
+        CommunityMembership.objects.create(user=cls.moderator, community=cls.community, role='moderator')
+        cls.members = []
+        for index in range(6):
+            user = User.objects.create_user(username=f'member{index}', password='password',
+                                            last_name='Оптиков' if index % 2 else '')
+            CommunityMembership.objects.create(user=user, community=cls.community)
+            cls.members.append(user)
+
+    def bulk(self, data, **params):
+        url = reverse('communities:bulk_update_members', args=[self.community.id])
+        return self.client.post(f'{url}?{"&".join(f"{k}={v}" for k, v in params.items())}' if params else url, data)
+
+    def membership(self, user):
+        return CommunityMembership.objects.get(user=user, community=self.community)
+
+    def test_bulk_roles_and_removals(self):
+        self.client.force_login(self.admin)
+        data = {
+            f'role_{self.members[0].id}': 'moderator',
+            f'role_{self.members[1].id}': 'member',
+            f'role_{self.members[2].id}': 'admin',
+            f'role_{self.moderator.id}': 'member',
+            f'role_{self.owner.id}': 'member',
+            'remove': [self.members[2].id, self.members[3].id, self.owner.id],
+        }
+        with CaptureQueriesContext(connection) as queries:
+            response = self.bulk(data, role='member')
+        self.assertRedirects(
+            response, reverse('communities:community_members', args=[self.community.id]) + '?role=member',
+            fetch_redirect_response=False,
+        )
+
+        # Роли - один UPDATE, удаление - один DELETE
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE "communities_communitymembership"')]
+        deletes = [q['sql'] for q in queries if q['sql'].startswith('DELETE FROM "communities_communitymembership"')]
+        self.assertEqual((len(updates), len(deletes)), (1, 1))
+
+        self.assertEqual((self.membership(self.members[0]).role, self.membership(self.members[0]).is_moderator),
+                         ('moderator', True))
+        self.assertEqual((self.membership(self.moderator).role, self.membership(self.moderator).is_moderator),
+                         ('member', False))
+        # Создателя нельзя ни понизить, ни удалить
+        self.assertEqual(self.membership(self.owner).role, 'admin')
+        self.assertFalse(CommunityMembership.objects.filter(user__in=self.members[2:4]).exists())
+        self.community.refresh_from_db()
+        self.assertEqual(self.community.members_count, 7)
+
+    def test_bulk_requires_admin(self):
+        self.client.force_login(self.moderator)
+        self.bulk({f'role_{self.members[0].id}': 'admin', 'remove': [self.members[1].id]})
+        self.assertEqual(self.membership(self.members[0]).role, 'member')
+        self.assertTrue(CommunityMembership.objects.filter(user=self.members[1]).exists())
+
+    def test_member_list_filters_and_pages(self):
+        names, after = [], None
+        while True:
+            page = member_page(self.community.id, role='member', after=after, limit=4)
+            names += [membership.user.username for membership in page['results']]
+            if not page['has_more']:
+                break
+            after = page['next_cursor']
+        self.assertEqual(names, [user.username for user in self.members])
+
+        page = member_page(self.community.id, query='Оптиков')
+        self.assertEqual([m.user.username for m in page['results']], ['member1', 'member3', 'member5'])
+
+        self.client.force_login(self.moderator)
+        response = self.client.get(reverse('communities:community_members', args=[self.community.id]),
+                                   {'role': 'moderator'})
+        self.assertEqual([m.user_id for m in response.context['members']], [self.moderator.id])
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN доступен только в SQLite')
+    def test_role_filter_uses_index(self):
+        queryset = CommunityMembership.objects.filter(community=self.community, role='member', id__gt=0) \
+            .order_by('id')[:50]
+        self.assertNoFullScan(queryset)
+        self.assertUsesIndex(queryset, 'membership_community_role_idx')
+
+
+class ActivityRollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(username='owner', password='password')
+        cls.reader = User.objects.create_user(username='reader', password='password')
+        cls.physics = ScientificField.objects.create(name='Физика')
+        cls.community = Community.objects.create(name='Optics', created_by=cls.owner, scientific_field=cls.physics)
+
+    def setUp(self):
+        self.today = timezone.localdate()
+        CommunityMembership.objects.create(user=self.owner, community=self.community, role='admin')
+        self.post = Post.objects.create(author=self.owner, community=self.community, title='Laser', content='...')
+        Post.objects.create(author=self.owner, scientific_field=self.physics, title='Personal', content='...')
+        Post.objects.create(author=self.reader, title='Plain', content='...')
+        Comment.objects.create(post=self.post, author=self.reader, content='!')
+        PostLike.objects.create(post=self.post, user=self.reader)
+
+    def day(self, scope, scope_id, day=None):
+        day = day or self.today
+        return activity_series(scope, scope_id, day, day)[0]
+
+    def test_rollup_per_scope(self):
+        # Пост, созданный три дня назад, попадает в свой день
+        old = Post.objects.create(author=self.owner, community=self.community, title='Old', content='...')
+        Post.objects.filter(id=old.id).update(created_at=timezone.now() - timedelta(days=3))
+
+        self.assertEqual(rollup_activity(lag=0), {'posts': 4, 'comments': 1, 'likes': 1, 'new_members': 1})
+        self.assertEqual(self.day('community', self.community.id),
+                         {'day': self.today.isoformat(), 'posts': 1, 'comments': 1, 'likes': 1, 'new_members': 1})
+        self.assertEqual(self.day('field', self.physics.id)['posts'], 2)
+        self.assertEqual(self.day('field', self.physics.id)['new_members'], 1)
+        self.assertEqual(self.day('platform', 0)['posts'], 3)
+        self.assertEqual(self.day('community', self.community.id, self.today - timedelta(days=3))['posts'], 1)
+
+    def test_incremental_from_watermark(self):
+        rollup_activity(lag=0)
+        self.assertEqual(rollup_activity(lag=0), dict.fromkeys(['posts', 'comments', 'likes', 'new_members'], 0))
+
+        Comment.objects.create(post=self.post, author=self.owner, content='?')
+        CommunityMembership.objects.create(user=self.reader, community=self.community)
+        self.assertEqual(rollup_activity(lag=0, batch_size=1), {'posts': 0, 'comments': 1, 'likes': 0, 'new_members': 1})
+        today = self.day('community', self.community.id)
+        self.assertEqual((today['comments'], today['new_members']), (2, 2))
+
+    def test_recent_events_wait_for_lag(self):
+        self.assertEqual(rollup_activity(lag=3600)['posts'], 0)
+        self.assertFalse(ActivityWatermark.objects.filter(last_id__gt=0).exists())
+        self.assertEqual(rollup_activity(lag=0)['posts'], 3)
+
+    def test_watermark_stops_before_events_inside_lag(self):
+        # Пост с меньшим id, но моложе cutoff, не дает отметке уйти за него
+        Post.objects.filter(id=self.post.id).update(created_at=timezone.now() + timedelta(hours=1))
+        self.assertEqual(rollup_activity(lag=0)['posts'], 0)
+        self.assertEqual(ActivityWatermark.objects.get(source='posts').last_id, 0)
+
+        Post.objects.filter(id=self.post.id).update(created_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(rollup_activity(lag=0)['posts'], 3)
+
+    def test_series_reads_one_row_per_day(self):
+        rollup_activity(lag=0)
+        with self.assertNumQueries(1):
+            series = activity_series('community', self.community.id, self.today - timedelta(days=29), self.today)
+        self.assertEqual(len(series), 30)
+        self.assertEqual(series[-1]['posts'], 1)
+        self.assertEqual(sum(day['posts'] for day in series[:-1]), 0)
+
+    def test_activity_endpoints(self):
+        rollup_activity(lag=0)
+        self.client.force_login(self.reader)
+        data = self.client.get(reverse('communities:community_activity', args=[self.community.id]),
+                               {'days': 7}).json()
+        self.assertEqual(len(data['series']), 7)
+        self.assertEqual(data['series'][-1]['likes'], 1)
 
-# Create your tests here.
+        # Тренды платформы и научных областей - только для администраторов
+        self.assertEqual(self.client.get(reverse('communities:activity_trends')).status_code, 302)
+        User.objects.filter(id=self.reader.id).update(is_staff=True)
+        data = self.client.get(reverse('communities:activity_trends'), {'field': self.physics.id, 'days': 1}).json()
+        self.assertEqual((data['scope'], data['series'][0]['posts']), ('field', 2))
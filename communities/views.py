@@ -1,28 +1,52 @@
+from datetime import timedelta
+
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db import models
+from django.contrib.admin.views.decorators import staff_member_required
 from django.http import JsonResponse
+from django.utils import timezone
+from .activity import activity_series
+from .directory import DEFAULT_SORT, SORT_CHOICES, SORTS, community_directory
+from .feed import community_feed, favourite_post_ids
+from .members import apply_member_changes, member_page
 from .models import Community, CommunityMembership
+from .permissions import get_community_roles
 from .forms import CommunityForm, CommunitySettingsForm, RoleChangeForm
+from posts.engagement import apply_buffered
 from posts.models import Post
 from posts.forms import PostForm
+from users.models import ScientificField
 
 
 @login_required
 def community_list(request):
-    """Список всех сообществ"""
-    communities = Community.objects.all().annotate(
-        members_count=models.Count('members'),
-        posts_count=models.Count('posts')
+    """Каталог сообществ: сортировка по размеру, активности или названию и фильтр по научной области"""
+    sort = request.GET.get('sort', DEFAULT_SORT)
+    try:
+        scientific_field_id = int(request.GET.get('field', ''))
+    except ValueError:
+        scientific_field_id = None
+
+    page = community_directory(sort, scientific_field_id, after=request.GET.get('after'))
+
+    # Сообщества, в которых состоит пользователь, вместе с его ролью - одним запросом
+    memberships = list(
+        CommunityMembership.objects.filter(user=request.user)
+        .select_related('community__scientific_field').order_by('-date_joined')
     )
 
-    # Сообщества, в которых состоит пользователь
-    user_communities = request.user.communities_joined.all() if request.user.is_authenticated else []
-
     context = {
-        'communities': communities,
-        'user_communities': user_communities,
+        'communities': page['results'],
+        'has_more': page['has_more'],
+        'next_cursor': page['next_cursor'],
+        'memberships': memberships,
+        'user_community_ids': {membership.community_id for membership in memberships},
+        'scientific_fields': ScientificField.objects.all(),
+        'sorts': SORT_CHOICES,
+        'current_sort': sort if sort in SORTS else DEFAULT_SORT,
+        'current_field': scientific_field_id,
     }
 
     return render(request, 'communities/community_list.html', context)
@@ -56,33 +80,31 @@ def community_create(request):
 @login_required
 def community_detail(request, community_id):
     """Детальная страница сообщества"""
-    community = get_object_or_404(Community, id=community_id)
-    posts = community.posts.all().order_by('-created_at')
+    community = get_object_or_404(Community.objects.select_related('created_by__profile'), id=community_id)
 
-    # Информация о членстве пользователя
-    is_member = community.is_member(request.user)
-    membership = None
-    user_role = None
+    # Лента постами по курсору: одна страница с авторами и счетчиками, первая - из кэша
+    feed = community_feed(community.id, after=request.GET.get('after'))
 
-    if is_member:
-        membership = CommunityMembership.objects.filter(user=request.user, community=community).first()
-        user_role = membership.role
-
-    # Проверка прав
-    can_edit = community.is_creator(request.user) or user_role in ['admin', 'moderator']
-    can_manage_members = community.is_creator(request.user) or user_role == 'admin'
+    # Членство и права пользователя - из ролей, загруженных одним запросом
+    roles = get_community_roles(request)
 
     # Форма для поста
     post_form = PostForm()
 
+    # Лайки и избранное из буфера, еще не перенесенные в БД
+    _, favourite_ids = apply_buffered(feed['results'], request.user.id,
+                                      favourite_post_ids(request.user, feed['results']))
+
     context = {
         'community': community,
-        'posts': posts,
-        'is_member': is_member,
-        'membership': membership,
-        'user_role': user_role,
-        'can_edit': can_edit,
-        'can_manage_members': can_manage_members,
+        'posts': feed['results'],
+        'has_more': feed['has_more'],
+        'next_cursor': feed['next_cursor'],
+        'user_favourite_ids': favourite_ids,
+        'is_member': roles.is_member(community),
+        'user_role': roles.role(community),
+        'can_edit': roles.can_edit(community),
+        'can_manage_members': roles.can_manage_members(community),
         'post_form': post_form,
     }
 
@@ -95,7 +117,7 @@ def community_edit(request, community_id):
     community = get_object_or_404(Community, id=community_id)
 
     # Проверка прав
-    if not (community.is_creator(request.user) or community.is_moderator(request.user)):
+    if not get_community_roles(request).can_edit(community):
         messages.error(request, 'У вас нет прав для редактирования этого сообщества!')
         return redirect('communities:community_detail', community_id=community.id)
 
@@ -122,7 +144,7 @@ def community_join(request, community_id):
     """Вступление в сообщество"""
     community = get_object_or_404(Community, id=community_id)
 
-    if community.is_member(request.user):
+    if get_community_roles(request).is_member(community):
         messages.info(request, 'Вы уже состоите в этом сообществе!')
     else:
         CommunityMembership.objects.create(user=request.user, community=community)
@@ -139,7 +161,7 @@ def community_leave(request, community_id):
 
     if membership:
         # Создатель не может покинуть сообщество
-        if community.is_creator(request.user):
+        if get_community_roles(request).is_creator(community):
             messages.error(request, 'Создатель не может покинуть сообщество! Передайте права другому администратору.')
         else:
             membership.delete()
@@ -156,17 +178,34 @@ def community_members(request, community_id):
     community = get_object_or_404(Community, id=community_id)
 
     # Проверка прав
-    if not (community.is_creator(request.user) or community.is_moderator(request.user)):
+    roles = get_community_roles(request)
+    if not roles.can_edit(community):
         messages.error(request, 'У вас нет прав для управления участниками!')
         return redirect('communities:community_detail', community_id=community.id)
 
-    members = CommunityMembership.objects.filter(community=community).select_related('user')
+    # Фильтры и страница списка - на стороне сервера
+    role = request.GET.get('role', '')
+    if role not in dict(CommunityMembership.ROLE_CHOICES):
+        role = ''
+    query = request.GET.get('q', '').strip()
+    try:
+        after = int(request.GET.get('after', 0))
+    except ValueError:
+        after = 0
+
+    page = member_page(community.id, role=role, query=query, after=after)
     role_form = RoleChangeForm()
 
     context = {
         'community': community,
-        'members': members,
+        'members': page['results'],
+        'has_more': page['has_more'],
+        'next_cursor': page['next_cursor'],
+        'role_choices': CommunityMembership.ROLE_CHOICES,
+        'current_role': role,
+        'query': query,
         'role_form': role_form,
+        'can_manage_members': roles.can_manage_members(community),
     }
 
     return render(request, 'communities/community_members.html', context)
@@ -183,13 +222,12 @@ def change_member_role(request, community_id, user_id):
             return redirect('communities:community_members', community_id=community.id)
 
         # Только создатель или администраторы могут менять роли
-        if not (community.is_creator(request.user) or
-                CommunityMembership.objects.get(user=request.user, community=community).role == 'admin'):
+        if not get_community_roles(request).can_manage_members(community):
             messages.error(request, 'У вас нет прав для изменения ролей!')
             return redirect('communities:community_members', community_id=community.id)
 
         # Создателя нельзя изменить
-        if community.is_creator(target_user.user):
+        if community.created_by_id == target_user.user_id:
             messages.error(request, 'Нельзя изменить роль создателя сообщества!')
             return redirect('communities:community_members', community_id=community.id)
 
@@ -208,8 +246,7 @@ def remove_member(request, community_id, user_id):
         community = get_object_or_404(Community, id=community_id)
 
         # Проверка прав
-        if not (community.is_creator(request.user) or
-                CommunityMembership.objects.get(user=request.user, community=community).role == 'admin'):
+        if not get_community_roles(request).can_manage_members(community):
             messages.error(request, 'У вас нет прав для удаления участников!')
             return redirect('communities:community_members', community_id=community.id)
 
@@ -219,7 +256,7 @@ def remove_member(request, community_id, user_id):
             return redirect('communities:community_members', community_id=community.id)
 
         # Создателя нельзя удалить
-        if community.is_creator(target_membership.user):
+        if community.created_by_id == target_membership.user_id:
             messages.error(request, 'Нельзя удалить создателя сообщества!')
         else:
             target_membership.delete()
@@ -228,13 +265,41 @@ def remove_member(request, community_id, user_id):
     return redirect('communities:community_members', community_id=community.id)
 
 
+@login_required
+def bulk_update_members(request, community_id):
+    """Массовая смена ролей и удаление участников одной формой"""
+    community = get_object_or_404(Community, id=community_id)
+    members_url = reverse('communities:community_members', args=[community.id])
+    if request.GET:
+        # Возвращаемся на ту же страницу списка с теми же фильтрами
+        members_url = f'{members_url}?{request.GET.urlencode()}'
+
+    if request.method == 'POST':
+        if not get_community_roles(request).can_manage_members(community):
+            messages.error(request, 'У вас нет прав для управления участниками!')
+            return redirect(members_url)
+
+        # Поля role_<id пользователя> и список remove из формы списка участников
+        valid_roles = dict(CommunityMembership.ROLE_CHOICES)
+        roles = {
+            int(key[len('role_'):]): value for key, value in request.POST.items()
+            if key.startswith('role_') and key[len('role_'):].isdigit() and value in valid_roles
+        }
+        remove_user_ids = [int(user_id) for user_id in request.POST.getlist('remove') if user_id.isdigit()]
+
+        changed, removed = apply_member_changes(community, roles, remove_user_ids)
+        messages.success(request, f'Изменено ролей: {changed}, удалено участников: {removed}')
+
+    return redirect(members_url)
+
+
 @login_required
 def create_community_post(request, community_id):
     """Создание поста в сообществе"""
     community = get_object_or_404(Community, id=community_id)
 
     # Проверка, что пользователь является участником
-    if not community.is_member(request.user):
+    if not get_community_roles(request).is_member(community):
         messages.error(request, 'Вы должны быть участником сообщества, чтобы публиковать посты!')
         return redirect('communities:community_detail', community_id=community.id)
 
@@ -250,3 +315,38 @@ def create_community_post(request, community_id):
             messages.error(request, 'Ошибка при создании поста!')
 
     return redirect('communities:community_detail', community_id=community.id)
+
+
+ACTIVITY_DEFAULT_DAYS = 30
+
+
+def _activity_response(request, scope, scope_id):
+    """JSON: дневной ряд активности за последние ?days= дней из агрегатов"""
+    try:
+        days = min(max(int(request.GET.get('days', ACTIVITY_DEFAULT_DAYS)), 1), 365)
+    except ValueError:
+        days = ACTIVITY_DEFAULT_DAYS
+    end = timezone.localdate()
+    start = end - timedelta(days=days - 1)
+    return JsonResponse({
+        'scope': scope,
+        'id': scope_id,
+        'series': activity_series(scope, scope_id, start, end),
+    })
+
+
+@login_required
+def community_activity(request, community_id):
+    """Тренды активности сообщества: публикации, комментарии, лайки и новые участники по дням"""
+    community = get_object_or_404(Community, id=community_id)
+    return _activity_response(request, 'community', community.id)
+
+
+@staff_member_required
+def activity_trends(request):
+    """Тренды активности платформы или научной области (?field=) для администраторов"""
+    try:
+        field_id = int(request.GET.get('field', ''))
+    except ValueError:
+        return _activity_response(request, 'platform', 0)
+    return _activity_response(request, 'field', field_id)
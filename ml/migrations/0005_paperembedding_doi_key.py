@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 12:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ml', '0004_mlmodelversion_experiment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paperembedding',
+            name='doi_key',
+            field=models.CharField(blank=True, editable=False, max_length=100, null=True, unique=True, verbose_name='Ключ DOI'),
+        ),
+    ]
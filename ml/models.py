@@ -1,6 +1,8 @@
 from django.db import models
 from django.conf import settings
 
+from utils.doi import normalize_doi
+
 class UserEmbedding(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='embedding', verbose_name="Пользователь")
     embedding_vector = models.TextField(verbose_name="Вектор эмбеддинга")
@@ -15,6 +17,9 @@ class UserEmbedding(models.Model):
 
 class PaperEmbedding(models.Model):
     doi = models.CharField(max_length=100, unique=True, verbose_name="DOI")
+    # Нормализованный DOI: «https://doi.org/10.1000/X» и «10.1000/x» - одна статья
+    doi_key = models.CharField(max_length=100, unique=True, null=True, blank=True, editable=False,
+                               verbose_name="Ключ DOI")
     title = models.CharField(max_length=255, verbose_name="Название")
     embedding_vector = models.TextField(verbose_name="Вектор эмбеддинга")
     scientific_field = models.ForeignKey('users.ScientificField', on_delete=models.CASCADE, verbose_name="Научная область")
@@ -27,6 +32,17 @@ class PaperEmbedding(models.Model):
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        # Ключ уникален: если его уже занимает другая статья, запись остается без ключа (как в backfill_doi_keys)
+        doi_key = normalize_doi(self.doi)
+        if doi_key and PaperEmbedding.objects.filter(doi_key=doi_key).exclude(pk=self.pk).exists():
+            doi_key = None
+        self.doi_key = doi_key
+        if kwargs.get('update_fields') is not None and 'doi' in kwargs['update_fields']:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'doi_key'}
+        super().save(*args, **kwargs)
+
+
 class Recommendation(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='recommendations', verbose_name="Пользователь")
     recommended_user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='recommended_to', verbose_name="Рекомендованный пользователь")
@@ -0,0 +1,244 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.http import Http404
+from pymongo import ReturnDocument
+
+from utils.mongo_cache import cache
+from users.models import UserStats
+from .models import Post, PostLike, FavouritePost
+
+
+class EngagementBuffer:
+    """
+    Буферизированная запись лайков и избранного.
+
+    Переключение выполняется одним атомарным обновлением в MongoDB, событие
+    дописывается в журнал, а клиент сразу получает значение атомарного
+    счетчика. В реляционную БД журнал переносится пачками через flush().
+
+    Документы состояния и счетчиков истекают через ttl секунд без
+    переключений и затем заново инициализируются из БД. Поэтому flush()
+    должен успевать переносить журнал намного быстрее ttl (воркер
+    flush_engagement --loop). До переноса страницы показывают значения
+    буфера через apply_buffered().
+    """
+
+    KINDS = {
+        'like': (PostLike, 'likes_count'),
+        'favourite': (FavouritePost, 'favourites_count'),
+    }
+
+    def __init__(self, database, ttl=None):
+        self.ttl = ttl or getattr(settings, 'ENGAGEMENT_STATE_TTL', 86400)
+        self.state = database['engagement_state']
+        self.counters = database['engagement_counters']
+        self.events = database['engagement_events']
+        self.state.create_index('expires', expireAfterSeconds=0)
+        self.counters.create_index('expires', expireAfterSeconds=0)
+
+    def toggle(self, kind, post_id, user_id):
+        """Переключить реакцию пользователя; вернуть (активна ли она, новое значение счетчика)"""
+        active, flips = self._flip(kind, post_id, user_id)
+        count = self._increment(kind, post_id, 1 if active else -1)
+        self.events.insert_one(
+            {'kind': kind, 'post_id': post_id, 'user_id': user_id, 'active': active, 'flips': flips}
+        )
+        return active, count
+
+    def _expires(self):
+        return datetime.utcnow() + timedelta(seconds=self.ttl)
+
+    def _flip(self, kind, post_id, user_id):
+        # Состояние = (initial + flips) % 2, поэтому переключение - это один $inc.
+        # Возвращает (состояние, flips): flips задает порядок событий пары
+        key = self._state_key(kind, post_id, user_id)
+        doc = self.state.find_one_and_update(
+            {'_id': key}, {'$inc': {'flips': 1}, '$set': {'expires': self._expires()}},
+            return_document=ReturnDocument.AFTER
+        )
+        if doc is None:
+            # Первое переключение: берем исходное состояние из БД. При гонке
+            # $setOnInsert сработает один раз, а оба $inc будут учтены
+            model, _ = self.KINDS[kind]
+            if not Post.objects.filter(id=post_id).exists():
+                raise Http404("Публикация не найдена")
+            initial = int(model.objects.filter(post_id=post_id, user_id=user_id).exists())
+            doc = self.state.find_one_and_update(
+                {'_id': key},
+                {'$setOnInsert': {'initial': initial}, '$inc': {'flips': 1}, '$set': {'expires': self._expires()}},
+                upsert=True, return_document=ReturnDocument.AFTER
+            )
+        return (doc['initial'] + doc['flips']) % 2 == 1, doc['flips']
+
+    def _increment(self, kind, post_id, delta):
+        key = f'{kind}:{post_id}'
+        doc = self.counters.find_one_and_update(
+            {'_id': key}, {'$inc': {'delta': delta}, '$set': {'expires': self._expires()}},
+            return_document=ReturnDocument.AFTER
+        )
+        if doc is None:
+            # Первое переключение для поста: все более ранние реакции уже в БД
+            model, _ = self.KINDS[kind]
+            base = model.objects.filter(post_id=post_id).count()
+            doc = self.counters.find_one_and_update(
+                {'_id': key},
+                {'$setOnInsert': {'base': base}, '$inc': {'delta': delta}, '$set': {'expires': self._expires()}},
+                upsert=True, return_document=ReturnDocument.AFTER
+            )
+        return max(doc['base'] + doc['delta'], 0)
+
+    def flush(self, batch_size=1000):
+        """Перенести пачку событий в БД; вернуть количество обработанных событий"""
+        events = list(self.events.find().sort('_id', 1).limit(batch_size))
+        if not events:
+            return 0
+
+        # Для каждой пары пост-пользователь важно только последнее состояние. Порядок задает
+        # счетчик переключений пары, а не _id: ObjectId разных процессов упорядочены лишь по их часам.
+        # События не новее уже перенесенного состояния (отставшие в прошлых пачках) пропускаются
+        latest = {}
+        for event in events:
+            pair = (event['kind'], event['post_id'], event['user_id'])
+            if pair not in latest or event['flips'] > latest[pair]['flips']:
+                latest[pair] = event
+        flushed = {
+            doc['_id']: doc.get('flushed', 0)
+            for doc in self.state.find({'_id': {'$in': [self._state_key(*pair) for pair in latest]}}, {'flushed': 1})
+        }
+        final_state = {
+            pair: event['active'] for pair, event in latest.items()
+            if event['flips'] > flushed.get(self._state_key(*pair), 0)
+        }
+
+        touched = defaultdict(set)
+        with transaction.atomic():
+            # id существующих постов -> автор (для статистики полученных лайков)
+            existing_posts = dict(Post.objects.filter(
+                id__in={post_id for _, post_id, _ in final_state}
+            ).values_list('id', 'author_id'))
+
+            for kind, (model, counter_field) in self.KINDS.items():
+                added = []
+                removed = defaultdict(set)
+                for (event_kind, post_id, user_id), active in final_state.items():
+                    if event_kind != kind or post_id not in existing_posts:
+                        continue
+                    touched[kind].add(post_id)
+                    if active:
+                        added.append(model(post_id=post_id, user_id=user_id))
+                    else:
+                        removed[post_id].add(user_id)
+
+                before = self._counts(model, touched[kind]) if kind == 'like' else None
+                model.objects.bulk_create(added, ignore_conflicts=True)
+                if removed:
+                    condition = Q()
+                    for post_id, user_ids in removed.items():
+                        condition |= Q(post_id=post_id, user_id__in=user_ids)
+                    model.objects.filter(condition).delete()
+
+                after = self._sync_counters(model, counter_field, touched[kind])
+                if kind == 'like':
+                    # Разница фактических количеств, а не событий: повторные и отмененные лайки не искажают счетчик
+                    received = defaultdict(int)
+                    for post_id in touched[kind]:
+                        received[existing_posts[post_id]] += after.get(post_id, 0) - before.get(post_id, 0)
+                    UserStats.increment('likes_received', received)
+
+        # Отметка перенесенного состояния; пары группируются по flips, значений обычно немного
+        by_flips = defaultdict(list)
+        for pair in final_state:
+            by_flips[latest[pair]['flips']].append(self._state_key(*pair))
+        for flips, keys in by_flips.items():
+            self.state.update_many({'_id': {'$in': keys}}, {'$max': {'flushed': flips}})
+        self.events.delete_many({'_id': {'$in': [event['_id'] for event in events]}})
+        return len(events)
+
+    @staticmethod
+    def _state_key(kind, post_id, user_id):
+        return f'{kind}:{post_id}:{user_id}'
+
+    @staticmethod
+    def _counts(model, post_ids):
+        """{id поста: количество реакций} одним запросом"""
+        if not post_ids:
+            return {}
+        return dict(
+            model.objects.filter(post_id__in=post_ids).order_by()
+            .values('post_id').annotate(total=Count('id')).values_list('post_id', 'total')
+        )
+
+    @classmethod
+    def _sync_counters(cls, model, counter_field, post_ids):
+        """Пересчитать денормализованные счетчики затронутых постов одним запросом; вернуть их"""
+        counts = cls._counts(model, post_ids)
+        posts = [Post(id=post_id, **{counter_field: counts.get(post_id, 0)}) for post_id in post_ids]
+        Post.objects.bulk_update(posts, [counter_field], batch_size=500)
+        return counts
+
+    def pending_count(self):
+        return self.events.count_documents({})
+
+    def buffered(self, post_ids, user_id=None):
+        """
+        Значения буфера для постов страницы, еще не обязательно перенесенные в БД.
+
+        Возвращает ({(вид, id поста): счетчик}, {(вид, id поста): активна ли
+        реакция user_id}); посты без переключений в буфере не попадают.
+        Два запроса к MongoDB независимо от размера страницы.
+        """
+        post_ids = list(post_ids)
+        if not post_ids:
+            return {}, {}
+        counts = {}
+        for doc in self.counters.find({'_id': {'$in': [f'{kind}:{post_id}' for kind in self.KINDS
+                                                        for post_id in post_ids]}}):
+            kind, post_id = doc['_id'].split(':')
+            counts[kind, int(post_id)] = max(doc['base'] + doc['delta'], 0)
+
+        states = {}
+        if user_id:
+            keys = [self._state_key(kind, post_id, user_id) for kind in self.KINDS for post_id in post_ids]
+            for doc in self.state.find({'_id': {'$in': keys}}, {'initial': 1, 'flips': 1}):
+                kind, post_id, _ = doc['_id'].split(':')
+                states[kind, int(post_id)] = (doc['initial'] + doc['flips']) % 2 == 1
+        return counts, states
+
+
+engagement_buffer = EngagementBuffer(cache._collection.database)
+
+
+def apply_buffered(posts, user_id=None, favourite_ids=(), buffer=None):
+    """
+    Подставить в посты страницы лайки и избранное из буфера.
+
+    posts - объекты Post или карточки-словари ленты сообщества, их like_count
+    и favourite_count заменяются значениями буфера. favourite_ids - избранное
+    зрителя по БД, к нему применяются его непереданные переключения.
+    Возвращает (список постов, множество id избранных постов).
+    """
+    buffer = buffer or engagement_buffer
+    posts = list(posts)
+    post_ids = [post['id'] if isinstance(post, dict) else post.id for post in posts]
+    counts, states = buffer.buffered(post_ids, user_id)
+
+    for post, post_id in zip(posts, post_ids):
+        for kind, field in (('like', 'like_count'), ('favourite', 'favourite_count')):
+            if (kind, post_id) in counts:
+                if isinstance(post, dict):
+                    post[field] = counts[kind, post_id]
+                else:
+                    setattr(post, field, counts[kind, post_id])
+
+    favourite_ids = set(favourite_ids)
+    for (kind, post_id), active in states.items():
+        if kind == 'favourite':
+            if active:
+                favourite_ids.add(post_id)
+            else:
+                favourite_ids.discard(post_id)
+    return posts, favourite_ids
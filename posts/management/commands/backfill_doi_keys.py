@@ -0,0 +1,83 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ml.models import PaperEmbedding
+from posts.models import Post
+from utils.doi import normalize_doi
+
+
+class Command(BaseCommand):
+    help = 'Fill normalized DOI keys of existing posts and paper embeddings'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=2000,
+            help='Rows per transaction'
+        )
+
+    def handle(self, *args, **options):
+        updated = self._backfill(Post, options['batch_size'])
+        self.stdout.write(f"Posts updated: {updated}")
+
+        updated, duplicates = self._backfill_papers(options['batch_size'])
+        self.stdout.write(f"Paper embeddings updated: {updated}")
+        if duplicates:
+            self.stdout.write(self.style.WARNING(
+                f"Paper embeddings left without a key, their DOI duplicates another paper: {duplicates}"
+            ))
+        self.stdout.write(self.style.SUCCESS("DOI keys are up to date"))
+
+    @staticmethod
+    def _chunks(model, batch_size):
+        """Строки (id, doi, doi_key) пачками по возрастанию id"""
+        last_id = 0
+        while True:
+            rows = list(
+                model.objects.filter(id__gt=last_id).order_by('id')
+                .values_list('id', 'doi', 'doi_key')[:batch_size]
+            )
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield rows
+
+    def _backfill(self, model, batch_size):
+        updated = 0
+        for rows in self._chunks(model, batch_size):
+            changed = [
+                model(id=row_id, doi_key=normalize_doi(doi))
+                for row_id, doi, doi_key in rows if normalize_doi(doi) != doi_key
+            ]
+            model.objects.bulk_update(changed, ['doi_key'], batch_size=500)
+            updated += len(changed)
+        return updated
+
+    def _backfill_papers(self, batch_size):
+        # Ключ уникален: статья, уже получившая ключ, сохраняет его, дубликаты остаются без ключа
+        updated = duplicates = 0
+        for rows in self._chunks(PaperEmbedding, batch_size):
+            keys = {row_id: normalize_doi(doi) for row_id, doi, _ in rows}
+            with transaction.atomic():
+                owners = dict(
+                    PaperEmbedding.objects.filter(doi_key__in={key for key in keys.values() if key})
+                    .exclude(id__in=keys).values_list('doi_key', 'id')
+                )
+                changed = []
+                for row_id, _, doi_key in rows:
+                    key = keys[row_id]
+                    if key and owners.get(key, row_id) != row_id:
+                        duplicates += 1
+                        key = None
+                    elif key:
+                        owners[key] = row_id
+                    if key != doi_key:
+                        changed.append(PaperEmbedding(id=row_id, doi_key=key))
+
+                # Сначала освобождаем старые ключи, чтобы обмен ключами не нарушил уникальность
+                PaperEmbedding.objects.filter(id__in=[paper.id for paper in changed]).update(doi_key=None)
+                PaperEmbedding.objects.bulk_update([paper for paper in changed if paper.doi_key], ['doi_key'],
+                                                   batch_size=500)
+            updated += len(changed)
+        return updated, duplicates
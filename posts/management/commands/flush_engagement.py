@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+from posts.engagement import engagement_buffer
+
+
+class Command(BaseCommand):
+    help = 'Flush buffered likes and favourites to the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Events per transaction'
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help='Run as a background worker'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=1.0,
+            help='Seconds to sleep when the buffer is empty (with --loop)'
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            flushed = 0
+            while True:
+                processed = engagement_buffer.flush(batch_size=options['batch_size'])
+                flushed += processed
+                if processed < options['batch_size']:
+                    break
+
+            if flushed:
+                self.stdout.write(f"Flushed {flushed} engagement events")
+
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Pending events: {engagement_buffer.pending_count()}")
+        )
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from posts.search import REBUILD_CHUNK_SIZE, rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the post search index in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=REBUILD_CHUNK_SIZE,
+            help='Posts per transaction'
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            self.stdout.write("Post search index is only available on SQLite, nothing to rebuild")
+            return
+
+        started = time.perf_counter()
+        total = 0
+        for total in rebuild_index(chunk_size=options['chunk_size']):
+            self.stdout.write(f"Indexed {total} posts")
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Rebuilt post search index: {total} posts in {time.perf_counter() - started:.1f} s")
+        )
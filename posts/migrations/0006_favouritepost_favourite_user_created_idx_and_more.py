@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-19 11:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0005_favouritepost'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='favouritepost',
+            index=models.Index(fields=['user', 'created_at'], name='favourite_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['community', 'created_at'], name='post_community_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(('community__isnull', True)), fields=['author', 'created_at'], name='post_author_personal_idx'),
+        ),
+    ]
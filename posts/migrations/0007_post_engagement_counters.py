@@ -0,0 +1,41 @@
+# Generated by Django 4.2.7 on 2026-10-19 11:19
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_engagement_counters(apps, schema_editor):
+    Post = apps.get_model('posts', 'Post')
+    PostLike = apps.get_model('posts', 'PostLike')
+    FavouritePost = apps.get_model('posts', 'FavouritePost')
+
+    def count_per_post(model):
+        counts = model.objects.filter(post=OuterRef('pk')).order_by().values('post').annotate(total=Count('*'))
+        return Coalesce(Subquery(counts.values('total')), 0)
+
+    Post.objects.update(
+        likes_count=count_per_post(PostLike),
+        favourites_count=count_per_post(FavouritePost),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0006_favouritepost_favourite_user_created_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='favourites_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Добавлений в избранное'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='likes_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Количество лайков'),
+        ),
+        migrations.RunPython(backfill_engagement_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,79 @@
+from django.db import migrations
+
+
+# Индекс хранит собственную копию текста, rowid строки индекса = id поста.
+# Колонка tags содержит служебные токены фильтров (typearticle, field12,
+# community5): фильтрация идет пересечением списков индекса, а не JOIN.
+# Триггеры держат индекс в актуальном состоянии при любых изменениях постов,
+# в том числе при каскадном удалении и SET_NULL научной области.
+INDEX_ROW_SQL = """
+    SELECT {row}.id, {row}.title, {row}.content, COALESCE({row}.doi, ''),
+           'type' || {row}.post_type
+           || ' field' || COALESCE({row}.scientific_field_id, 0)
+           || ' community' || COALESCE({row}.community_id, 0)
+"""
+
+FTS_SQL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS posts_post_fts USING fts5(
+        title, content, doi, tags,
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS posts_post_fts_insert AFTER INSERT ON posts_post BEGIN
+        INSERT OR REPLACE INTO posts_post_fts(rowid, title, content, doi, tags)
+        {INDEX_ROW_SQL.format(row='new')};
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS posts_post_fts_update
+    AFTER UPDATE OF title, content, doi, post_type, scientific_field_id, community_id ON posts_post BEGIN
+        INSERT OR REPLACE INTO posts_post_fts(rowid, title, content, doi, tags)
+        {INDEX_ROW_SQL.format(row='new')};
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS posts_post_fts_delete AFTER DELETE ON posts_post BEGIN
+        DELETE FROM posts_post_fts WHERE rowid = old.id;
+    END
+    """,
+    f"""
+    INSERT INTO posts_post_fts(rowid, title, content, doi, tags)
+    {INDEX_ROW_SQL.format(row='p')} FROM posts_post p
+    """,
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS posts_post_fts_delete",
+    "DROP TRIGGER IF EXISTS posts_post_fts_update",
+    "DROP TRIGGER IF EXISTS posts_post_fts_insert",
+    "DROP TABLE IF EXISTS posts_post_fts",
+]
+
+
+def _execute_on_sqlite(schema_editor, statements):
+    # FTS5 есть только в SQLite; на других СУБД поиск работает без индекса
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def create_post_fts(apps, schema_editor):
+    _execute_on_sqlite(schema_editor, FTS_SQL)
+
+
+def drop_post_fts(apps, schema_editor):
+    _execute_on_sqlite(schema_editor, DROP_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0007_post_engagement_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_post_fts, drop_post_fts),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.7 on 2026-10-19 12:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0008_post_fts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='doi_key',
+            field=models.CharField(blank=True, editable=False, max_length=100, null=True, verbose_name='Ключ DOI'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(('doi_key__isnull', False)), fields=['doi_key', 'created_at'], name='post_doi_key_idx'),
+        ),
+    ]
@@ -1,6 +1,35 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
 from django.conf import settings
 
+from users.models import UserStats
+from utils.doi import normalize_doi
+from utils.mongo_cache import MongoCacheHelper
+
+
+def _count_per_post(model):
+    """Количество связанных с постом строк коррелированным подзапросом по индексу post_id"""
+    counts = model.objects.filter(post=OuterRef('pk')).order_by().values('post').annotate(total=Count('*'))
+    return Coalesce(Subquery(counts.values('total')), 0)
+
+
+class PostQuerySet(models.QuerySet):
+    def with_engagement(self):
+        """
+        Аннотировать посты счетчиками лайков, комментариев и избранного.
+
+        Лайки и избранное читаются из денормализованных счетчиков поста,
+        комментарии - подзапросом. В отличие от Count по JOIN строки не
+        перемножаются и GROUP BY не нужен, поэтому планировщик может
+        использовать индексы фильтров.
+        """
+        return self.annotate(
+            like_count=F('likes_count'),
+            comment_count=_count_per_post(Comment),
+            favourite_count=F('favourites_count'),
+        )
+
 
 class Post(models.Model):
     POST_TYPES = (
@@ -21,20 +50,70 @@ class Post(models.Model):
     community = models.ForeignKey('communities.Community', on_delete=models.CASCADE, null=True, blank=True,
                                   related_name='posts', verbose_name="Сообщество")
     doi = models.CharField(max_length=100, blank=True, null=True, verbose_name="DOI")
+    # Нормализованный DOI (utils.doi.normalize_doi): все обсуждения одной статьи - один поиск по индексу
+    doi_key = models.CharField(max_length=100, blank=True, null=True, editable=False, verbose_name="Ключ DOI")
+    likes_count = models.PositiveIntegerField(default=0, verbose_name="Количество лайков")
+    favourites_count = models.PositiveIntegerField(default=0, verbose_name="Добавлений в избранное")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
 
+    objects = PostQuerySet.as_manager()
+
     class Meta:
         verbose_name = "Публикация"
         verbose_name_plural = "Публикации"
         ordering = ['-created_at']
+        indexes = [
+            # Посты сообществ в ленте и на странице сообщества
+            models.Index(fields=['community', 'created_at'], name='post_community_created_idx'),
+            # Посты друзей вне сообществ в ленте
+            models.Index(fields=['author', 'created_at'], name='post_author_personal_idx',
+                         condition=models.Q(community__isnull=True)),
+            # Страница статьи: все посты с этим DOI
+            models.Index(fields=['doi_key', 'created_at'], name='post_doi_key_idx',
+                         condition=models.Q(doi_key__isnull=False)),
+        ]
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        self.doi_key = normalize_doi(self.doi)
+        if kwargs.get('update_fields') is not None and 'doi' in kwargs['update_fields']:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'doi_key'}
+        created = self._state.adding
+        super().save(*args, **kwargs)
+        if created:
+            UserStats.increment('posts_count', {self.author_id: 1})
+        if created and self.community_id:
+            from communities.models import Community
+            Community.record_post(self)
+            self._invalidate_community_feed()
+
+    def delete(self, *args, **kwargs):
+        # Комментарии и лайки удаляются каскадом, минуя свои delete(): учитываем их в статистике здесь
+        comment_authors = dict(
+            self.comments.order_by().values('author_id').annotate(total=Count('id')).values_list('author_id', 'total')
+        )
+        likes = self.post_likes.count()
+        result = super().delete(*args, **kwargs)
+        UserStats.increment('posts_count', {self.author_id: -1})
+        UserStats.increment('likes_received', {self.author_id: -likes})
+        UserStats.increment('comments_count', {author_id: -total for author_id, total in comment_authors.items()})
+        if self.community_id:
+            from communities.models import Community
+            Community.objects.filter(id=self.community_id).update(posts_count=Greatest(F('posts_count') - 1, 0))
+            self._invalidate_community_feed()
+        return result
+
+    def _invalidate_community_feed(self):
+        # Кэшируется только первая страница ленты сообщества: ее и затрагивает новый или удаленный пост
+        community_id = self.community_id
+        transaction.on_commit(lambda: MongoCacheHelper.invalidate_community_feed(community_id))
+
     def like_count(self):
         """Количество лайков у поста"""
-        return self.post_likes.count()
+        return self.likes_count
 
     def comment_count(self):
         """Количество комментариев у поста"""
@@ -54,6 +133,19 @@ class PostLike(models.Model):
     def __str__(self):
         return f"Лайк от {self.user} на {self.post}"
 
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        super().save(*args, **kwargs)
+        if created:
+            Post.objects.filter(id=self.post_id).update(likes_count=F('likes_count') + 1)
+            UserStats.increment('likes_received', {self.post.author_id: 1})
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        Post.objects.filter(id=self.post_id).update(likes_count=Greatest(F('likes_count') - 1, 0))
+        UserStats.increment('likes_received', {self.post.author_id: -1})
+        return result
+
 
 class Comment(models.Model):
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='comments', verbose_name="Публикация")
@@ -71,6 +163,17 @@ class Comment(models.Model):
     def __str__(self):
         return f"Комментарий от {self.author} к {self.post.title}"
 
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        super().save(*args, **kwargs)
+        if created:
+            UserStats.increment('comments_count', {self.author_id: 1})
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        UserStats.increment('comments_count', {self.author_id: -1})
+        return result
+
 
 class FavouritePost(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='favourites')
@@ -79,4 +182,18 @@ class FavouritePost(models.Model):
 
     class Meta:
         unique_together = ['user', 'post']  # чтобы один пользователь не мог добавить пост в избранное дважды
-        ordering = ['-created_at']
\ No newline at end of file
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='favourite_user_created_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        super().save(*args, **kwargs)
+        if created:
+            Post.objects.filter(id=self.post_id).update(favourites_count=F('favourites_count') + 1)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        Post.objects.filter(id=self.post_id).update(favourites_count=Greatest(F('favourites_count') - 1, 0))
+        return result
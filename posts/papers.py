@@ -0,0 +1,96 @@
+import numpy as np
+from django.db.models import Count
+from django.urls import reverse
+
+from ml.models import PaperEmbedding
+from utils.doi import normalize_doi
+from .models import Post
+from .ranking import parse_embedding
+
+
+PAPER_POSTS_LIMIT = 50
+PAPER_COMMUNITIES_LIMIT = 20
+SIMILAR_PAPERS = 5
+SIMILAR_CANDIDATES = 500  # сколько статей той же научной области сравнивается по эмбеддингу
+
+
+def get_paper_overview(doi):
+    """
+    Все, что известно о статье по DOI: обсуждения, сообщества и похожие статьи.
+
+    Каждая часть - один запрос по индексу нормализованного ключа DOI.
+    Возвращает None, если DOI некорректен или о статье ничего нет.
+    """
+    doi_key = normalize_doi(doi)
+    if doi_key is None:
+        return None
+
+    paper = PaperEmbedding.objects.select_related('scientific_field').filter(doi_key=doi_key).first()
+    posts = list(
+        Post.objects.filter(doi_key=doi_key).select_related('author', 'community')
+        .order_by('-created_at')[:PAPER_POSTS_LIMIT]
+    )
+    if paper is None and not posts:
+        return None
+
+    communities = (
+        Post.objects.filter(doi_key=doi_key, community__isnull=False).order_by()
+        .values('community_id', 'community__name').annotate(posts=Count('id'))
+        .order_by('-posts', 'community_id')[:PAPER_COMMUNITIES_LIMIT]
+    )
+
+    return {
+        'doi': doi_key,
+        'paper': {
+            'title': paper.title,
+            'scientific_field': paper.scientific_field.name,
+        } if paper else None,
+        'posts': [
+            {
+                'id': post.id,
+                'title': post.title,
+                'author': post.author.get_full_name() or post.author.username,
+                'community': post.community.name if post.community else None,
+                'created_at': post.created_at.isoformat(),
+                'url': reverse('posts:post_detail', args=[post.id]),
+            }
+            for post in posts
+        ],
+        'communities': [
+            {
+                'id': row['community_id'],
+                'name': row['community__name'],
+                'posts': row['posts'],
+                'url': reverse('communities:community_detail', args=[row['community_id']]),
+            }
+            for row in communities
+        ],
+        'similar_papers': similar_papers(paper) if paper else [],
+    }
+
+
+def similar_papers(paper, limit=SIMILAR_PAPERS):
+    """Статьи той же научной области, ближайшие по косинусному сходству эмбеддингов"""
+    vector = parse_embedding(paper.embedding_vector)
+    if vector is None:
+        return []
+
+    candidates = PaperEmbedding.objects.filter(scientific_field_id=paper.scientific_field_id) \
+        .exclude(id=paper.id).order_by('-id').values_list('doi', 'doi_key', 'title', 'embedding_vector')
+    rows, vectors = [], []
+    for doi, doi_key, title, raw in candidates[:SIMILAR_CANDIDATES]:
+        candidate = parse_embedding(raw)
+        if candidate is not None and candidate.shape == vector.shape:
+            rows.append((doi_key or doi, title))
+            vectors.append(candidate)
+    if not vectors:
+        return []
+
+    matrix = np.vstack(vectors)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector)
+    similarity = np.divide(matrix @ vector, norms, out=np.zeros(len(rows)), where=norms > 0)
+    best = np.argsort(-similarity)[:limit]
+    return [
+        {'doi': rows[index][0], 'title': rows[index][1], 'similarity': round(float(similarity[index]), 4)}
+        for index in best
+    ]
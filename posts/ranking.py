@@ -0,0 +1,249 @@
+import json
+import math
+import time
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from ml.models import UserEmbedding
+from users.models import Profile
+
+
+DEFAULT_FEED_RANKING = {
+    'candidates': 500,          # сколько свежих постов ранжируем
+    'time_budget_ms': 15,       # жесткий бюджет времени на запрос
+    'half_life_hours': 36,      # период полураспада свежести
+    'weights': {
+        'fields': 1.0,          # пересечение научных областей
+        'embedding': 1.0,       # сходство эмбеддингов
+        'engagement': 0.6,      # скорость набора реакций
+        'recency': 1.2,         # свежесть
+    },
+}
+
+
+def get_ranking_settings():
+    """Настройки ранжирования с учетом переопределений из settings.FEED_RANKING"""
+    config = dict(DEFAULT_FEED_RANKING)
+    overrides = getattr(settings, 'FEED_RANKING', {})
+    config.update({key: value for key, value in overrides.items() if key != 'weights'})
+    config['weights'] = {**DEFAULT_FEED_RANKING['weights'], **overrides.get('weights', {})}
+    return config
+
+
+# Через сколько разобранных строк этапа проверять бюджет времени
+BUDGET_CHECK_EVERY = 64
+
+
+class RankingBudgetExceeded(Exception):
+    """Бюджет времени на ранжирование исчерпан"""
+
+
+class FeedRanker:
+    """
+    Ранжирование кандидатов ленты по релевантности для пользователя.
+
+    Все признаки считаются векторно по всей пачке кандидатов. Если бюджет
+    времени исчерпан, возвращается исходный хронологический порядок.
+    """
+
+    def __init__(self, user, config=None):
+        self.user = user
+        self.config = config or get_ranking_settings()
+        self.weights = self.config['weights']
+        self._deadline = None
+
+    def rank(self, posts):
+        """Вернуть список постов, упорядоченный по убыванию релевантности"""
+        posts = list(posts)
+        if len(posts) < 2:
+            return posts
+
+        self._deadline = time.perf_counter() + self.config['time_budget_ms'] / 1000
+        try:
+            scores = self.score(posts)
+        except RankingBudgetExceeded:
+            return posts
+
+        # Стабильная сортировка: при равных оценках сохраняется хронология
+        order = np.argsort(-scores, kind='stable')
+        return [posts[i] for i in order]
+
+    def score(self, posts):
+        author_ids = np.fromiter((post.author_id for post in posts), dtype=np.int64, count=len(posts))
+
+        scores = self.weights['recency'] * self._recency(posts)
+        scores += self.weights['engagement'] * self._engagement(posts)
+        self._check_budget()
+
+        # Бюджет проверяется и внутри этапов, по ходу разбора строк, чтобы один медленный этап не выходил за него
+        if self.weights['fields']:
+            scores += self.weights['fields'] * self._field_overlap(author_ids)
+            self._check_budget()
+
+        if self.weights['embedding']:
+            scores += self.weights['embedding'] * self._embedding_similarity(author_ids)
+            self._check_budget()
+
+        return scores
+
+    def _check_budget(self):
+        if time.perf_counter() > self._deadline:
+            raise RankingBudgetExceeded()
+
+    def _age_hours(self, posts):
+        now = timezone.now().timestamp()
+        created = np.fromiter((post.created_at.timestamp() for post in posts), dtype=np.float64, count=len(posts))
+        return np.maximum(now - created, 0) / 3600
+
+    def _recency(self, posts):
+        """Экспоненциальное затухание свежести, 1.0 для только что созданного поста"""
+        decay = math.log(2) / self.config['half_life_hours']
+        return np.exp(-decay * self._age_hours(posts))
+
+    def _engagement(self, posts):
+        """Скорость набора реакций (лайки, комментарии, избранное в час), нормированная на пачку"""
+        reactions = np.array([
+            _annotated(post, 'like_count')
+            + 2 * _annotated(post, 'comment_count')
+            + 3 * _annotated(post, 'favourite_count')
+            for post in posts
+        ], dtype=np.float64)
+        velocity = np.log1p(reactions / (self._age_hours(posts) + 2))
+        peak = velocity.max()
+        return velocity / peak if peak > 0 else velocity
+
+    def _field_overlap(self, author_ids):
+        """Коэффициент Жаккара между научными областями автора и читателя"""
+        through = Profile.scientific_fields.through
+        rows = through.objects.filter(
+            profile__user_id__in=set(author_ids.tolist()) | {self.user.id}
+        ).values_list('profile__user_id', 'scientificfield_id')
+
+        fields_by_user = {}
+        for index, (user_id, field_id) in enumerate(rows.iterator(chunk_size=BUDGET_CHECK_EVERY)):
+            if index % BUDGET_CHECK_EVERY == 0:
+                self._check_budget()
+            fields_by_user.setdefault(user_id, set()).add(field_id)
+
+        viewer_fields = fields_by_user.get(self.user.id)
+        if not viewer_fields:
+            return np.zeros(len(author_ids))
+
+        overlap_by_author = {}
+        for author_id, fields in fields_by_user.items():
+            overlap_by_author[author_id] = len(fields & viewer_fields) / len(fields | viewer_fields)
+        return np.array([overlap_by_author.get(author_id, 0.0) for author_id in author_ids.tolist()])
+
+    def _embedding_similarity(self, author_ids):
+        """Косинусное сходство эмбеддингов автора и читателя (0, если эмбеддинга нет)"""
+        unique_ids = set(author_ids.tolist()) | {self.user.id}
+        rows = UserEmbedding.objects.filter(user_id__in=unique_ids).values_list('user_id', 'embedding_vector')
+        vectors = {}
+        for index, (user_id, raw) in enumerate(rows.iterator(chunk_size=BUDGET_CHECK_EVERY)):
+            if index % BUDGET_CHECK_EVERY == 0:
+                self._check_budget()
+            vectors[user_id] = parse_embedding(raw)
+
+        viewer_vector = vectors.pop(self.user.id, None)
+        vectors = {
+            user_id: vector for user_id, vector in vectors.items()
+            if vector is not None and viewer_vector is not None and vector.shape == viewer_vector.shape
+        }
+        if viewer_vector is None or not vectors:
+            return np.zeros(len(author_ids))
+
+        ids = list(vectors)
+        matrix = np.vstack([vectors[user_id] for user_id in ids])
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(viewer_vector)
+        similarity = np.divide(matrix @ viewer_vector, norms, out=np.zeros(len(ids)), where=norms > 0)
+
+        similarity_by_author = dict(zip(ids, np.clip(similarity, 0, 1).tolist()))
+        return np.array([similarity_by_author.get(author_id, 0.0) for author_id in author_ids.tolist()])
+
+
+def _annotated(post, name):
+    """Значение аннотации счетчика; методы модели с тем же именем не вызываются, чтобы не делать запросов"""
+    value = getattr(post, name, 0)
+    return 0 if callable(value) or value is None else value
+
+
+def parse_embedding(raw):
+    """Разбор вектора эмбеддинга из текстового поля (JSON-список или числа через запятую)"""
+    if not raw:
+        return None
+    try:
+        values = json.loads(raw)
+    except (TypeError, ValueError):
+        values = raw.replace(',', ' ').split()
+    try:
+        vector = np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return None
+    return vector if vector.ndim == 1 and vector.size else None
+
+
+def rank_feed(user, posts):
+    """Ранжировать пачку кандидатов ленты для пользователя"""
+    return FeedRanker(user).rank(posts)
+
+
+class RankedFeed:
+    """
+    Лента для Paginator: первые window постов - по релевантности, дальше - хронологически.
+
+    Окно свежих кандидатов ранжируется, когда его затрагивает первая страница
+    (или когда порядок окна неизвестен); его порядок - window_ids - сохраняется
+    вызывающим кодом и передается при открытии следующих страниц. Так все
+    страницы нарезаются из одного порядка, даже если на какой-то из них
+    ранжирование вышло бы за бюджет и вернуло хронологию. Посты за пределами
+    окна читаются из запроса срезом и из ленты не пропадают.
+    """
+
+    def __init__(self, user, queryset, window, window_ids=None):
+        self.user = user
+        self.queryset = queryset
+        self.window = window
+        self.window_ids = window_ids
+        self.reranked = False   # окно ранжировано заново, window_ids нужно сохранить
+        self._posts = {}
+
+    def count(self):
+        return self.queryset.count()
+
+    def __len__(self):
+        return self.count()
+
+    def _rank_window(self):
+        ranked = rank_feed(self.user, self.queryset[:self.window])
+        self.window_ids = [post.id for post in ranked]
+        self._posts = {post.id: post for post in ranked}
+        self.reranked = True
+
+    def _window_posts(self, start, stop):
+        ids = self.window_ids[start:stop]
+        missing = [post_id for post_id in ids if post_id not in self._posts]
+        if missing:
+            self._posts.update(self.queryset.order_by().in_bulk(missing))
+        # Посты, удаленные после ранжирования, просто пропускаются
+        return [self._posts[post_id] for post_id in ids if post_id in self._posts]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        start, stop = key.start or 0, key.stop
+        if start == 0 or (self.window_ids is None and start < self.window):
+            self._rank_window()
+        if self.window_ids is None:
+            return list(self.queryset[start:stop])
+
+        # Окно короче window, если кандидатов было меньше
+        boundary = len(self.window_ids)
+        posts = self._window_posts(start, boundary if stop is None else min(stop, boundary)) if start < boundary else []
+        if stop is None or stop > boundary:
+            # Без постов окна: новые посты, появившиеся после ранжирования, идут сразу за ним
+            posts += list(self.queryset.exclude(id__in=self.window_ids)[
+                max(start - boundary, 0):None if stop is None else stop - boundary
+            ])
+        return posts
@@ -0,0 +1,177 @@
+import re
+
+from django.db import connection, transaction
+from django.db.models import Q
+
+from utils.doi import normalize_doi
+from utils.fts import make_cursor, parse_cursor, parse_query
+from .models import Post
+
+
+SEARCH_PAGE_SIZE = 20
+REBUILD_CHUNK_SIZE = 5000
+
+# Веса bm25 по колонкам индекса: title, content, doi, tags (служебные токены не ранжируются)
+BM25_WEIGHTS = (5.0, 1.0, 10.0, 0.0)
+
+_DOI_RE = re.compile(r'10\.\d{4,9}/\S+')
+
+# Та же строка индекса, что собирают триггеры миграции 0008_post_fts
+_INDEX_ROW_SQL = """
+    SELECT p.id, p.title, p.content, COALESCE(p.doi, ''),
+           'type' || p.post_type
+           || ' field' || COALESCE(p.scientific_field_id, 0)
+           || ' community' || COALESCE(p.community_id, 0)
+    FROM posts_post p
+"""
+
+
+def _fts_query(query, post_type=None, scientific_field_id=None, community_id=None):
+    """Запрос FTS5: DOI ищется фразой в своей колонке, слова - префиксами в тексте, фильтры - по tags"""
+    doi = _DOI_RE.search(query or '')
+    if doi:
+        tokens = parse_query(doi.group(0).lower())
+        match = '{doi} : "%s"' % ' '.join(tokens)
+    else:
+        tokens = parse_query(query)
+        if not tokens:
+            return None
+        # Префиксный поиск только от двух символов: для них есть prefix-индекс
+        match = '{title content doi} : (%s)' % ' '.join(
+            f'"{token}"*' if len(token) > 1 else f'"{token}"' for token in tokens
+        )
+
+    for prefix, value in (('type', post_type), ('field', scientific_field_id), ('community', community_id)):
+        if value:
+            match += f' AND tags : "{prefix}{value}"'
+    return match
+
+
+def search_posts(query, post_type=None, scientific_field_id=None, community_id=None, after=None,
+                 limit=SEARCH_PAGE_SIZE):
+    """
+    Поиск публикаций по заголовку, тексту и DOI с ранжированием BM25.
+
+    Фильтры по типу, научной области и сообществу необязательны, курсор
+    after - значение next_cursor предыдущей страницы. Возвращает
+    {'results', 'has_more', 'next_cursor'}.
+    """
+    if post_type not in dict(Post.POST_TYPES):
+        post_type = None
+    scientific_field_id = _int_or_none(scientific_field_id)
+    community_id = _int_or_none(community_id)
+
+    match = _fts_query(query, post_type, scientific_field_id, community_id)
+    if match is None:
+        return {'results': [], 'has_more': False, 'next_cursor': None}
+
+    after = parse_cursor(after)
+    if connection.vendor == 'sqlite':
+        rows = _search_fts(match, after, limit + 1)
+    else:
+        rows = _search_scan(query, post_type, scientific_field_id, community_id, after, limit + 1)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    posts = Post.objects.select_related('author', 'community', 'scientific_field').in_bulk(
+        [post_id for post_id, _ in rows]
+    )
+    return {
+        'results': [posts[post_id] for post_id, _ in rows if post_id in posts],
+        'has_more': has_more,
+        'next_cursor': make_cursor(rows[-1][1], rows[-1][0]) if has_more else None,
+    }
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _search_fts(match, after, limit):
+    """
+    Поиск по индексу FTS5: bm25 ранжирует все совпадения, страницы идут
+    по (оценка, id) без OFFSET. Сортировка по оценке идет в памяти, так что
+    стоимость растет с числом совпадений, но более релевантный старый пост
+    не теряется за свежими.
+    """
+    sql = """
+        SELECT id, score FROM (
+            SELECT rowid AS id, bm25(posts_post_fts, %s, %s, %s, %s) AS score
+            FROM posts_post_fts
+            WHERE posts_post_fts MATCH %s
+        )
+    """
+    params = [*BM25_WEIGHTS, match]
+    if after is not None:
+        sql += ' WHERE score > %s OR (score = %s AND id > %s)'
+        params.extend([after[0], after[0], after[1]])
+    sql += ' ORDER BY score, id LIMIT %s'
+    params.append(limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def _search_scan(query, post_type, scientific_field_id, community_id, after, limit):
+    """Точный поиск по ключу DOI или подстрочный по заголовку и тексту; порядок по id, без оценки"""
+    posts = Post.objects.all()
+    doi_key = normalize_doi(query)
+    if doi_key:
+        posts = posts.filter(doi_key=doi_key)
+    else:
+        for token in parse_query(query):
+            posts = posts.filter(Q(title__icontains=token) | Q(content__icontains=token))
+    if post_type:
+        posts = posts.filter(post_type=post_type)
+    if scientific_field_id:
+        posts = posts.filter(scientific_field_id=scientific_field_id)
+    if community_id:
+        posts = posts.filter(community_id=community_id)
+    if after is not None:
+        posts = posts.filter(id__gt=after[1])
+    return [(post_id, 0.0) for post_id in posts.order_by('id').values_list('id', flat=True)[:limit]]
+
+
+def rebuild_index(chunk_size=REBUILD_CHUNK_SIZE):
+    """
+    Пересобрать поисковый индекс постов пачками по id.
+
+    Генератор: после каждой пачки возвращает число проиндексированных
+    постов. Каждая пачка - отдельная транзакция, поэтому запись в посты
+    не блокируется на все время пересборки; изменения, сделанные во время
+    нее, попадают в индекс через триггеры. Строки индекса заменяются на
+    месте, а строки удаленных постов убираются в конце, так что поиск
+    работает и во время пересборки.
+    """
+    if connection.vendor != 'sqlite':
+        return
+
+    last_id = total = 0
+    while True:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT MAX(id), COUNT(*) FROM (SELECT id FROM posts_post WHERE id > %s ORDER BY id LIMIT %s)',
+                [last_id, chunk_size]
+            )
+            chunk_last_id, count = cursor.fetchone()
+            if not count:
+                break
+            cursor.execute(
+                'INSERT OR REPLACE INTO posts_post_fts(rowid, title, content, doi, tags)'
+                f'{_INDEX_ROW_SQL} WHERE p.id > %s AND p.id <= %s',
+                [last_id, chunk_last_id]
+            )
+        last_id = chunk_last_id
+        total += count
+        yield total
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('DELETE FROM posts_post_fts WHERE rowid NOT IN (SELECT id FROM posts_post)')
+    with connection.cursor() as cursor:
+        # Слияние сегментов индекса ускоряет последующие запросы
+        cursor.execute("INSERT INTO posts_post_fts(posts_post_fts) VALUES ('optimize')")
@@ -1,3 +1,560 @@
+import time
+from datetime import timedelta
+from unittest import mock, skipUnless
+
+import numpy as np
+
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.core.paginator import Paginator
+from django.urls import reverse
+from django.utils import timezone
+
+from communities.models import Community, CommunityMembership
+from ml.models import PaperEmbedding, UserEmbedding
+from users.friend_graph import friend_graph
+from users.models import FriendEdge, User, Friendship, Profile, ScientificField, UserStats
+from utils.mongo_cache import MongoCacheHelper, cache
+from utils.doi import normalize_doi
+from utils.query_plan import QueryPlanAssertionsMixin
+from .engagement import EngagementBuffer, apply_buffered
+from .search import rebuild_index, search_posts
+from .models import Post, FavouritePost, Comment, PostLike
+from .ranking import FeedRanker, RankedFeed, RankingBudgetExceeded, get_ranking_settings, rank_feed
+from .views import COMMENTS_PAGE_SIZE, get_comment_page
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN доступен только в SQLite')
+class PostQueryPlanTests(QueryPlanAssertionsMixin, TestCase):
+    """Горячие запросы ленты и избранного не должны сканировать таблицы целиком"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='reader', password='password')
+        cls.friend = User.objects.create_user(username='friend', password='password')
+        Friendship.objects.create(from_user=cls.user, to_user=cls.friend, status='accepted')
+
+        cls.community = Community.objects.create(name='Physics', created_by=cls.friend)
+        CommunityMembership.objects.create(user=cls.user, community=cls.community)
+
+        community_post = Post.objects.create(title='A', content='a', author=cls.friend, community=cls.community)
+        Post.objects.create(title='B', content='b', author=cls.friend)
+        FavouritePost.objects.create(user=cls.user, post=community_post)
+
+    def feed_querysets(self):
+        user_communities = self.user.communities_joined.all()
+        community_posts = Post.objects.filter(community__in=user_communities)
+        friend_ids = list(self.user.get_friend_ids())
+        friends_posts = Post.objects.filter(author_id__in=friend_ids, community__isnull=True)
+        return {
+            'communities': community_posts,
+            'friends': friends_posts,
+            'all': community_posts | friends_posts,
+        }
+
+    def test_news_feed(self):
+        for content_type, posts in self.feed_querysets().items():
+            with self.subTest(content_type=content_type):
+                self.assertNoFullScan(posts.with_engagement().order_by('-created_at'))
+
+    def test_community_posts_use_composite_index(self):
+        posts = Post.objects.filter(community=self.community).order_by('-created_at')
+        self.assertNoFullScan(posts)
+        self.assertUsesIndex(posts, 'post_community_created_idx')
+
+    def test_friends(self):
+        self.assertNoFullScan(self.user.get_friends())
+
+    def test_favourite_posts(self):
+        favourites = Post.objects.filter(favourited_by__user=self.user).with_engagement().order_by(
+            '-favourited_by__created_at'
+        )
+        self.assertNoFullScan(favourites)
+        self.assertUsesIndex(favourites, 'favourite_user_created_idx')
+
+
+class FeedRankingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = User.objects.create_user(username='viewer', password='password')
+        cls.physicist = User.objects.create_user(username='physicist', password='password')
+        cls.biologist = User.objects.create_user(username='biologist', password='password')
+        cls.physics = ScientificField.objects.create(name='Физика')
+        cls.biology = ScientificField.objects.create(name='Биология')
+        for user, field in [(cls.viewer, cls.physics), (cls.physicist, cls.physics), (cls.biologist, cls.biology)]:
+            Profile.objects.create(user=user).scientific_fields.add(field)
+
+    def setUp(self):
+        now = timezone.now()
+        # Свежий пост биолога и пост физика часом старше
+        self.bio_post = Post.objects.create(author=self.biologist, title='Клетки', content='...')
+        self.physics_post = Post.objects.create(author=self.physicist, title='Лазеры', content='...')
+        Post.objects.filter(id=self.bio_post.id).update(created_at=now)
+        Post.objects.filter(id=self.physics_post.id).update(created_at=now - timedelta(hours=1))
+
+    def chronological(self):
+        return list(Post.objects.with_engagement().order_by('-created_at'))
+
+    def ranker(self, budget_ms=1000, **weights):
+        config = get_ranking_settings()
+        config = {**config, 'time_budget_ms': budget_ms,
+                  'weights': {'fields': 0, 'embedding': 0, 'engagement': 0, 'recency': 0, **weights}}
+        return FeedRanker(self.viewer, config)
+
+    def test_recency_keeps_chronology(self):
+        self.assertEqual(self.ranker(recency=1).rank(self.chronological()), [self.bio_post, self.physics_post])
+
+    def test_shared_fields_and_engagement_raise_score(self):
+        self.assertEqual(self.ranker(recency=1, fields=2).rank(self.chronological()),
+                         [self.physics_post, self.bio_post])
+
+        PostLike.objects.create(post=self.physics_post, user=self.viewer)
+        Comment.objects.create(post=self.physics_post, author=self.viewer, content='!')
+        self.assertEqual(self.ranker(recency=1, engagement=2).rank(self.chronological()),
+                         [self.physics_post, self.bio_post])
+
+    def test_embedding_similarity(self):
+        UserEmbedding.objects.create(user=self.viewer, embedding_vector='[1, 0]')
+        UserEmbedding.objects.create(user=self.physicist, embedding_vector='[0.9, 0.1]')
+        UserEmbedding.objects.create(user=self.biologist, embedding_vector='[0, 1]')
+        self.assertEqual(self.ranker(embedding=1).rank(self.chronological()), [self.physics_post, self.bio_post])
+
+    def test_missing_embeddings_fall_back_to_other_signals(self):
+        # Нет эмбеддинга читателя, у авторов - пустой и некорректный: сходство нулевое, порядок задают остальные признаки
+        UserEmbedding.objects.create(user=self.physicist, embedding_vector='')
+        UserEmbedding.objects.create(user=self.biologist, embedding_vector='not a vector')
+        ranker = self.ranker(embedding=1, recency=1)
+        self.assertEqual(ranker.rank(self.chronological()), [self.bio_post, self.physics_post])
+
+        UserEmbedding.objects.create(user=self.viewer, embedding_vector='[1, 0]')
+        ranker._deadline = time.perf_counter() + 1
+        similarity = ranker._embedding_similarity(np.array([self.physicist.id, self.biologist.id]))
+        self.assertEqual(similarity.tolist(), [0.0, 0.0])
+
+    def test_budget_exceeded_returns_chronology(self):
+        ranker = self.ranker(budget_ms=0, fields=2)
+        self.assertEqual(ranker.rank(self.chronological()), [self.bio_post, self.physics_post])
+        self.assertEqual(rank_feed(self.viewer, []), [])
+
+    def test_budget_checked_inside_stage(self):
+        # Медленный этап прерывается на первой проверке внутри разбора строк, а не после него
+        ranker = self.ranker(fields=1)
+        ranker._deadline = 0
+        with self.assertRaises(RankingBudgetExceeded):
+            ranker._field_overlap(np.array([self.physicist.id]))
+
+    def test_ranked_feed_keeps_posts_beyond_window(self):
+        older = []
+        for index in range(3):
+            post = Post.objects.create(author=self.biologist, title=f'Old {index}', content='...')
+            Post.objects.filter(id=post.id).update(created_at=timezone.now() - timedelta(days=index + 1))
+            older.append(post)
+
+        queryset = Post.objects.with_engagement().order_by('-created_at')
+        with mock.patch('posts.ranking.rank_feed', side_effect=lambda user, posts: list(posts)[::-1]):
+            paginator = Paginator(RankedFeed(self.viewer, queryset, window=2), 2)
+            pages = [list(paginator.page(number)) for number in paginator.page_range]
+        # Окно из двух постов ранжировано (здесь - перевернуто), остальные идут хронологически
+        self.assertEqual(pages, [[self.physics_post, self.bio_post], [older[0], older[1]], [older[2]]])
+
+    def test_next_pages_follow_stored_window_order(self):
+        older = []
+        for index in range(3):
+            post = Post.objects.create(author=self.biologist, title=f'Old {index}', content='...')
+            Post.objects.filter(id=post.id).update(created_at=timezone.now() - timedelta(days=index + 1))
+            older.append(post)
+        queryset = Post.objects.with_engagement().order_by('-created_at')
+
+        with mock.patch('posts.ranking.rank_feed', side_effect=lambda user, posts: list(posts)[::-1]):
+            first_feed = RankedFeed(self.viewer, queryset, window=4)
+            first = list(Paginator(first_feed, 2).page(1))
+        self.assertTrue(first_feed.reranked)
+
+        # На следующей странице ранжирование вышло бы за бюджет и вернуло хронологию:
+        # страница все равно нарезается из сохраненного порядка, без повторов и пропусков
+        with mock.patch('posts.ranking.rank_feed', side_effect=lambda user, posts: list(posts)) as rank:
+            feed = RankedFeed(self.viewer, queryset, window=4, window_ids=first_feed.window_ids)
+            paginator = Paginator(feed, 2)
+            rest = [post for number in (2, 3) for post in paginator.page(number)]
+        rank.assert_not_called()
+        self.assertFalse(feed.reranked)
+        self.assertEqual([post.id for post in first + rest], first_feed.window_ids + [older[2].id])
+        self.assertCountEqual(first + rest, list(queryset))
+
+    @mock.patch.object(MongoCacheHelper, 'cache_news_feed')
+    @mock.patch.object(MongoCacheHelper, 'get_cached_news_feed', return_value=None)
+    def test_news_feed_stores_window_order_on_first_page(self, get_cached, cache_page):
+        friend_graph.clear()
+        FriendEdge.link(self.viewer.id, self.biologist.id)
+        FriendEdge.link(self.viewer.id, self.physicist.id)
+        Post.objects.bulk_create([Post(author=self.biologist, title=f'Note {i}', content='...') for i in range(20)])
+        self.client.force_login(self.viewer)
+        self.addCleanup(cache.delete, f'feed_order_{self.viewer.id}_all')
+
+        self.client.get(reverse('posts:news_feed'))
+        order = MongoCacheHelper.get_cached_feed_order(self.viewer.id, 'all')
+        self.assertCountEqual(order['ids'], Post.objects.values_list('id', flat=True))
+        self.assertEqual(cache_page.call_args.kwargs['sort'], f"relevance_{order['version']}")
+
+        with mock.patch('posts.ranking.rank_feed') as rank:
+            self.client.get(reverse('posts:news_feed'), {'page': 2})
+        rank.assert_not_called()
+        self.assertEqual(get_cached.call_args.args[3], f"relevance_{order['version']}")
+
+
+@mock.patch.object(MongoCacheHelper, 'cache_comment_page')
+@mock.patch.object(MongoCacheHelper, 'get_cached_comment_page', return_value=None)
+class CommentPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author', password='password')
+        cls.post = Post.objects.create(title='Discussion', content='...', author=cls.author)
+        Comment.objects.bulk_create([
+            Comment(post=cls.post, author=cls.author, content=f'Comment {i}')
+            for i in range(COMMENTS_PAGE_SIZE + 5)
+        ])
+
+    def test_pages_follow_cursor(self, get_cached, cache_page):
+        with self.assertNumQueries(1):
+            first = get_comment_page(self.post.id)
+        self.assertEqual(len(first['comments']), COMMENTS_PAGE_SIZE)
+        self.assertTrue(first['has_more'])
+        self.assertEqual(first['comments'][0]['author_username'], 'author')
+
+        second = get_comment_page(self.post.id, first['next_cursor'])
+        self.assertEqual([c['content'] for c in second['comments']],
+                         [f'Comment {i}' for i in range(COMMENTS_PAGE_SIZE, COMMENTS_PAGE_SIZE + 5)])
+        self.assertFalse(second['has_more'])
+
+    def test_only_last_page_is_marked_as_tail(self, get_cached, cache_page):
+        first = get_comment_page(self.post.id)
+        get_comment_page(self.post.id, first['next_cursor'])
+
+        self.assertFalse(cache_page.call_args_list[0].kwargs['is_tail'])
+        self.assertTrue(cache_page.call_args_list[1].kwargs['is_tail'])
+
+
+class CommentPageCacheTests(TestCase):
+    def setUp(self):
+        author = User.objects.create_user(username='author', password='password')
+        self.post = Post.objects.create(title='Discussion', content='...', author=author)
+        self.comments = Comment.objects.bulk_create([
+            Comment(post=self.post, author=author, content=f'Comment {i}') for i in range(COMMENTS_PAGE_SIZE + 5)
+        ])
+        self.addCleanup(MongoCacheHelper.invalidate_comment_tail, self.post.id)
+
+    def test_new_comment_invalidates_every_short_page(self):
+        first = get_comment_page(self.post.id)
+        tail = get_comment_page(self.post.id, first['next_cursor'])
+        # Страница с произвольного курсора тоже неполная и не должна вытеснить конец цепочки
+        arbitrary_cursor = self.comments[-3].id
+        get_comment_page(self.post.id, arbitrary_cursor)
+        self.assertEqual(MongoCacheHelper.get_cached_comment_page(self.post.id, first['next_cursor']), tail)
+
+        MongoCacheHelper.invalidate_comment_tail(self.post.id)
+
+        self.assertEqual(MongoCacheHelper.get_cached_comment_page(self.post.id, 0), first)
+        self.assertIsNone(MongoCacheHelper.get_cached_comment_page(self.post.id, first['next_cursor']))
+        self.assertIsNone(MongoCacheHelper.get_cached_comment_page(self.post.id, arbitrary_cursor))
+
+    def test_tail_read_before_new_comment_is_not_served(self):
+        first = get_comment_page(self.post.id)
+        # Хвост прочитан из БД до фиксации нового комментария, а сохранен в кэш уже после инвалидации
+        version = MongoCacheHelper.comment_tail_version(self.post.id)
+        stale = get_comment_page(self.post.id, first['next_cursor'])
+        MongoCacheHelper.invalidate_comment_tail(self.post.id)
+        Comment.objects.create(post=self.post, author=self.post.author, content='New')
+        MongoCacheHelper.cache_comment_page(self.post.id, first['next_cursor'], stale, is_tail=True,
+                                            tail_version=version)
+
+        self.assertIsNone(MongoCacheHelper.get_cached_comment_page(self.post.id, first['next_cursor']))
+        fresh = get_comment_page(self.post.id, first['next_cursor'])
+        self.assertEqual(fresh['comments'][-1]['content'], 'New')
+        self.assertEqual(MongoCacheHelper.get_cached_comment_page(self.post.id, first['next_cursor']), fresh)
+
+
+class EngagementBufferTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author', password='password')
+        cls.reader = User.objects.create_user(username='reader', password='password')
+        cls.post = Post.objects.create(title='Viral', content='...', author=cls.author)
+
+    def setUp(self):
+        # Отдельная база MongoDB, чтобы не задеть буфер рабочего приложения
+        self.database = cache._collection.database.client['axon_horizon_test']
+        self.buffer = EngagementBuffer(self.database)
+
+    def tearDown(self):
+        self.database.client.drop_database(self.database.name)
+
+    def test_toggle_returns_state_and_count(self):
+        PostLike.objects.create(user=self.author, post=self.post)
+
+        self.assertEqual(self.buffer.toggle('like', self.post.id, self.reader.id), (True, 2))
+        self.assertEqual(self.buffer.toggle('like', self.post.id, self.author.id), (False, 1))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.buffer.toggle('like', self.post.id, self.reader.id), (False, 0))
+            self.assertEqual(self.buffer.toggle('like', self.post.id, self.reader.id), (True, 1))
+
+    def test_flush_applies_final_state_and_counters(self):
+        self.buffer.toggle('like', self.post.id, self.reader.id)
+        self.buffer.toggle('favourite', self.post.id, self.reader.id)
+        self.buffer.toggle('favourite', self.post.id, self.author.id)
+        self.buffer.toggle('favourite', self.post.id, self.author.id)
+
+        self.assertEqual(self.buffer.flush(), 4)
+        self.assertEqual(self.buffer.pending_count(), 0)
+
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.likes_count, 1)
+        self.assertEqual(self.post.favourites_count, 1)
+        self.assertTrue(FavouritePost.objects.filter(user=self.reader, post=self.post).exists())
+        self.assertFalse(FavouritePost.objects.filter(user=self.author, post=self.post).exists())
+        annotated = Post.objects.with_engagement().get(id=self.post.id)
+        self.assertEqual((annotated.like_count, annotated.favourite_count), (1, 1))
+
+    def test_pages_show_buffered_state_before_flush(self):
+        other = Post.objects.create(title='Quiet', content='...', author=self.author)
+        FavouritePost.objects.create(user=self.reader, post=other)
+        self.buffer.toggle('like', self.post.id, self.reader.id)
+        self.buffer.toggle('favourite', self.post.id, self.reader.id)
+        self.buffer.toggle('favourite', other.id, self.reader.id)
+
+        posts = list(Post.objects.with_engagement().order_by('id'))
+        cards = [{'id': post.id, 'like_count': 0, 'favourite_count': 0} for post in posts]
+        with self.assertNumQueries(0):
+            posts, favourite_ids = apply_buffered(posts, self.reader.id, {other.id}, buffer=self.buffer)
+            cards, _ = apply_buffered(cards, buffer=self.buffer)
+        self.assertEqual(favourite_ids, {self.post.id})
+        self.assertEqual([(post.like_count, post.favourite_count) for post in posts], [(1, 1), (0, 0)])
+        self.assertEqual(cards[0], {'id': self.post.id, 'like_count': 1, 'favourite_count': 1})
+
+        # После переноса в БД буфер показывает те же значения
+        self.buffer.flush()
+        posts, favourite_ids = apply_buffered(Post.objects.with_engagement().order_by('id'), self.reader.id,
+                                              {self.post.id}, buffer=self.buffer)
+        self.assertEqual(favourite_ids, {self.post.id})
+        self.assertEqual(posts[0].like_count, 1)
+
+    def test_flush_orders_events_by_flips_not_id(self):
+        self.buffer.toggle('like', self.post.id, self.reader.id)
+        self.buffer.toggle('like', self.post.id, self.reader.id)
+        # Часы процессов расходятся: отмена лайка получила меньший _id, чем сам лайк
+        events = list(self.buffer.events.find().sort('flips', -1))
+        self.buffer.events.delete_many({})
+        for event in events:
+            del event['_id']
+            self.buffer.events.insert_one(event)
+
+        self.buffer.flush(batch_size=1)
+        # Отставшее событие из следующей пачки старше уже перенесенного состояния
+        self.buffer.flush(batch_size=1)
+        self.assertEqual(self.buffer.pending_count(), 0)
+        self.assertFalse(PostLike.objects.filter(user=self.reader, post=self.post).exists())
+
+    def test_expired_state_is_reseeded_from_database(self):
+        self.buffer.toggle('like', self.post.id, self.reader.id)
+        self.assertIsNotNone(self.buffer.state.find_one()['expires'])
+        self.assertIsNotNone(self.buffer.counters.find_one()['expires'])
+        self.buffer.flush()
+
+        # TTL-монитор удалил документы: следующее переключение читает состояние и счетчик из БД
+        self.buffer.state.delete_many({})
+        self.buffer.counters.delete_many({})
+        PostLike.objects.create(user=self.author, post=self.post)
+        self.assertEqual(self.buffer.toggle('like', self.post.id, self.reader.id), (False, 1))
+
+    def test_flush_updates_likes_received(self):
+        stats = UserStats.for_user(self.author)
+        self.buffer.toggle('like', self.post.id, self.reader.id)
+        self.buffer.toggle('like', self.post.id, self.author.id)
+        self.buffer.toggle('like', self.post.id, self.author.id)
+        self.buffer.flush()
+        stats.refresh_from_db()
+        self.assertEqual(stats.likes_received, 1)
+
+        self.buffer.toggle('like', self.post.id, self.reader.id)
+        self.buffer.flush()
+        stats.refresh_from_db()
+        self.assertEqual(stats.likes_received, 0)
+
+
+class PostSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author', password='password')
+        cls.physics = ScientificField.objects.create(name='Физика')
+        cls.community = Community.objects.create(name='Optics', created_by=cls.author)
+
+    def post(self, title, content='', **kwargs):
+        return Post.objects.create(author=self.author, title=title, content=content, **kwargs)
+
+    def ids(self, query, **kwargs):
+        return [post.id for post in search_posts(query, **kwargs)['results']]
+
+    def test_title_matches_rank_above_content(self):
+        in_content = self.post('Заметки', 'Обсуждаем квантовую запутанность фотонов')
+        in_title = self.post('Квантовая запутанность', 'Обзор')
+        self.assertEqual(self.ids('квантов запутанность'), [in_title.id, in_content.id])
+
+    def test_search_by_doi(self):
+        paper = self.post('Paper', doi='10.1038/nature12373')
+        self.post('Other', 'nature 1038 12373', doi='10.1126/science.1234')
+        self.assertEqual(self.ids('https://doi.org/10.1038/nature12373'), [paper.id])
+
+    def test_filters(self):
+        article = self.post('Лазер', post_type='article', scientific_field=self.physics, community=self.community)
+        self.post('Лазер', post_type='question')
+        self.assertEqual(self.ids('лазер', post_type='article'), [article.id])
+        self.assertEqual(self.ids('лазер', scientific_field_id=str(self.physics.id)), [article.id])
+        self.assertEqual(self.ids('лазер', community_id=self.community.id), [article.id])
+        self.assertEqual(len(self.ids('лазер', post_type='unknown')), 2)
+
+    def test_index_follows_changes(self):
+        post = self.post('Spectroscopy', community=self.community)
+        post.title = 'Microscopy'
+        post.save()
+        self.assertEqual(self.ids('spectroscopy'), [])
+        self.assertEqual(self.ids('microscopy'), [post.id])
+
+        self.community.delete()
+        self.assertEqual(self.ids('microscopy'), [])
+
+    def test_cursor_pagination(self):
+        posts = [self.post(f'Dataset {i}') for i in range(5)]
+        page = search_posts('dataset', limit=3)
+        rest = search_posts('dataset', after=page['next_cursor'], limit=3)
+        self.assertTrue(page['has_more'])
+        self.assertFalse(rest['has_more'])
+        self.assertCountEqual([p.id for p in page['results'] + rest['results']], [p.id for p in posts])
+
+    def test_older_relevant_post_ranks_above_newer_matches(self):
+        best = self.post('Interferometer', 'Interferometer interferometer')
+        newer = [self.post(f'Notes {i}', 'Мы собрали interferometer') for i in range(30)]
+        first = search_posts('interferometer', limit=5)
+        self.assertEqual(first['results'][0].id, best.id)
+
+        seen, page = [], first
+        while True:
+            seen += [post.id for post in page['results']]
+            if not page['has_more']:
+                break
+            page = search_posts('interferometer', after=page['next_cursor'], limit=5)
+        self.assertCountEqual(seen, [best.id] + [post.id for post in newer])
+
+    @skipUnless(connection.vendor == 'sqlite', 'Индекс FTS5 доступен только в SQLite')
+    def test_rebuild_command(self):
+        posts = [self.post(f'Telescope {i}') for i in range(5)]
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM posts_post_fts')
+        self.assertEqual(self.ids('telescope'), [])
+
+        call_command('rebuild_post_index', chunk_size=2, stdout=mock.MagicMock())
+        self.assertCountEqual(self.ids('telescope'), [post.id for post in posts])
+
+    @skipUnless(connection.vendor == 'sqlite', 'Индекс FTS5 доступен только в SQLite')
+    def test_search_works_during_rebuild(self):
+        posts = [self.post(f'Telescope {i}') for i in range(5)]
+        with connection.cursor() as cursor:
+            # Строка поста, удаленного мимо триггеров
+            cursor.execute("INSERT INTO posts_post_fts(rowid, title, content, doi, tags) "
+                           "VALUES (%s, 'Telescope orphan', '', '', '')", [posts[-1].id + 100])
+
+        rebuild = rebuild_index(chunk_size=2)
+        self.assertEqual(next(rebuild), 2)
+        self.assertCountEqual(self.ids('telescope'), [post.id for post in posts])
+        list(rebuild)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT rowid FROM posts_post_fts WHERE posts_post_fts MATCH 'telescope'")
+            self.assertCountEqual([row[0] for row in cursor.fetchall()], [post.id for post in posts])
+
+    def test_search_page(self):
+        self.post('Graphene synthesis', post_type='article')
+        self.client.force_login(self.author)
+        response = self.client.get(reverse('posts:post_search'), {'q': 'graphene', 'post_type': 'article'})
+        self.assertContains(response, 'Graphene synthesis')
+
+
+class DoiTests(QueryPlanAssertionsMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author', password='password')
+        cls.physics = ScientificField.objects.create(name='Физика')
+        cls.community = Community.objects.create(name='Optics', created_by=cls.author)
+
+    def paper(self, doi, title, vector):
+        return PaperEmbedding.objects.create(doi=doi, title=title, embedding_vector=str(vector),
+                                             scientific_field=self.physics)
+
+    def test_normalize_doi(self):
+        for value in ['10.1038/NATURE12373', 'doi:10.1038/nature12373', ' https://doi.org/10.1038/nature12373 ',
+                      'http://dx.doi.org/10.1038%2Fnature12373', 'DOI: 10.1038/nature12373.']:
+            self.assertEqual(normalize_doi(value), '10.1038/nature12373')
+        self.assertIsNone(normalize_doi('not a doi'))
+        self.assertIsNone(normalize_doi(None))
+
+    def test_keys_are_set_on_save(self):
+        post = Post.objects.create(author=self.author, title='A', content='...', doi='https://doi.org/10.1000/ABC')
+        self.assertEqual(post.doi_key, '10.1000/abc')
+        post.doi = ''
+        post.save(update_fields=['doi'])
+        post.refresh_from_db()
+        self.assertIsNone(post.doi_key)
+        self.assertEqual(self.paper('DOI:10.1000/XYZ', 'Paper', [1, 0]).doi_key, '10.1000/xyz')
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN доступен только в SQLite')
+    def test_lookup_uses_index(self):
+        queryset = Post.objects.filter(doi_key='10.1000/abc').order_by('-created_at')
+        self.assertNoFullScan(queryset)
+        self.assertUsesIndex(queryset, 'post_doi_key_idx')
+
+    def test_paper_endpoint(self):
+        paper = self.paper('10.1000/main', 'Main paper', [1.0, 0.0])
+        self.paper('10.1000/near', 'Near paper', [0.9, 0.1])
+        self.paper('10.1000/far', 'Far paper', [0.0, 1.0])
+        Post.objects.create(author=self.author, title='Discussion', content='...', doi='doi:10.1000/MAIN',
+                            community=self.community)
+        Post.objects.create(author=self.author, title='Personal note', content='...', doi='10.1000/main')
+        Post.objects.create(author=self.author, title='Other', content='...', doi='10.1000/other')
+
+        self.client.force_login(self.author)
+        data = self.client.get(reverse('posts:paper_detail', args=['https://doi.org/10.1000/Main'])).json()
+        self.assertEqual(data['doi'], paper.doi_key)
+        self.assertEqual(data['paper']['title'], 'Main paper')
+        self.assertEqual([post['title'] for post in data['posts']], ['Personal note', 'Discussion'])
+        self.assertEqual([(c['name'], c['posts']) for c in data['communities']], [('Optics', 1)])
+        self.assertEqual([p['title'] for p in data['similar_papers']], ['Near paper', 'Far paper'])
+
+        self.assertEqual(self.client.get(reverse('posts:paper_detail', args=['10.1000/missing'])).status_code, 404)
+
+    def test_duplicate_doi_leaves_key_with_first_paper(self):
+        first = self.paper('10.1000/DUP', 'First', [1, 0])
+        second = self.paper('https://doi.org/10.1000/dup', 'Second', [1, 0])
+        self.assertEqual((first.doi_key, second.doi_key), ('10.1000/dup', None))
+
+        second.title = 'Second edition'
+        second.save()
+        first.save()
+        self.assertEqual(
+            dict(PaperEmbedding.objects.values_list('id', 'doi_key')), {first.id: '10.1000/dup', second.id: None}
+        )
+
+    def test_backfill_command(self):
+        post = Post.objects.create(author=self.author, title='A', content='...', doi='10.1000/ABC')
+        first = self.paper('10.1000/DUP', 'First', [1, 0])
+        # Старые строки без ключей, среди них дубликат DOI в другой записи
+        Post.objects.filter(id=post.id).update(doi_key=None)
+        PaperEmbedding.objects.update(doi_key=None)
+        second = PaperEmbedding.objects.create(doi='https://doi.org/10.1000/dup', title='Second',
+                                               embedding_vector='[1, 0]', scientific_field=self.physics)
+        PaperEmbedding.objects.filter(id=second.id).update(doi_key=None)
 
-# Create your tests here.
+        output = mock.MagicMock()
+        call_command('backfill_doi_keys', batch_size=1, stdout=output)
+        post.refresh_from_db()
+        self.assertEqual(post.doi_key, '10.1000/abc')
+        self.assertEqual(
+            dict(PaperEmbedding.objects.values_list('id', 'doi_key')), {first.id: '10.1000/dup', second.id: None}
+        )
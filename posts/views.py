@@ -1,13 +1,18 @@
 from django.contrib.auth.decorators import login_required
 from django.core.paginator import Paginator
-from django.db.models import Count
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse
 from django.contrib import messages
 from django.shortcuts import render, get_object_or_404, redirect
-from .models import Post, FavouritePost, Comment, PostLike
+from django.utils.dateformat import format as date_format
+from django.utils.timezone import localtime
+from .models import Post, FavouritePost, Comment
 from .forms import PostForm, CommentForm
 from users.models import ScientificField
 from utils.mongo_cache import MongoCacheHelper
+from .engagement import apply_buffered, engagement_buffer
+from .ranking import RankedFeed, get_ranking_settings
+from .papers import get_paper_overview
+from .search import search_posts
 import time
 
 
@@ -42,14 +47,24 @@ def news_feed(request):
     # Получаем параметры для кэширования
     content_type = request.GET.get('type', 'all')
     page_number = request.GET.get('page', 1)
+    sort = request.GET.get('sort', 'relevance')
+    if sort not in ('relevance', 'new'):
+        sort = 'relevance'
+
+    # Страницы ранжированной ленты кэшируются вместе с версией порядка окна, из которого нарезаны:
+    # после переранжирования первой страницы старые страницы не смешиваются с новыми
+    feed_order = None
+    cache_sort = sort
+    if sort == 'relevance':
+        feed_order = MongoCacheHelper.get_cached_feed_order(request.user.id, content_type)
+        cache_sort = f"relevance_{feed_order['version'] if feed_order else 0}"
 
     # Пробуем получить из кэша
-    cache_key = f"{request.user.id}_{content_type}_{page_number}"
-    cached_data = MongoCacheHelper.get_cached_news_feed(request.user.id, content_type, page_number)
+    cached_data = MongoCacheHelper.get_cached_news_feed(request.user.id, content_type, page_number, cache_sort)
 
     if cached_data:
         print("✅ Данные ленты получены из кэша MongoDB")
-        return render(request, 'posts/news_feed.html', cached_data)
+        return render(request, 'posts/news_feed.html', _with_buffered_engagement(cached_data, request.user))
 
     print("🔄 Данные ленты загружаются из базы данных")
 
@@ -60,10 +75,8 @@ def news_feed(request):
     community_posts = Post.objects.filter(community__in=user_communities)
 
     # Посты друзей
-    friends_posts = Post.objects.none()
-    if hasattr(request.user, 'get_friends'):
-        friends = request.user.get_friends()
-        friends_posts = Post.objects.filter(author__in=friends, community__isnull=True)
+    friend_ids = list(request.user.get_friend_ids())
+    friends_posts = Post.objects.filter(author_id__in=friend_ids, community__isnull=True)
 
     # Применяем фильтрацию
     if content_type == 'communities':
@@ -71,19 +84,26 @@ def news_feed(request):
     elif content_type == 'friends':
         all_posts = friends_posts
     else:
-        all_posts = (community_posts | friends_posts).distinct()
+        all_posts = community_posts | friends_posts
 
     # Аннотируем посты
-    all_posts = all_posts.annotate(
-        like_count=Count('post_likes'),
-        comment_count=Count('comments'),
-        favourite_count=Count('favourited_by')
-    ).order_by('-created_at')
+    all_posts = all_posts.with_engagement().select_related('author', 'community', 'scientific_field').order_by('-created_at')
+
+    # Ранжирование по релевантности среди самых свежих кандидатов, дальше - хронология.
+    # Первая страница ранжирует окно заново, следующие нарезаются из сохраненного порядка
+    if sort == 'relevance':
+        all_posts = RankedFeed(request.user, all_posts, get_ranking_settings()['candidates'],
+                               window_ids=feed_order['ids'] if feed_order else None)
 
     # Пагинация
     paginator = Paginator(all_posts, 20)
     page_obj = paginator.get_page(page_number)
 
+    if sort == 'relevance' and all_posts.reranked:
+        feed_order = {'ids': all_posts.window_ids, 'version': time.time_ns()}
+        MongoCacheHelper.cache_feed_order(request.user.id, content_type, feed_order)
+        cache_sort = f"relevance_{feed_order['version']}"
+
     # Получаем ID избранных постов пользователя
     user_favourite_ids = []
     if request.user.is_authenticated:
@@ -98,46 +118,43 @@ def news_feed(request):
         'page_obj': page_obj,
         'community_count': user_communities.count(),
         'content_type': content_type,
-        'has_friends': hasattr(request.user, 'get_friends') and request.user.get_friends().exists(),
+        'sort': sort,
+        'has_friends': bool(friend_ids),
         'user_favourite_ids': user_favourite_ids,
         'cache_timestamp': time.time()  # Добавляем метку времени
     }
 
     # Сохраняем в кэш
-    MongoCacheHelper.cache_news_feed(request.user.id, content_type, page_number, context)
+    MongoCacheHelper.cache_news_feed(request.user.id, content_type, page_number, context, sort=cache_sort)
+
+    return render(request, 'posts/news_feed.html', _with_buffered_engagement(context, request.user))
+
 
-    return render(request, 'posts/news_feed.html', context)
+def _with_buffered_engagement(context, user):
+    # Лайки и избранное, еще не перенесенные flush_engagement, видны сразу (и поверх кэша страницы)
+    _, favourite_ids = apply_buffered(context['page_obj'], user.id, context['user_favourite_ids'])
+    return {**context, 'user_favourite_ids': favourite_ids}
 
 
 @login_required
 def toggle_favourite(request, post_id):
     """Добавление/удаление поста из избранного"""
-    post = get_object_or_404(Post, id=post_id)
-    favourite, created = FavouritePost.objects.get_or_create(
-        user=request.user,
-        post=post
-    )
+    # Переключение и счетчик - атомарно в буфере, в БД переносит flush_engagement
+    added, favourite_count = engagement_buffer.toggle('favourite', post_id, request.user.id)
 
     # Инвалидируем кэш избранных постов
     MongoCacheHelper.invalidate_user_cache(request.user.id)
 
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        if not created:
-            favourite.delete()
-            return JsonResponse({
-                'status': 'removed',
-                'favourite_count': post.favourited_by.count()
-            })
         return JsonResponse({
-            'status': 'added',
-            'favourite_count': post.favourited_by.count()
+            'status': 'added' if added else 'removed',
+            'favourite_count': favourite_count
         })
 
-    if not created:
-        favourite.delete()
-        messages.info(request, "Пост удален из избранного")
-    else:
+    if added:
         messages.success(request, "Пост добавлен в избранное")
+    else:
+        messages.info(request, "Пост удален из избранного")
 
     return redirect(request.META.get('HTTP_REFERER', 'posts:news_feed'))
 
@@ -161,11 +178,9 @@ def favourite_posts(request):
     print("🔄 Избранные посты загружаются из базы данных")
 
     # Получаем избранные посты
-    favourite_posts = Post.objects.filter(favourited_by__user=request.user).annotate(
-        like_count=Count('post_likes'),
-        comment_count=Count('comments'),
-        favourite_count=Count('favourited_by')
-    ).order_by('-favourited_by__created_at')
+    favourite_posts = Post.objects.filter(favourited_by__user=request.user).with_engagement().order_by(
+        '-favourited_by__created_at'
+    )
 
     # Фильтрация
     if scientific_field_id:
@@ -192,23 +207,91 @@ def favourite_posts(request):
 
 
 @login_required
-def post_detail(request, post_id):
-    """Детальная страница поста"""
-    # Пробуем получить из кэша
-    cached_data = MongoCacheHelper.get_cached_post_detail(post_id)
+def post_search(request):
+    """Поиск публикаций по ключевым словам или DOI с фильтрами"""
+    query = request.GET.get('q', '').strip()
+    post_type = request.GET.get('post_type', '')
+    scientific_field_id = request.GET.get('scientific_field', '')
+    community_id = request.GET.get('community', '')
+
+    page = search_posts(
+        query, post_type=post_type, scientific_field_id=scientific_field_id, community_id=community_id,
+        after=request.GET.get('after')
+    )
 
-    if cached_data:
-        print("✅ Детали поста получены из кэша MongoDB")
-        # Добавляем форму комментария (не кэшируется)
-        cached_data['comment_form'] = CommentForm()
-        return render(request, 'posts/post_detail.html', cached_data)
+    context = {
+        'query': query,
+        'posts': page['results'],
+        'has_more': page['has_more'],
+        'next_cursor': page['next_cursor'],
+        'post_types': Post.POST_TYPES,
+        'scientific_fields': ScientificField.objects.all(),
+        'current_post_type': post_type,
+        'current_field': scientific_field_id,
+        'current_community': community_id,
+    }
+    return render(request, 'posts/post_search.html', context)
 
-    print("🔄 Детали поста загружаются из базы данных")
 
-    post = get_object_or_404(Post, id=post_id)
-    comments = post.comments.all().order_by('created_at')
+@login_required
+def paper_detail(request, doi):
+    """Статья по DOI (в любой записи: с резолвером, префиксом doi: или без): обсуждения, сообщества, похожие статьи"""
+    overview = get_paper_overview(doi)
+    if overview is None:
+        raise Http404("Статья не найдена")
+    return JsonResponse(overview)
+
+
+COMMENTS_PAGE_SIZE = 20
+
+
+def _serialize_comment(comment):
+    """Компактное представление комментария для кэша и JSON"""
+    return {
+        'id': comment.id,
+        'author_username': comment.author.username,
+        'author_name': comment.author.get_full_name() or comment.author.username,
+        'content': comment.content,
+        'created_at': comment.created_at,
+    }
+
+
+def get_comment_page(post_id, after=0):
+    """
+    Страница комментариев поста после курсора (id последнего показанного комментария).
+
+    Страницы кэшируются по курсору. Заполненная страница не меняется при новых
+    комментариях, поэтому добавление комментария сбрасывает только неполные.
+    """
+    cached_page = MongoCacheHelper.get_cached_comment_page(post_id, after)
+    if cached_page is not None:
+        return cached_page
 
+    # Версия хвоста читается до запроса: комментарий, добавленный во время чтения, ее сменит
+    tail_version = MongoCacheHelper.comment_tail_version(post_id)
+
+    comments = list(
+        Comment.objects.filter(post_id=post_id, id__gt=after)
+        .select_related('author')
+        .order_by('id')[:COMMENTS_PAGE_SIZE + 1]
+    )
+    has_more = len(comments) > COMMENTS_PAGE_SIZE
+    comments = [_serialize_comment(comment) for comment in comments[:COMMENTS_PAGE_SIZE]]
+
+    page = {
+        'comments': comments,
+        'next_cursor': comments[-1]['id'] if comments else after,
+        'has_more': has_more,
+    }
+    MongoCacheHelper.cache_comment_page(post_id, after, page, is_tail=not has_more, tail_version=tail_version)
+    return page
+
+
+@login_required
+def post_detail(request, post_id):
+    """Детальная страница поста"""
     if request.method == 'POST':
+        post = get_object_or_404(Post, id=post_id)
         comment_form = CommentForm(request.POST)
         if comment_form.is_valid():
             comment = comment_form.save(commit=False)
@@ -216,58 +299,87 @@ def post_detail(request, post_id):
             comment.post = post
             comment.save()
 
-            # Инвалидируем кэш поста при добавлении комментария
-            MongoCacheHelper.invalidate_post_cache(post_id)
+            # Новый комментарий попадает только на неполные страницы
+            MongoCacheHelper.invalidate_comment_tail(post_id)
 
             messages.success(request, "Комментарий добавлен!")
             return redirect('posts:post_detail', post_id=post.id)
     else:
         comment_form = CommentForm()
 
+    # Пробуем получить из кэша
+    cached_data = MongoCacheHelper.get_cached_post_detail(post_id)
+
+    if cached_data:
+        print("✅ Детали поста получены из кэша MongoDB")
+        context = cached_data
+    else:
+        print("🔄 Детали поста загружаются из базы данных")
+        post = get_object_or_404(Post.objects.select_related('author', 'scientific_field'), id=post_id)
+        context = {
+            'post': post,
+            'cache_timestamp': time.time()
+        }
+        MongoCacheHelper.cache_post_detail(post_id, context)
+
+    apply_buffered([context['post']])
+
+    # Комментарии и форма кэшируются отдельно от поста
+    comment_page = get_comment_page(post_id)
     context = {
-        'post': post,
-        'comments': comments,
+        **context,
+        'comments': comment_page['comments'],
+        'comments_next_cursor': comment_page['next_cursor'],
+        'comments_has_more': comment_page['has_more'],
         'comment_form': comment_form,
-        'cache_timestamp': time.time()
     }
 
-    # Сохраняем в кэш (без формы)
-    cache_context = context.copy()
-    cache_context.pop('comment_form', None)  # Убираем форму из кэша
-    MongoCacheHelper.cache_post_detail(post_id, cache_context)
-
     return render(request, 'posts/post_detail.html', context)
 
 
+@login_required
+def post_comments(request, post_id):
+    """JSON: следующая страница комментариев («Загрузить еще»)"""
+    try:
+        after = int(request.GET.get('after', 0))
+    except ValueError:
+        return JsonResponse({'error': 'Некорректный курсор'}, status=400)
+
+    if not Post.objects.filter(id=post_id).exists():
+        return JsonResponse({'error': 'Публикация не найдена'}, status=404)
+
+    page = get_comment_page(post_id, after)
+    comments = [
+        {
+            **comment,
+            'created_at': comment['created_at'].isoformat(),
+            'created_at_display': date_format(localtime(comment['created_at']), 'd.m.Y H:i'),
+        }
+        for comment in page['comments']
+    ]
+    return JsonResponse({
+        'comments': comments,
+        'next_cursor': page['next_cursor'],
+        'has_more': page['has_more'],
+    })
+
+
 @login_required
 def like_post(request, post_id):
     """Лайк/анлайк поста"""
-    post = get_object_or_404(Post, id=post_id)
-    like, created = PostLike.objects.get_or_create(
-        user=request.user,
-        post=post
-    )
-
-    # Инвалидируем кэш поста
-    MongoCacheHelper.invalidate_post_cache(post_id)
+    # Кэш поста не инвалидируем: при «шторме» лайков он был бы постоянно холодным
+    liked, like_count = engagement_buffer.toggle('like', post_id, request.user.id)
 
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        if not created:
-            like.delete()
-            return JsonResponse({
-                'liked': False,
-                'like_count': post.post_likes.count()
-            })
         return JsonResponse({
-            'liked': True,
-            'like_count': post.post_likes.count()
+            'liked': liked,
+            'like_count': like_count
         })
 
-    if not created:
-        like.delete()
-        messages.info(request, "Лайк удален")
-    else:
+    if liked:
         messages.success(request, "Пост лайкнут")
+    else:
+        messages.info(request, "Лайк удален")
 
     return redirect(request.META.get('HTTP_REFERER', 'posts:news_feed'))
 
@@ -0,0 +1,117 @@
+import threading
+import uuid
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from django.conf import settings
+
+from utils.mongo_cache import cache
+
+
+class FriendGraphCache:
+    """
+    Кэш списков смежности графа дружбы в памяти процесса.
+
+    Для каждого пользователя хранится отсортированный массив id друзей.
+    Актуальность проверяется по версии пользователя в общем для всех
+    процессов кэше MongoDB: изменение дружбы в любом процессе меняет версию,
+    и локальная копия перечитывается из таблицы FriendEdge при следующем
+    обращении. Версии живут ограниченное время; истекшая версия заменяется
+    новой, и копия просто перечитывается.
+    """
+
+    VERSION_KEY = 'friend_graph_version_{}'
+
+    def __init__(self, max_users=None, version_timeout=None):
+        self.max_users = max_users or getattr(settings, 'FRIEND_GRAPH_CACHE_SIZE', 10000)
+        self.version_timeout = version_timeout or getattr(settings, 'FRIEND_GRAPH_VERSION_TIMEOUT', 86400)
+        self._entries = OrderedDict()  # user_id -> (версия, array друзей)
+        self._lock = threading.Lock()
+
+    def friend_ids(self, user_id):
+        """Отсортированный массив id друзей пользователя"""
+        return self._get_many([user_id])[user_id]
+
+    def are_friends(self, user_id, other_id):
+        """Проверка дружбы бинарным поиском, O(log n)"""
+        friends = self.friend_ids(user_id)
+        index = bisect_left(friends, other_id)
+        return index < len(friends) and friends[index] == other_id
+
+    def mutual_count(self, user_id, other_id):
+        """Количество общих друзей: бинарный поиск элементов меньшего массива в большем"""
+        adjacency = self._get_many([user_id, other_id])
+        smaller, larger = sorted((adjacency[user_id], adjacency[other_id]), key=len)
+        count = 0
+        size = len(larger)
+        for friend_id in smaller:
+            index = bisect_left(larger, friend_id)
+            if index < size and larger[index] == friend_id:
+                count += 1
+        return count
+
+    def invalidate(self, *user_ids):
+        """Сменить версии пользователей, чтобы все процессы перечитали их друзей"""
+        cache.set_many(
+            {self.VERSION_KEY.format(user_id): uuid.uuid4().hex for user_id in user_ids}, self.version_timeout
+        )
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get_many(self, user_ids):
+        versions = self._current_versions(user_ids)
+        result = {}
+        missing = []
+
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._entries.get(user_id)
+                if entry and entry[0] == versions[user_id]:
+                    self._entries.move_to_end(user_id)
+                    result[user_id] = entry[1]
+                else:
+                    missing.append(user_id)
+
+        if missing:
+            loaded = self._load(missing)
+            with self._lock:
+                for user_id, friends in loaded.items():
+                    self._entries[user_id] = (versions[user_id], friends)
+                    self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_users:
+                    self._entries.popitem(last=False)
+            result.update(loaded)
+
+        return result
+
+    def _current_versions(self, user_ids):
+        keys = {self.VERSION_KEY.format(user_id): user_id for user_id in user_ids}
+        stored = cache.get_many(keys)
+
+        # Пользователю без версии выдаем новую, чтобы вытеснение ключа из
+        # общего кэша никогда не совпало с версией устаревшей локальной копии
+        fresh = {key: uuid.uuid4().hex for key in keys if key not in stored}
+        for key, version in fresh.items():
+            if not cache.add(key, version, self.version_timeout):
+                version = cache.get(key, version)
+            stored[key] = version
+
+        return {user_id: stored[key] for key, user_id in keys.items()}
+
+    def _load(self, user_ids):
+        from .models import FriendEdge
+
+        loaded = {user_id: array('q') for user_id in user_ids}
+        edges = FriendEdge.objects.filter(user_id__in=user_ids).order_by('user_id', 'friend_id')
+        for user_id, friend_id in edges.values_list('user_id', 'friend_id'):
+            loaded[user_id].append(friend_id)
+        return loaded
+
+
+friend_graph = FriendGraphCache()
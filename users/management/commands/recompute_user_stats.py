@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from users.models import User, UserStats
+
+
+class Command(BaseCommand):
+    help = 'Recompute profile statistics of all users from posts, comments, memberships, friendships and likes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Users per UPDATE'
+        )
+
+    def handle(self, *args, **options):
+        last_id = total = 0
+        while True:
+            user_ids = list(
+                User.objects.filter(id__gt=last_id).order_by('id')
+                .values_list('id', flat=True)[:options['batch_size']]
+            )
+            if not user_ids:
+                break
+            UserStats.recompute(user_ids)
+            total += len(user_ids)
+            last_id = user_ids[-1]
+
+        self.stdout.write(self.style.SUCCESS(f"Recomputed statistics of {total} users"))
@@ -0,0 +1,27 @@
+from django.db import migrations
+
+
+def backfill_friend_edges(apps, schema_editor):
+    Friendship = apps.get_model('users', 'Friendship')
+    FriendEdge = apps.get_model('users', 'FriendEdge')
+
+    pairs = Friendship.objects.filter(status='accepted').values_list('from_user_id', 'to_user_id')
+    edges = []
+    for from_user_id, to_user_id in pairs.iterator(chunk_size=2000):
+        edges.append(FriendEdge(user_id=from_user_id, friend_id=to_user_id))
+        edges.append(FriendEdge(user_id=to_user_id, friend_id=from_user_id))
+        if len(edges) >= 2000:
+            FriendEdge.objects.bulk_create(edges, ignore_conflicts=True)
+            edges = []
+    FriendEdge.objects.bulk_create(edges, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_friendedge'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_friend_edges, migrations.RunPython.noop),
+    ]
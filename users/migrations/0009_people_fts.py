@@ -0,0 +1,99 @@
+from django.db import migrations
+
+
+# Индекс собирается из двух таблиц (пользователь и профиль), поэтому хранит
+# собственную копию текста. rowid строки индекса = id пользователя.
+# Триггеры пересобирают строку пользователя при любом изменении полей,
+# которые в нее попадают, в том числе при bulk_create и update().
+REFRESH_SQL = """
+        DELETE FROM users_people_fts WHERE rowid = {user_id};
+        INSERT INTO users_people_fts(rowid, name, institution, interests)
+        SELECT u.id, u.username || ' ' || u.first_name || ' ' || u.last_name,
+               COALESCE(p.institution, ''), COALESCE(p.research_interests, '')
+        FROM users_user u LEFT JOIN users_profile p ON p.user_id = u.id
+        WHERE u.id = {user_id};
+"""
+
+FTS_SQL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS users_people_fts USING fts5(
+        name, institution, interests,
+        tokenize='unicode61 remove_diacritics 2', prefix='1 2 3'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS users_people_fts_user_insert AFTER INSERT ON users_user BEGIN
+        {REFRESH_SQL.format(user_id='new.id')}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS users_people_fts_user_update
+    AFTER UPDATE OF username, first_name, last_name ON users_user BEGIN
+        {REFRESH_SQL.format(user_id='new.id')}
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_people_fts_user_delete AFTER DELETE ON users_user BEGIN
+        DELETE FROM users_people_fts WHERE rowid = old.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS users_people_fts_profile_insert AFTER INSERT ON users_profile BEGIN
+        {REFRESH_SQL.format(user_id='new.user_id')}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS users_people_fts_profile_update
+    AFTER UPDATE OF institution, research_interests ON users_profile BEGIN
+        {REFRESH_SQL.format(user_id='new.user_id')}
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS users_people_fts_profile_delete AFTER DELETE ON users_profile BEGIN
+        {REFRESH_SQL.format(user_id='old.user_id')}
+    END
+    """,
+    """
+    INSERT INTO users_people_fts(rowid, name, institution, interests)
+    SELECT u.id, u.username || ' ' || u.first_name || ' ' || u.last_name,
+           COALESCE(p.institution, ''), COALESCE(p.research_interests, '')
+    FROM users_user u LEFT JOIN users_profile p ON p.user_id = u.id
+    """,
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS users_people_fts_profile_delete",
+    "DROP TRIGGER IF EXISTS users_people_fts_profile_update",
+    "DROP TRIGGER IF EXISTS users_people_fts_profile_insert",
+    "DROP TRIGGER IF EXISTS users_people_fts_user_delete",
+    "DROP TRIGGER IF EXISTS users_people_fts_user_update",
+    "DROP TRIGGER IF EXISTS users_people_fts_user_insert",
+    "DROP TABLE IF EXISTS users_people_fts",
+]
+
+
+def _execute_on_sqlite(schema_editor, statements):
+    # FTS5 есть только в SQLite; на других СУБД поиск работает без индекса
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def create_people_fts(apps, schema_editor):
+    _execute_on_sqlite(schema_editor, FTS_SQL)
+
+
+def drop_people_fts(apps, schema_editor):
+    _execute_on_sqlite(schema_editor, DROP_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_backfill_friendedge'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_people_fts, drop_people_fts),
+    ]
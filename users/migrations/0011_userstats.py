@@ -0,0 +1,30 @@
+# Generated by Django 4.2.7 on 2026-10-19 12:44
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0010_user_updated_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+                ('posts_count', models.PositiveIntegerField(default=0, verbose_name='Публикации')),
+                ('comments_count', models.PositiveIntegerField(default=0, verbose_name='Комментарии')),
+                ('communities_count', models.PositiveIntegerField(default=0, verbose_name='Сообщества')),
+                ('friends_count', models.PositiveIntegerField(default=0, verbose_name='Друзья')),
+                ('likes_received', models.PositiveIntegerField(default=0, verbose_name='Полученные лайки')),
+            ],
+            options={
+                'verbose_name': 'Статистика пользователя',
+                'verbose_name_plural': 'Статистика пользователей',
+            },
+        ),
+    ]
@@ -1,5 +1,11 @@
+from collections import defaultdict
+
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+from .friend_graph import friend_graph
 
 
 class ScientificField(models.Model):
@@ -41,44 +47,27 @@ class User(AbstractUser):
 
     def get_unread_chats_count(self):
         """Количество чатов с непрочитанными сообщениями"""
-        from chats.models import Chat, ChatMember, Message
-        user_chats = Chat.objects.filter(members=self)
-        unread_count = 0
-
-        for chat in user_chats:
-            try:
-                chat_member = ChatMember.objects.get(chat=chat, user=self)
-                unread_messages = Message.objects.filter(
-                    chat=chat,
-                    created_at__gt=chat_member.last_read
-                ).count()
-                if unread_messages > 0:
-                    unread_count += 1
-            except ChatMember.DoesNotExist:
-                continue
-
-        return unread_count
+        from chats.models import ChatMember
+        return ChatMember.objects.filter(user=self).with_unread().filter(unread__gt=0).count()
 
     class Meta:
         verbose_name = "Пользователь"
         verbose_name_plural = "Пользователи"
+        indexes = [
+            # Дочитывание измененных пользователей индексом автодополнения
+            models.Index(fields=['updated_at'], name='user_updated_idx'),
+        ]
 
     def __str__(self):
         return self.username
 
     def get_friends(self):
         """Получить список принятых друзей"""
-        # Друзья, которые приняли наши запросы
-        sent_accepted = User.objects.filter(
-            friendship_requests_received__from_user=self,
-            friendship_requests_received__status='accepted'
-        )
-        # Друзья, чьи запросы мы приняли
-        received_accepted = User.objects.filter(
-            friendship_requests_sent__to_user=self,
-            friendship_requests_sent__status='accepted'
-        )
-        return (sent_accepted | received_accepted).distinct()
+        return User.objects.filter(id__in=self.get_friend_ids())
+
+    def get_friend_ids(self):
+        """Отсортированные id друзей из кэша графа дружбы (без запроса к БД при попадании)"""
+        return friend_graph.friend_ids(self.id)
 
     def get_pending_requests(self):
         """Получить входящие запросы дружбы"""
@@ -90,16 +79,19 @@ class User(AbstractUser):
 
     def get_friends_count(self):
         """Количество друзей"""
-        return self.get_friends().count()
+        return len(self.get_friend_ids())
 
     def is_friends_with(self, user):
         """Проверить, друзья ли с пользователем"""
         if not user.is_authenticated:
             return False
-        return Friendship.objects.filter(
-            models.Q(from_user=self, to_user=user, status='accepted') |
-            models.Q(from_user=user, to_user=self, status='accepted')
-        ).exists()
+        return friend_graph.are_friends(self.id, user.id)
+
+    def get_mutual_friends_count(self, user):
+        """Количество общих друзей с пользователем"""
+        if not user.is_authenticated:
+            return 0
+        return friend_graph.mutual_count(self.id, user.id)
 
     def has_pending_request_from(self, user):
         """Есть ли pending запрос от пользователя"""
@@ -188,6 +180,10 @@ class Friendship(models.Model):
         verbose_name_plural = "Запросы дружбы"
         unique_together = ('from_user', 'to_user')
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['from_user', 'status'], name='friendship_from_status_idx'),
+            models.Index(fields=['to_user', 'status'], name='friendship_to_status_idx'),
+        ]
 
     def __str__(self):
         return f"{self.from_user} → {self.to_user} ({self.status})"
@@ -202,5 +198,159 @@ class Friendship(models.Model):
         self.status = 'rejected'
         self.save()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Принята ли дружба в БД; None - статус не загружен
+        instance._accepted_in_db = instance.status == 'accepted' if 'status' in instance.__dict__ else None
+        return instance
+
+    def save(self, *args, **kwargs):
+        # Поддерживаем симметричные ребра графа дружбы в одной транзакции с запросом.
+        # Ребра и кэш трогаем, только когда дружба становится принятой или перестает ею быть;
+        # если прежний статус неизвестен, ребра синхронизируются безусловно
+        accepted = self.status == 'accepted'
+        accepted_before = False if self._state.adding else getattr(self, '_accepted_in_db', None)
+        update_fields = kwargs.get('update_fields')
+        status_saved = update_fields is None or 'status' in update_fields
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if status_saved and accepted != accepted_before:
+                if accepted:
+                    FriendEdge.link(self.from_user_id, self.to_user_id)
+                else:
+                    FriendEdge.unlink(self.from_user_id, self.to_user_id)
+        if status_saved:
+            self._accepted_in_db = accepted
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            FriendEdge.unlink(self.from_user_id, self.to_user_id)
+            return super().delete(*args, **kwargs)
+
+
+class FriendEdge(models.Model):
+    """
+    Материализованное симметричное ребро графа дружбы.
+
+    На каждую принятую дружбу хранятся две строки (user -> friend и
+    friend -> user), поэтому список друзей читается одним запросом по индексу.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='friend_edges',
+                             verbose_name="Пользователь")
+    friend = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+', verbose_name="Друг")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+
+    class Meta:
+        verbose_name = "Связь дружбы"
+        verbose_name_plural = "Связи дружбы"
+        unique_together = ('user', 'friend')
+
+    def __str__(self):
+        return f"{self.user_id} ↔ {self.friend_id}"
+
+    @classmethod
+    def link(cls, user_id, friend_id):
+        cls.objects.bulk_create(
+            [cls(user_id=user_id, friend_id=friend_id), cls(user_id=friend_id, friend_id=user_id)],
+            ignore_conflicts=True
+        )
+        cls._invalidate(user_id, friend_id)
+
+    @classmethod
+    def unlink(cls, user_id, friend_id):
+        cls.objects.filter(
+            models.Q(user_id=user_id, friend_id=friend_id) |
+            models.Q(user_id=friend_id, friend_id=user_id)
+        ).delete()
+        cls._invalidate(user_id, friend_id)
+
+    @staticmethod
+    def _invalidate(*user_ids):
+        # Версии меняем после фиксации транзакции, иначе другой процесс
+        # может успеть перечитать еще не зафиксированное состояние
+        transaction.on_commit(lambda: friend_graph.invalidate(*user_ids))
+        UserStats.recompute(user_ids, fields=['friends_count'])
+
+
+class UserStats(models.Model):
+    """
+    Статистика пользователя для страниц профиля одной строкой.
+
+    Счетчики поддерживаются путями записи (посты, комментарии, членства,
+    дружба, перенос лайков из буфера) через increment(). Строка создается
+    при первом чтении (for_user) или командой recompute_user_stats, которая
+    также исправляет накопившееся расхождение после каскадных удалений.
+    """
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='stats',
+                                verbose_name="Пользователь")
+    posts_count = models.PositiveIntegerField(default=0, verbose_name="Публикации")
+    comments_count = models.PositiveIntegerField(default=0, verbose_name="Комментарии")
+    communities_count = models.PositiveIntegerField(default=0, verbose_name="Сообщества")
+    friends_count = models.PositiveIntegerField(default=0, verbose_name="Друзья")
+    likes_received = models.PositiveIntegerField(default=0, verbose_name="Полученные лайки")
+
+    class Meta:
+        verbose_name = "Статистика пользователя"
+        verbose_name_plural = "Статистика пользователей"
+
+    def __str__(self):
+        return f"Статистика {self.user_id}"
+
+    @classmethod
+    def for_user(cls, user):
+        """Статистика пользователя; без строки - пересчитать и создать ее"""
+        try:
+            return user.stats
+        except cls.DoesNotExist:
+            cls.recompute([user.id])
+            return cls.objects.get(user_id=user.id)
+
+    @classmethod
+    def increment(cls, field, deltas):
+        """
+        Прибавить к счетчику field изменения {id пользователя: delta}.
+
+        Одно UPDATE на каждое различное значение delta (обычно ±1). У кого строки
+        еще нет, тем ничего не пишется: она будет посчитана целиком при чтении.
+        """
+        by_delta = defaultdict(list)
+        for user_id, delta in deltas.items():
+            if delta:
+                by_delta[delta].append(user_id)
+        for delta, user_ids in by_delta.items():
+            cls.objects.filter(user_id__in=user_ids).update(**{field: Greatest(F(field) + delta, 0)})
+
+    @classmethod
+    def recompute(cls, user_ids, fields=None):
+        """
+        Пересчитать статистику пользователей по исходным таблицам одним UPDATE.
+
+        Полный пересчет создает недостающие строки; пересчет отдельных полей
+        (fields) затрагивает только существующие.
+        """
+        from communities.models import CommunityMembership
+        from posts.models import Comment, Post, PostLike
+
+        def total(queryset, key):
+            counts = queryset.filter(**{key: OuterRef('pk')}).order_by().values(key).annotate(total=Count('*'))
+            return Coalesce(Subquery(counts.values('total')), 0)
+
+        sources = {
+            'posts_count': (Post.objects, 'author_id'),
+            'comments_count': (Comment.objects, 'author_id'),
+            'communities_count': (CommunityMembership.objects, 'user_id'),
+            'friends_count': (FriendEdge.objects, 'user_id'),
+            'likes_received': (PostLike.objects, 'post__author_id'),
+        }
+        user_ids = list(user_ids)
+        if fields is None:
+            cls.objects.bulk_create([cls(user_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+        cls.objects.filter(user_id__in=user_ids).update(**{
+            field: total(*sources[field]) for field in (fields or sources)
+        })
+
 
 # Пользователи: admin/admin; user1/1234567890AA; user2/1234567DD; user3/123456789XX
\ No newline at end of file
@@ -0,0 +1,89 @@
+from django.db import connection
+from django.db.models import Q
+
+from utils.fts import make_cursor, parse_cursor, parse_query, prefix_query
+from .models import User
+
+
+PEOPLE_PAGE_SIZE = 20
+
+# Веса bm25 по колонкам индекса: имя важнее учреждения, учреждение важнее интересов
+NAME_WEIGHT, INSTITUTION_WEIGHT, INTERESTS_WEIGHT = 10.0, 3.0, 1.0
+
+
+def search_people(query, exclude_user_id=None, after=None, limit=PEOPLE_PAGE_SIZE):
+    """
+    Поиск людей по имени, username, учреждению и научным интересам.
+
+    Результаты ранжированы по релевантности, курсор after - значение
+    next_cursor предыдущей страницы. Возвращает {'results', 'has_more',
+    'next_cursor'}, результаты - пользователи с подгруженным профилем.
+    """
+    tokens = parse_query(query)
+    if not tokens:
+        return {'results': [], 'has_more': False, 'next_cursor': None}
+
+    after = parse_cursor(after)
+    if connection.vendor == 'sqlite':
+        rows = _search_fts(tokens, exclude_user_id, after, limit + 1)
+    else:
+        rows = _search_scan(tokens, exclude_user_id, after, limit + 1)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    users = User.objects.select_related('profile').in_bulk([user_id for user_id, _ in rows])
+    results = [users[user_id] for user_id, _ in rows if user_id in users]
+
+    return {
+        'results': results,
+        'has_more': has_more,
+        'next_cursor': make_cursor(rows[-1][1], rows[-1][0]) if has_more else None,
+    }
+
+
+def _search_fts(tokens, exclude_user_id, after, limit):
+    """
+    Поиск по индексу FTS5: bm25 ранжирует все совпадения, так что точное
+    совпадение имени находится и среди тысяч совпадений короткого префикса.
+    Страницы идут по (оценка, id) без OFFSET.
+    """
+    sql = """
+        SELECT id, score FROM (
+            SELECT rowid AS id, bm25(users_people_fts, %s, %s, %s) AS score
+            FROM users_people_fts
+            WHERE users_people_fts MATCH %s
+        )
+        WHERE 1
+    """
+    params = [NAME_WEIGHT, INSTITUTION_WEIGHT, INTERESTS_WEIGHT, prefix_query(tokens)]
+    if exclude_user_id is not None:
+        sql += ' AND id != %s'
+        params.append(exclude_user_id)
+    if after is not None:
+        sql += ' AND (score > %s OR (score = %s AND id > %s))'
+        params.extend([after[0], after[0], after[1]])
+    sql += ' ORDER BY score, id LIMIT %s'
+    params.append(limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def _search_scan(tokens, exclude_user_id, after, limit):
+    """Подстрочный поиск по имени, username, учреждению и интересам; порядок по id, от курсора берется только id"""
+    users = User.objects.all()
+    for token in tokens:
+        users = users.filter(
+            Q(username__icontains=token) |
+            Q(first_name__icontains=token) |
+            Q(last_name__icontains=token) |
+            Q(profile__institution__icontains=token) |
+            Q(profile__research_interests__icontains=token)
+        )
+    if exclude_user_id is not None:
+        users = users.exclude(id=exclude_user_id)
+    if after is not None:
+        users = users.filter(id__gt=after[1])
+    return [(user_id, 0.0) for user_id in users.order_by('id').values_list('id', flat=True)[:limit]]
@@ -1,3 +1,351 @@
+from unittest import mock, skipUnless
+
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from communities.members import apply_member_changes
+from communities.models import Community, CommunityMembership
+from posts.models import Comment, Post, PostLike
+
+from .friend_graph import friend_graph
+from .models import User, Friendship, FriendEdge, Profile, UserStats
+from .search import search_people
+from .typeahead import TypeaheadIndex, typeahead
+
+
+class FriendGraphTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol, cls.dave = [
+            User.objects.create_user(username=name, password='password')
+            for name in ('alice', 'bob', 'carol', 'dave')
+        ]
+
+    def setUp(self):
+        friend_graph.clear()
+
+    def befriend(self, from_user, to_user):
+        with self.captureOnCommitCallbacks(execute=True):
+            friendship = Friendship.objects.create(from_user=from_user, to_user=to_user)
+            friendship.accept()
+        return friendship
+
+    def test_accept_creates_symmetric_edges(self):
+        self.befriend(self.alice, self.bob)
+
+        self.assertTrue(FriendEdge.objects.filter(user=self.alice, friend=self.bob).exists())
+        self.assertTrue(FriendEdge.objects.filter(user=self.bob, friend=self.alice).exists())
+        self.assertTrue(self.alice.is_friends_with(self.bob))
+        self.assertTrue(self.bob.is_friends_with(self.alice))
+        self.assertEqual(list(self.bob.get_friends()), [self.alice])
+
+    def test_pending_request_is_not_friendship(self):
+        Friendship.objects.create(from_user=self.alice, to_user=self.bob)
+
+        self.assertFalse(self.alice.is_friends_with(self.bob))
+        self.assertEqual(self.alice.get_friends_count(), 0)
+
+    def test_delete_removes_edges_and_invalidates_cache(self):
+        friendship = self.befriend(self.alice, self.bob)
+        self.assertEqual(self.alice.get_friends_count(), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            friendship.delete()
+
+        self.assertFalse(FriendEdge.objects.exists())
+        self.assertFalse(self.alice.is_friends_with(self.bob))
+        self.assertEqual(self.bob.get_friends_count(), 0)
+
+    def test_reject_after_accept_removes_edges(self):
+        friendship = self.befriend(self.alice, self.bob)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            friendship.reject()
+
+        self.assertFalse(self.alice.is_friends_with(self.bob))
+
+    def test_save_without_status_change_keeps_edges(self):
+        self.befriend(self.alice, self.bob)
+        pending = Friendship.objects.create(from_user=self.carol, to_user=self.dave)
+
+        # Повторное сохранение принятой дружбы и отклонение запроса, который не был принят
+        pending.status = 'rejected'
+        friendships = [Friendship.objects.get(from_user=self.alice), pending]
+        with mock.patch.object(friend_graph, 'invalidate') as invalidate:
+            for friendship in friendships:
+                with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as queries:
+                    friendship.save()
+                self.assertFalse([q for q in queries if 'users_friendedge' in q['sql']])
+        invalidate.assert_not_called()
+        self.assertTrue(self.alice.is_friends_with(self.bob))
+
+    def test_versions_are_shared_between_processes(self):
+        # Второй экземпляр кэша - как граф другого процесса: видит смену версий через MongoDB
+        other_process = type(friend_graph)()
+        self.assertEqual(list(other_process.friend_ids(self.alice.id)), [])
+
+        self.befriend(self.alice, self.bob)
+        self.assertEqual(list(other_process.friend_ids(self.alice.id)), [self.bob.id])
+
+    def test_cached_lookups_do_not_query_database(self):
+        for friend in (self.bob, self.carol):
+            self.befriend(self.alice, friend)
+            self.befriend(self.dave, friend)
+
+        self.assertEqual(self.alice.get_mutual_friends_count(self.dave), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.alice.get_friends_count(), 2)
+            self.assertTrue(self.alice.is_friends_with(self.carol))
+            self.assertFalse(self.alice.is_friends_with(self.dave))
+            self.assertEqual(self.alice.get_mutual_friends_count(self.dave), 2)
+
+
+class PeopleSearchTests(TestCase):
+    def setUp(self):
+        typeahead.clear()
+        self.alice = User.objects.create_user(username='alice', password='password')
+        self.ivan = User.objects.create_user(username='ivan_p', first_name='Иван', last_name='Петров',
+                                             password='password')
+        self.jose = User.objects.create_user(username='jlopez', first_name='José', last_name='López',
+                                             password='password')
+        Profile.objects.create(user=self.ivan, institution='МГУ', research_interests='квантовая оптика')
+        Profile.objects.create(user=self.jose, research_interests='оптика, спектроскопия')
+
+    def ids(self, query, **kwargs):
+        return [user.id for user in search_people(query, **kwargs)['results']]
+
+    def test_case_accent_folding_and_prefixes(self):
+        self.assertEqual(self.ids('иван'), [self.ivan.id])
+        self.assertEqual(self.ids('ПЕТР'), [self.ivan.id])
+        self.assertEqual(self.ids('jose lop'), [self.jose.id])
+        self.assertEqual(self.ids('ivan'), [self.ivan.id])
+
+    def test_profile_fields_and_ranking(self):
+        self.assertEqual(self.ids('мгу'), [self.ivan.id])
+        # Совпадение в имени весит больше, чем в научных интересах
+        optikov = User.objects.create_user(username='optikov', last_name='Оптиков', password='password')
+        results = self.ids('оптик')
+        self.assertEqual(results[0], optikov.id)
+        self.assertEqual(set(results[1:]), {self.ivan.id, self.jose.id})
+
+    def test_index_follows_changes(self):
+        profile = self.ivan.profile
+        profile.institution = 'СПбГУ'
+        profile.save()
+        self.assertEqual(self.ids('мгу'), [])
+        self.assertEqual(self.ids('спбгу'), [self.ivan.id])
+
+        self.ivan.last_name = 'Сидоров'
+        self.ivan.save()
+        self.assertEqual(self.ids('петров'), [])
+        self.assertEqual(self.ids('сидоров'), [self.ivan.id])
+
+        self.ivan.delete()
+        self.assertEqual(self.ids('сидоров'), [])
+
+    def test_cursor_pagination_and_exclusion(self):
+        users = [User.objects.create_user(username=f'chem{i}', password='password') for i in range(5)]
+        page = search_people('chem', limit=3)
+        self.assertTrue(page['has_more'])
+        rest = search_people('chem', after=page['next_cursor'], limit=3)
+        self.assertFalse(rest['has_more'])
+        found = [user.id for user in page['results'] + rest['results']]
+        self.assertCountEqual(found, [user.id for user in users])
+
+        self.assertNotIn(users[0].id, self.ids('chem', exclude_user_id=users[0].id))
+        self.assertEqual(self.ids('"*()'), [])
+
+    @skipUnless(connection.vendor == 'sqlite', 'Индекс FTS5 доступен только в SQLite')
+    def test_older_exact_match_is_found_among_many_prefix_matches(self):
+        exact = User.objects.create_user(username='iv', first_name='Iv', last_name='Iv', password='password')
+        User.objects.bulk_create([User(username=f'ivanov{i}', first_name='Ivan') for i in range(60)])
+        User.objects.bulk_create([User(username=f'ivan_{i}', first_name='Ivanka') for i in range(60)])
+        self.assertEqual(self.ids('iv')[0], exact.id)
+
+    def test_search_views(self):
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('users:search_users'), {'q': 'оптика'})
+        self.assertContains(response, '@ivan_p')
+        self.assertContains(response, '@jlopez')
+
+        response = self.client.get(reverse('chats:search_users'), {'q': 'петров'})
+        self.assertEqual(response.json(), [{'id': self.ivan.id, 'name': 'Иван Петров'}])
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TypeaheadTests(TestCase):
+    def setUp(self):
+        friend_graph.clear()
+        self.clock = FakeClock()
+        self.index = TypeaheadIndex(refresh_interval=30, reload_interval=900, clock=self.clock)
+        self.alice = User.objects.create_user(username='alice', password='password')
+        self.bob = User.objects.create_user(username='bob', password='password')
+        self.olga = User.objects.create_user(username='olga', first_name='Ольга', last_name='Ёлкина',
+                                             password='password')
+
+    def labels(self, query, **kwargs):
+        return [result['label'] for result in self.index.lookup(query, **kwargs)]
+
+    def test_prefixes_across_kinds_with_folding(self):
+        from communities.models import Community
+        from .models import ScientificField
+
+        Community.objects.create(name='Quantum Optics', created_by=self.alice)
+        ScientificField.objects.create(name='Оптика')
+        self.assertEqual(self.labels('opt'), ['Quantum Optics'])
+        self.assertEqual(self.labels('ОПТ'), ['Оптика'])
+        self.assertEqual(self.labels('елк'), ['Ольга Ёлкина'])
+        self.assertEqual(self.labels('ol', kinds=('community',)), [])
+
+    def test_popularity_and_friend_boost(self):
+        from communities.models import Community, CommunityMembership
+
+        small = Community.objects.create(name='Bio small', created_by=self.alice)
+        large = Community.objects.create(name='Bio large', created_by=self.alice)
+        for user in (self.alice, self.bob):
+            CommunityMembership.objects.create(user=user, community=large)
+        self.assertEqual(self.labels('bio'), [large.name, small.name])
+
+        bobby = User.objects.create_user(username='bobby', password='password')
+        carol = User.objects.create_user(username='carol', password='password')
+        for user in (carol, self.olga):
+            FriendEdge.link(bobby.id, user.id)
+        self.index.reload()
+        self.assertEqual(self.labels('bob'), ['bobby', 'bob'])
+        FriendEdge.link(self.alice.id, self.bob.id)
+        self.assertEqual(self.labels('bob', user_id=self.alice.id), ['bob', 'bobby'])
+        self.assertEqual(self.labels('bob', user_id=self.alice.id, exclude=[self.bob.id]), ['bobby'])
+
+    @mock.patch('users.typeahead.MEMO_THRESHOLD', 0)
+    def test_exclude_does_not_shrink_results(self):
+        users = [User.objects.create_user(username=f'zed{number:02}', password='password') for number in range(12)]
+        self.assertEqual(len(self.labels('zed')), 10)
+        excluded = [user.id for user in users[:3]]
+        self.assertCountEqual(self.labels('zed', exclude=excluded), [user.username for user in users[3:]])
+
+    @mock.patch('users.typeahead.MEMO_THRESHOLD', 0)
+    def test_incremental_refresh(self):
+        self.assertEqual(self.labels('ol'), ['Ольга Ёлкина'])
+        User.objects.create_user(username='oleg', password='password')
+        self.olga.first_name = 'Мария'
+        self.olga.save()
+        self.assertEqual(self.labels('ol'), ['Ольга Ёлкина'])
+
+        self.clock.now = 31
+        self.assertCountEqual(self.labels('ol'), ['oleg', 'Мария Ёлкина'])
+        self.assertEqual(self.labels('мар'), ['Мария Ёлкина'])
+        self.assertEqual(self.labels('ольг'), [])
+        self.assertEqual(len(self.index), 3 + 1)
+
+        self.olga.is_active = False
+        self.olga.save()
+        self.clock.now = 62
+        self.assertEqual(self.labels('ol'), ['oleg'])
+        self.assertEqual(self.labels('мар'), [])
+        self.assertEqual(len(self.index), 3)
+
+    def test_endpoint(self):
+        typeahead.clear()
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('users:typeahead'), {'q': 'al'})
+        self.assertEqual(response.json(), {'results': []})
+
+        response = self.client.get(reverse('users:typeahead'), {'q': 'bo', 'types': 'user'})
+        self.assertEqual(response.json()['results'], [
+            {'type': 'user', 'id': self.bob.id, 'label': 'bob', 'username': 'bob', 'url': '/user/bob/'},
+        ])
+
+
+class UserStatsTests(TestCase):
+    FIELDS = ('posts_count', 'comments_count', 'communities_count', 'friends_count', 'likes_received')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(username='alice', password='password')
+        cls.bob = User.objects.create_user(username='bob', password='password')
+        cls.community = Community.objects.create(name='Optics', created_by=cls.bob)
+
+    def setUp(self):
+        friend_graph.clear()
+
+    def stats(self, user):
+        stats = UserStats.objects.get(user=user)
+        return {field: getattr(stats, field) for field in self.FIELDS}
+
+    def assertMatchesRecompute(self, *users):
+        maintained = [self.stats(user) for user in users]
+        UserStats.recompute([user.id for user in users])
+        self.assertEqual(maintained, [self.stats(user) for user in users])
+
+    def test_write_paths_keep_stats(self):
+        UserStats.for_user(self.alice)
+        UserStats.for_user(self.bob)
+
+        post = Post.objects.create(author=self.alice, title='Laser', content='...')
+        Post.objects.create(author=self.alice, title='Optics', content='...', community=self.community)
+        Comment.objects.create(post=post, author=self.bob, content='!')
+        Comment.objects.create(post=post, author=self.alice, content='?')
+        PostLike.objects.create(post=post, user=self.bob)
+        CommunityMembership.objects.create(user=self.alice, community=self.community)
+        CommunityMembership.objects.create(user=self.bob, community=self.community, role='admin')
+        with self.captureOnCommitCallbacks(execute=True):
+            Friendship.objects.create(from_user=self.alice, to_user=self.bob).accept()
+
+        self.assertEqual(self.stats(self.alice), {'posts_count': 2, 'comments_count': 1, 'communities_count': 1,
+                                                  'friends_count': 1, 'likes_received': 1})
+        self.assertMatchesRecompute(self.alice, self.bob)
+
+        # Удаление поста каскадом уносит комментарии и лайки
+        post.delete()
+        apply_member_changes(self.community, {}, [self.alice.id])
+        self.assertEqual(self.stats(self.alice), {'posts_count': 1, 'comments_count': 0, 'communities_count': 0,
+                                                  'friends_count': 1, 'likes_received': 0})
+        self.assertEqual(self.stats(self.bob)['comments_count'], 0)
+        self.assertMatchesRecompute(self.alice, self.bob)
+
+    def test_missing_row_is_computed_on_read(self):
+        Post.objects.create(author=self.alice, title='Laser', content='...')
+        self.assertFalse(UserStats.objects.filter(user=self.alice).exists())
+        self.assertEqual(UserStats.for_user(self.alice).posts_count, 1)
+
+    def test_recompute_command(self):
+        Post.objects.create(author=self.alice, title='Laser', content='...')
+        UserStats.for_user(self.alice)
+        UserStats.objects.update(posts_count=42)
+
+        call_command('recompute_user_stats', batch_size=1, stdout=mock.MagicMock())
+        self.assertEqual(self.stats(self.alice)['posts_count'], 1)
+        self.assertEqual(UserStats.objects.count(), User.objects.count())
+
+    def test_profile_pages_read_one_stats_row(self):
+        for index in range(5):
+            post = Post.objects.create(author=self.alice, title=f'Post {index}', content='...')
+            PostLike.objects.create(post=post, user=self.bob)
+            Comment.objects.create(post=post, author=self.bob, content='!')
+        UserStats.for_user(self.alice)
+        self.client.force_login(self.bob)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('users:user_profile', args=['alice']))
+        self.assertEqual(response.context['stats'].likes_received, 5)
+        sqls = [query['sql'] for query in queries]
+        # Ни одного отдельного подсчета: статистика - одна строка, счетчики постов - поля и подзапросы списка
+        stats_sources = ('"posts_post"', '"posts_comment"', '"communities_communitymembership"', '"users_friendedge"')
+        self.assertFalse([sql for sql in sqls
+                          if sql.startswith('SELECT COUNT(') and any(table in sql for table in stats_sources)])
+        self.assertFalse([sql for sql in sqls if 'posts_postlike' in sql])
 
-# Create your tests here.
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('users:profile'))
+        self.assertEqual(response.context['stats'].posts_count, 5)
+        self.assertContains(response, 'Post 4')
@@ -0,0 +1,270 @@
+import heapq
+import math
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import timedelta
+from operator import itemgetter
+
+from django.conf import settings
+from django.db.models import Count
+from django.utils import timezone
+
+from .friend_graph import friend_graph
+
+
+KINDS = ('user', 'community', 'field')
+
+TOP_K = 10               # сколько подсказок возвращается по умолчанию
+TOP_DEPTH = 2 * TOP_K    # сколько лучших кандидатов каждого вида хранится для префикса (запас на исключенных)
+MEMO_THRESHOLD = 256     # диапазоны длиннее этого не сканируются повторно, их топ запоминается
+MEMO_SIZE = 4096         # сколько префиксов с запомненным топом хранится (LRU)
+WARM_PREFIX_LENGTH = 2   # топы префиксов до этой длины считаются сразу при загрузке
+FRIEND_BOOST = 100.0     # друзья пользователя всегда выше остальных людей
+FRIEND_SCAN_LIMIT = 2000
+MAX_WORDS = 4            # сколько слов названия индексируется отдельно
+
+
+def normalize(text):
+    """Нижний регистр без диакритики: «Ёлкин» и «елкин», «José» и «jose» совпадают"""
+    text = unicodedata.normalize('NFKD', (text or '').casefold())
+    return ' '.join(''.join(char for char in text if not unicodedata.combining(char)).split())
+
+
+def _name_keys(name):
+    # Название целиком и каждое следующее слово: «Quantum Optics» находится и по «opt»
+    words = normalize(name).split()
+    return {' '.join(words[index:]) for index in range(min(len(words), MAX_WORDS))}
+
+
+class TypeaheadIndex:
+    """
+    Префиксный поиск для автодополнения в памяти процесса.
+
+    Ключи (username, имена, названия) лежат в отсортированном массиве,
+    диапазон префикса находится бинарным поиском. Для коротких префиксов
+    с длинным диапазоном лучшие по популярности кандидаты запоминаются.
+    Индекс загружается при первом обращении, раз в refresh_interval секунд
+    дочитывает измененные строки по updated_at и раз в reload_interval
+    секунд перестраивается целиком (подхватывая удаления и новые веса).
+    """
+
+    def __init__(self, max_items=None, refresh_interval=None, reload_interval=None, clock=time.monotonic):
+        self.max_items = max_items or getattr(settings, 'TYPEAHEAD_MAX_ITEMS', 100000)
+        self.refresh_interval = refresh_interval or getattr(settings, 'TYPEAHEAD_REFRESH_INTERVAL', 30)
+        self.reload_interval = reload_interval or getattr(settings, 'TYPEAHEAD_RELOAD_INTERVAL', 900)
+        self.clock = clock
+
+        self._items = {}        # (вид, id) -> (подпись, вес, ключи, username)
+        self._keys = []         # отсортированные ключи
+        self._refs = []         # (вид, id) для ключа с тем же индексом
+        self._memo = OrderedDict()  # префикс -> {вид: [((вид, id), вес), ...]}
+        self._loaded_at = None
+        self._refreshed_at = None
+        self._synced_at = None  # время БД, с которого дочитываются изменения
+        self._last_field_id = 0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def lookup(self, query, user_id=None, kinds=KINDS, limit=TOP_K, exclude=()):
+        """
+        До limit подсказок для префикса query, лучшие первыми.
+
+        Вес - популярность (число друзей, участников сообщества, профилей
+        в научной области); друзья user_id поднимаются наверх. Кандидатов
+        берется с запасом на exclude, чтобы исключенные не сокращали выдачу.
+        """
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        self._ensure_fresh()
+
+        friend_ids = friend_graph.friend_ids(user_id)[:FRIEND_SCAN_LIMIT] if user_id and 'user' in kinds else ()
+        exclude = {('user', excluded_id) for excluded_id in exclude}
+
+        with self._lock:
+            top = self._top_for(prefix, limit + len(exclude))
+            candidates = {ref: weight for kind in kinds for ref, weight in top.get(kind, ())}
+            for friend_id in friend_ids:
+                ref = ('user', friend_id)
+                item = self._items.get(ref)
+                if item is not None and any(key.startswith(prefix) for key in item[2]):
+                    candidates[ref] = item[1] + FRIEND_BOOST
+
+            ranked = heapq.nlargest(limit, (pair for pair in candidates.items() if pair[0] not in exclude),
+                                    key=itemgetter(1))
+            return [self._result(ref) for ref, _ in ranked]
+
+    def reload(self):
+        """Перестроить индекс целиком из БД"""
+        synced_at = timezone.now()
+        items = {}
+        for kind, rows in self._load_rows().items():
+            for row in rows:
+                items[(kind, row[0])] = self._make_item(kind, row)
+
+        pairs = sorted((key, ref) for ref, item in items.items() for key in item[2])
+        keys = [key for key, _ in pairs]
+        refs = [ref for _, ref in pairs]
+        memo = self._warm_memo(items, keys, refs)
+        with self._lock:
+            self._items, self._keys, self._refs, self._memo = items, keys, refs, memo
+            self._last_field_id = max((ref[1] for ref in items if ref[0] == 'field'), default=0)
+            self._loaded_at = self._refreshed_at = self.clock()
+            self._synced_at = synced_at
+
+    def refresh(self):
+        """Дочитать строки, измененные с прошлой синхронизации"""
+        synced_at = timezone.now()
+        # Запас на запись, которая шла одновременно с прошлой синхронизацией
+        changed = self._load_rows(since=self._synced_at - timedelta(seconds=1), field_id=self._last_field_id)
+        deactivated = self._load_deactivated(since=self._synced_at - timedelta(seconds=1))
+        with self._lock:
+            for user_id in deactivated:
+                self._remove(('user', user_id))
+            for kind, rows in changed.items():
+                for row in rows:
+                    self._upsert((kind, row[0]), self._make_item(kind, row))
+                    if kind == 'field':
+                        self._last_field_id = max(self._last_field_id, row[0])
+            self._refreshed_at = self.clock()
+            self._synced_at = synced_at
+
+    def clear(self):
+        with self._lock:
+            self._items, self._keys, self._refs = {}, [], []
+            self._memo.clear()
+            self._loaded_at = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def _ensure_fresh(self):
+        now = self.clock()
+        if self._loaded_at is not None and now - self._refreshed_at < self.refresh_interval:
+            return
+        # Загрузкой занимается один поток; остальные, если индекс уже есть, отвечают по нему
+        if not self._load_lock.acquire(blocking=self._loaded_at is None):
+            return
+        try:
+            if self._loaded_at is None or now - self._loaded_at >= self.reload_interval:
+                self.reload()
+            elif now - self._refreshed_at >= self.refresh_interval:
+                self.refresh()
+        finally:
+            self._load_lock.release()
+
+    def _load_rows(self, since=None, field_id=None):
+        from communities.models import Community
+        from .models import ScientificField, User
+
+        users = User.objects.filter(is_active=True).annotate(popularity=Count('friend_edges'))
+        communities = Community.objects.annotate(popularity=Count('members'))
+        fields = ScientificField.objects.annotate(popularity=Count('profiles'))
+        if since is not None:
+            users = users.filter(updated_at__gte=since)
+            communities = communities.filter(updated_at__gte=since)
+            fields = fields.filter(id__gt=field_id)
+
+        limit = self.max_items
+        return {
+            'user': users.order_by('-popularity', 'id').values_list(
+                'id', 'username', 'first_name', 'last_name', 'popularity')[:limit],
+            'community': communities.order_by('-popularity', 'id').values_list('id', 'name', 'popularity')[:limit],
+            'field': fields.order_by('-popularity', 'id').values_list('id', 'name', 'popularity')[:limit],
+        }
+
+    @staticmethod
+    def _load_deactivated(since):
+        """id пользователей, отключенных после since: обычная выборка их уже не видит"""
+        from .models import User
+
+        return list(User.objects.filter(is_active=False, updated_at__gte=since).values_list('id', flat=True))
+
+    @staticmethod
+    def _make_item(kind, row):
+        weight = math.log1p(row[-1])
+        if kind == 'user':
+            _, username, first_name, last_name, _ = row
+            full_name = f'{first_name} {last_name}'.strip()
+            keys = {normalize(username)} | (_name_keys(full_name) if full_name else set())
+            return full_name or username, weight, tuple(keys), username
+        return row[1], weight, tuple(_name_keys(row[1])), None
+
+    def _upsert(self, ref, item):
+        self._remove(ref)
+        for key in item[2]:
+            index = bisect_left(self._keys, key)
+            self._keys.insert(index, key)
+            self._refs.insert(index, ref)
+        self._items[ref] = item
+        self._forget_prefixes(item[2])
+
+    def _remove(self, ref):
+        """Убрать запись из индекса вместе с ее ключами"""
+        old = self._items.pop(ref, None)
+        old_keys = old[2] if old else ()
+        for key in old_keys:
+            index = bisect_left(self._keys, key)
+            while self._refs[index] != ref:
+                index += 1
+            del self._keys[index]
+            del self._refs[index]
+        self._forget_prefixes(old_keys)
+
+    def _forget_prefixes(self, keys):
+        # Запомненные топы префиксов этих ключей устарели
+        for key in keys:
+            for length in range(1, len(key) + 1):
+                self._memo.pop(key[:length], None)
+
+    @staticmethod
+    def _warm_memo(items, keys, refs):
+        """Топы самых коротких префиксов: их диапазоны длиннее всего, а запросы начинаются с них"""
+        memo = OrderedDict()
+        for length in range(1, WARM_PREFIX_LENGTH + 1):
+            index = 0
+            while index < len(keys):
+                prefix = keys[index][:length]
+                high = bisect_left(keys, prefix + '\U0010ffff', lo=index)
+                if high - index > MEMO_THRESHOLD:
+                    memo[prefix] = _top_in_range(items, refs, index, high)
+                index = high
+        return memo
+
+    def _top_for(self, prefix, depth=TOP_K):
+        # Запомненного топа хватает, если нужно не больше TOP_DEPTH кандидатов
+        top = self._memo.get(prefix) if depth <= TOP_DEPTH else None
+        if top is not None:
+            self._memo.move_to_end(prefix)
+            return top
+
+        low = bisect_left(self._keys, prefix)
+        high = bisect_left(self._keys, prefix + '\U0010ffff', lo=low)
+        top = _top_in_range(self._items, self._refs, low, high, max(depth, TOP_DEPTH))
+
+        if high - low > MEMO_THRESHOLD and depth <= TOP_DEPTH:
+            self._memo[prefix] = top
+            if len(self._memo) > MEMO_SIZE:
+                self._memo.popitem(last=False)
+        return top
+
+    def _result(self, ref):
+        label, _, _, username = self._items[ref]
+        result = {'type': ref[0], 'id': ref[1], 'label': label}
+        if username is not None:
+            result['username'] = username
+        return result
+
+
+def _top_in_range(items, refs, low, high, depth=TOP_DEPTH):
+    """Лучшие по весу depth записей каждого вида среди refs[low:high]"""
+    weights = {kind: {} for kind in KINDS}
+    for ref in refs[low:high]:
+        weights[ref[0]][ref] = items[ref][1]
+    return {kind: heapq.nlargest(depth, found.items(), key=itemgetter(1)) for kind, found in weights.items()}
+
+
+typeahead = TypeaheadIndex()
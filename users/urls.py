@@ -18,6 +18,7 @@ urlpatterns = [
     path('user/<str:username>/', views_friends.user_profile, name='user_profile'),
     path('friends/', views_friends.friends_list, name='friends_list'),
     path('search/', views_friends.search_users, name='search_users'),
+    path('typeahead/', views_friends.typeahead_search, name='typeahead'),
     path('friend-request/send/<str:username>/', views_friends.send_friend_request, name='send_friend_request'),
     path('friend-request/accept/<str:username>/', views_friends.accept_friend_request, name='accept_friend_request'),
     path('friend-request/reject/<str:username>/', views_friends.reject_friend_request, name='reject_friend_request'),
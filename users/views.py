@@ -4,7 +4,9 @@ from django.contrib.auth import login, authenticate
 from django.contrib.auth.decorators import login_required
 from django.db import transaction
 from .forms import UserRegisterForm, UserLoginForm, UserUpdateForm, ProfileUpdateForm
-from .models import Profile
+from .models import Profile, UserStats
+from chats.models import Chat
+from posts.engagement import apply_buffered
 
 
 def home(request):
@@ -55,12 +57,15 @@ def profile(request):
     if created:
         messages.info(request, 'Профиль был автоматически создан для вас!')
 
-    # Получаем посты пользователя
-    user_posts = request.user.posts.all().order_by('-created_at')
+    # Посты пользователя со счетчиками лайков и комментариев одним запросом
+    user_posts = request.user.posts.with_engagement().select_related('scientific_field').order_by('-created_at')
+    # Лайки, еще не перенесенные из буфера, видны сразу
+    user_posts, _ = apply_buffered(user_posts)
 
     context = {
         'profile': profile,  # Явно передаем профиль в контекст
-        'user_posts': user_posts
+        'user_posts': user_posts,
+        'stats': UserStats.for_user(request.user),
     }
 
     return render(request, 'users/profile.html', context)
@@ -85,6 +90,8 @@ def profile_edit(request):
         if user_form.is_valid() and profile_form.is_valid():
             user_form.save()
             profile_form.save()
+            # Имя хранится в сводках личных чатов
+            Chat.refresh_member_names(request.user)
             messages.success(request, 'Ваш профиль успешно обновлен!')
             return redirect('users:profile')
     else:
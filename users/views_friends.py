@@ -1,23 +1,28 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse
 from django.db import models
-from .models import User, Friendship
+from .models import User, Friendship, UserStats
+from .search import search_people
+from .typeahead import KINDS, TOP_K, typeahead
+from posts.engagement import apply_buffered
 
 
 @login_required
 def user_profile(request, username):
     """Просмотр профиля другого пользователя"""
-    user = get_object_or_404(User, username=username)
+    user = get_object_or_404(User.objects.select_related('profile', 'stats'), username=username)
 
-    # Статистика
-    posts_count = user.posts.count()
-    friends_count = user.get_friends_count()
+    # Статистика - одной строкой UserStats
+    stats = UserStats.for_user(user)
+    mutual_friends_count = 0
 
     # Статус дружбы с текущим пользователем
     friendship_status = None
     if request.user != user:
+        mutual_friends_count = request.user.get_mutual_friends_count(user)
         if request.user.is_friends_with(user):
             friendship_status = 'friends'
         elif request.user.has_pending_request_to(user):
@@ -29,8 +34,10 @@ def user_profile(request, username):
 
     context = {
         'profile_user': user,
-        'posts_count': posts_count,
-        'friends_count': friends_count,
+        'stats': stats,
+        # Лайки, еще не перенесенные из буфера, видны сразу
+        'user_posts': apply_buffered(user.posts.with_engagement().order_by('-created_at'))[0],
+        'mutual_friends_count': mutual_friends_count,
         'friendship_status': friendship_status,
     }
 
@@ -167,20 +174,35 @@ def friends_list(request):
 @login_required
 def search_users(request):
     """Поиск пользователей"""
-    query = request.GET.get('q', '')
-    users = User.objects.all()
-
-    if query:
-        users = users.filter(
-            models.Q(username__icontains=query) |
-            models.Q(first_name__icontains=query) |
-            models.Q(last_name__icontains=query) |
-            models.Q(email__icontains=query)
-        ).exclude(id=request.user.id)
+    query = request.GET.get('q', '').strip()
+    page = search_people(query, exclude_user_id=request.user.id, after=request.GET.get('after'))
 
     context = {
-        'users': users,
+        'users': page['results'],
         'query': query,
+        'has_more': page['has_more'],
+        'next_cursor': page['next_cursor'],
     }
 
-    return render(request, 'users/search_users.html', context)
\ No newline at end of file
+    return render(request, 'users/search_users.html', context)
+
+
+@login_required
+def typeahead_search(request):
+    """Подсказки по префиксу: люди, сообщества и научные области (?types=user,community)"""
+    kinds = tuple(kind for kind in request.GET.get('types', '').split(',') if kind in KINDS) or KINDS
+    try:
+        limit = min(max(int(request.GET.get('limit', TOP_K)), 1), TOP_K)
+    except ValueError:
+        limit = TOP_K
+
+    results = typeahead.lookup(
+        request.GET.get('q', ''), user_id=request.user.id, kinds=kinds, limit=limit, exclude=[request.user.id]
+    )
+    for result in results:
+        if result['type'] == 'user':
+            result['url'] = reverse('users:user_profile', args=[result['username']])
+        elif result['type'] == 'community':
+            result['url'] = reverse('communities:community_detail', args=[result['id']])
+
+    return JsonResponse({'results': results})
@@ -0,0 +1,22 @@
+import re
+from urllib.parse import unquote
+
+
+# DOI: префикс 10.<регистрант>/ и непустой суффикс; всё перед ним (resolver, «doi:») отбрасывается
+_DOI_RE = re.compile(r'10\.\d{4,9}/\S+')
+
+
+def normalize_doi(value):
+    """
+    Канонический ключ DOI или None.
+
+    «https://doi.org/10.1038/NATURE12373», «doi:10.1038/nature12373» и
+    «10.1038/nature12373» дают один ключ: DOI нечувствителен к регистру,
+    адрес резолвера и URL-кодирование в ключ не входят.
+    """
+    if not value:
+        return None
+    match = _DOI_RE.search(unquote(value.strip()))
+    if match is None:
+        return None
+    return match.group(0).rstrip('.,;').lower()[:100]
@@ -0,0 +1,35 @@
+import re
+
+
+# Общие части полнотекстового поиска людей, публикаций и сообщений. Индексы FTS5
+# есть только в SQLite; на других СУБД модули поиска переходят на свой
+# _search_scan - подстрочный поиск без ранжирования
+
+# Больше слов в запросе не учитывается
+MAX_QUERY_TOKENS = 10
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def parse_query(query):
+    """Слова запроса в нижнем регистре (операторы FTS5 из пользовательского ввода не передаются)"""
+    return [token.lower() for token in _TOKEN_RE.findall(query or '')][:MAX_QUERY_TOKENS]
+
+
+def prefix_query(tokens):
+    """Запрос FTS5, в котором каждое слово - префиксный поиск: «иван» найдет «Иванов»"""
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def parse_cursor(cursor):
+    """(оценка, id) из курсора «оценка:id» или None"""
+    try:
+        score, row_id = (cursor or '').rsplit(':', 1)
+        return float(score), int(row_id)
+    except ValueError:
+        return None
+
+
+def make_cursor(score, row_id):
+    """Курсор «оценка:id» для следующей страницы ранжированной выдачи"""
+    return f'{score!r}:{row_id}'
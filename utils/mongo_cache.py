@@ -1,5 +1,6 @@
 from AxonHorizon.mongo_cache import MongoCacheBackend
 from datetime import datetime
+from pymongo.errors import DuplicateKeyError
 import json
 # Инициализация кэша
 cache = MongoCacheBackend(location='', params={})
@@ -62,17 +63,27 @@ class MongoCacheHelper:
         cache.clear()
 
     @staticmethod
-    def cache_news_feed(user_id, content_type, page_number, posts_data, timeout=300):
+    def cache_news_feed(user_id, content_type, page_number, posts_data, timeout=300, sort='new'):
         """Кэширование ленты новостей на 5 минут"""
-        cache_key = f'news_feed_{user_id}_{content_type}_{page_number}'
+        cache_key = f'news_feed_{user_id}_{content_type}_{sort}_{page_number}'
         cache.set(cache_key, posts_data, timeout)
 
     @staticmethod
-    def get_cached_news_feed(user_id, content_type, page_number):
+    def get_cached_news_feed(user_id, content_type, page_number, sort='new'):
         """Получение кэшированной ленты новостей"""
-        cache_key = f'news_feed_{user_id}_{content_type}_{page_number}'
+        cache_key = f'news_feed_{user_id}_{content_type}_{sort}_{page_number}'
         return cache.get(cache_key)
 
+    @staticmethod
+    def cache_feed_order(user_id, content_type, order, timeout=1800):
+        """Порядок ранжированного окна ленты ({'ids', 'version'}) на 30 минут: по нему нарезаются следующие страницы"""
+        cache.set(f'feed_order_{user_id}_{content_type}', order, timeout)
+
+    @staticmethod
+    def get_cached_feed_order(user_id, content_type):
+        """Получение сохраненного порядка ранжированного окна ленты"""
+        return cache.get(f'feed_order_{user_id}_{content_type}')
+
     @staticmethod
     def cache_favourite_posts(user_id, scientific_field_id, post_type, posts_data, timeout=600):
         """Кэширование избранных постов на 10 минут"""
@@ -97,6 +108,72 @@ class MongoCacheHelper:
         cache_key = f'post_detail_{post_id}'
         return cache.get(cache_key)
 
+    @staticmethod
+    def cache_comment_page(post_id, cursor, page_data, is_tail=False, timeout=1800, tail_version=None):
+        """
+        Кэширование страницы комментариев поста на 30 минут.
+
+        Неполная страница помечается версией хвоста, прочитанной до запроса
+        к БД (comment_tail_version): если комментарий добавили, пока страница
+        читалась, она сохранится со старой версией и не будет отдана.
+        """
+        if is_tail:
+            page_data = {**page_data, 'tail_version': tail_version}
+        cache.set(f'post_{post_id}_comments_{cursor}', page_data, timeout)
+        if is_tail:
+            # Запоминаем курсоры всех неполных страниц: только их затрагивает новый комментарий.
+            # Неполной бывает и страница с произвольного курсора, а не только конец цепочки
+            cache._collection.update_one(
+                {'_id': cache.make_key(f'post_{post_id}_comments_tails')},
+                {'$addToSet': {'cursors': cursor}, '$set': {'expires': cache._get_expires(timeout)}},
+                upsert=True
+            )
+
+    @staticmethod
+    def get_cached_comment_page(post_id, cursor):
+        """Получение кэшированной страницы комментариев (неполная - только текущей версии хвоста)"""
+        page = cache.get(f'post_{post_id}_comments_{cursor}')
+        if page is not None and 'tail_version' in page:
+            if page.pop('tail_version') != MongoCacheHelper.comment_tail_version(post_id):
+                return None
+        return page
+
+    @staticmethod
+    def comment_tail_version(post_id):
+        """Версия неполных страниц комментариев: растет с каждым новым комментарием"""
+        doc = cache._collection.find_one({'_id': cache.make_key(f'post_{post_id}_comments_version')}, {'version': 1})
+        return doc['version'] if doc else 0
+
+    @staticmethod
+    def invalidate_comment_tail(post_id, timeout=86400):
+        """Инвалидация неполных страниц комментариев (заполненные страницы не меняются)"""
+        # Версия живет намного дольше страниц, иначе страница со старой версией снова сочтется свежей
+        cache._collection.update_one(
+            {'_id': cache.make_key(f'post_{post_id}_comments_version')},
+            {'$inc': {'version': 1}, '$set': {'expires': cache._get_expires(timeout)}},
+            upsert=True
+        )
+        doc = cache._collection.find_one_and_delete({'_id': cache.make_key(f'post_{post_id}_comments_tails')})
+        if doc and doc.get('cursors'):
+            cache._collection.delete_many({'_id': {'$in': [
+                cache.make_key(f'post_{post_id}_comments_{cursor}') for cursor in doc['cursors']
+            ]}})
+
+    @staticmethod
+    def cache_community_feed(community_id, page_data, timeout=300):
+        """Кэширование первой страницы ленты сообщества на 5 минут"""
+        cache.set(f'community_{community_id}_feed', page_data, timeout)
+
+    @staticmethod
+    def get_cached_community_feed(community_id):
+        """Получение кэшированной первой страницы ленты сообщества"""
+        return cache.get(f'community_{community_id}_feed')
+
+    @staticmethod
+    def invalidate_community_feed(community_id):
+        """Инвалидация первой страницы ленты сообщества (новый или удаленный пост)"""
+        cache.delete(f'community_{community_id}_feed')
+
     @staticmethod
     def cache_chat_list(user_id, chats_data, timeout=300):
         """Кэширование списка чатов на 5 минут"""
@@ -110,16 +187,74 @@ class MongoCacheHelper:
         return cache.get(cache_key)
 
     @staticmethod
-    def cache_chat_messages(chat_id, messages_data, timeout=300):
-        """Кэширование сообщений чата на 5 минут"""
-        cache_key = f'chat_messages_{chat_id}'
-        cache.set(cache_key, messages_data, timeout)
+    def cache_chat_messages(chat_id, window, timeout=86400):
+        """
+        Кэширование окна последних сообщений чата на 24 часа.
+
+        Окно хранится документом с массивом сообщений, чтобы новые сообщения
+        дописывались в него через $push, а не сбрасывали кэш. last_id - метка
+        версии: окно, собранное из БД раньше уже записанного сообщения, не
+        перезапишет более новую метку.
+        """
+        last_id = window['messages'][-1]['id'] if window['messages'] else 0
+        try:
+            cache._collection.replace_one(
+                {'_id': cache.make_key(f'chat_messages_{chat_id}'), 'last_id': {'$lte': last_id}},
+                {
+                    'messages': window['messages'],
+                    'last_id': last_id,
+                    'truncated': window['has_more'],
+                    'size': len(window['messages']),
+                    'expires': cache._get_expires(timeout),
+                },
+                upsert=True
+            )
+        except DuplicateKeyError:
+            pass
 
     @staticmethod
     def get_cached_chat_messages(chat_id):
-        """Получение кэшированных сообщений чата"""
-        cache_key = f'chat_messages_{chat_id}'
-        return cache.get(cache_key)
+        """Получение кэшированного окна сообщений чата ({'messages', 'has_more'} или None)"""
+        doc = cache._collection.find_one({'_id': cache.make_key(f'chat_messages_{chat_id}')})
+        if not doc or 'messages' not in doc or (doc.get('expires') and doc['expires'] < datetime.utcnow()):
+            return None
+        return {'messages': doc['messages'], 'has_more': doc['truncated'] or doc['size'] > len(doc['messages'])}
+
+    @staticmethod
+    def append_chat_message(chat_id, message_data, previous_id, window_size, timeout=86400):
+        """
+        Дописать новое сообщение в кэшированное окно чата.
+
+        Запись проходит, только если окно заканчивается сообщением previous_id,
+        длина окна ограничивается $slice. Иначе (или если previous_id
+        неизвестен - None) в окне пропуск: сообщения удаляются, а метка
+        сдвигается вперед, чтобы окно пересобрали из БД.
+        Возвращает True, если сообщение дописано.
+        """
+        cache_key = cache.make_key(f'chat_messages_{chat_id}')
+        expires = cache._get_expires(timeout)
+        if previous_id is not None:
+            result = cache._collection.update_one(
+                {'_id': cache_key, 'last_id': previous_id, 'messages': {'$exists': True}},
+                {
+                    '$push': {'messages': {'$each': [message_data], '$slice': -window_size}},
+                    '$inc': {'size': 1},
+                    '$set': {'last_id': message_data['id'], 'expires': expires},
+                }
+            )
+            if result.modified_count:
+                return True
+
+        try:
+            cache._collection.update_one(
+                {'_id': cache_key, 'last_id': {'$lt': message_data['id']}},
+                {'$set': {'last_id': message_data['id'], 'expires': expires}, '$unset': {'messages': ''}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # В окне уже есть это или более новое сообщение
+            pass
+        return False
 
     @staticmethod
     def invalidate_user_cache(user_id):
@@ -128,6 +263,13 @@ class MongoCacheHelper:
         # Это упрощенная версия
         pass
 
+    @staticmethod
+    def invalidate_chat_lists(user_ids):
+        """Инвалидация кэша списка чатов сразу для многих пользователей одним запросом"""
+        keys = [cache.make_key(f'chat_list_{user_id}') for user_id in user_ids]
+        if keys:
+            cache._collection.delete_many({'_id': {'$in': keys}})
+
     @staticmethod
     def invalidate_post_cache(post_id):
         """Инвалидация кэша поста"""
@@ -0,0 +1,32 @@
+from django.db import connections
+
+
+def explain_query_plan(queryset):
+    """Строки EXPLAIN QUERY PLAN для запроса (только SQLite)"""
+    sql, params = queryset.query.sql_with_params()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def find_full_scans(queryset):
+    """Шаги плана, на которых SQLite полностью сканирует таблицу или индекс"""
+    return [
+        step for step in explain_query_plan(queryset)
+        if step.startswith('SCAN ') and step != 'SCAN CONSTANT ROW'
+    ]
+
+
+class QueryPlanAssertionsMixin:
+    """Проверки плана запросов для TestCase"""
+
+    def assertNoFullScan(self, queryset, msg=None):
+        full_scans = find_full_scans(queryset)
+        if full_scans:
+            plan = '\n'.join(explain_query_plan(queryset))
+            self.fail(msg or f'Запрос выполняет полное сканирование {full_scans}:\n{plan}')
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = explain_query_plan(queryset)
+        if not any(index_name in step for step in plan):
+            self.fail(f'Индекс {index_name} не используется:\n' + '\n'.join(plan))